@@ -1,7 +1,10 @@
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 import admintools.routing
+import archive.routing
 
 application = ProtocolTypeRouter({
-    'websocket': AuthMiddlewareStack(URLRouter(admintools.routing.websocket_urlpatterns)),
+    'http': archive.routing.http_application,
+    'websocket': AuthMiddlewareStack(URLRouter(admintools.routing.websocket_urlpatterns +
+                                               archive.routing.websocket_urlpatterns)),
 })
@@ -133,3 +133,82 @@ LOGIN_REDIRECT_URL = 'archive-home'
 LOGIN_URL = 'login'
 #   For Channels async
 ASGI_APPLICATION = 'anniversary_project.routing.application'
+#   How archive parts are spread across S3 connections: 'active' puts every part on the active connection;
+#   'round-robin' and 'throughput' stripe parts across all valid connections whose is_striped is True, either evenly
+#   or weighted by each connection's measured throughput
+ARCHIVE_PLACEMENT_POLICY = 'round-robin'
+#   The sync scripts normally only look at the archives in the change journal; every this many seconds they check
+#   every archive instead, to catch whatever the journal missed
+SYNC_FULL_AUDIT_INTERVAL = 24 * 60 * 60
+#   Local archive files whose fingerprint hasn't changed are not hashed again by sync_archive_to_db until their last
+#   checksum is this many seconds old
+LOCAL_ARCHIVE_REVERIFY_INTERVAL = 30 * 24 * 60 * 60
+#   The scrub runs every SCRUB_INTERVAL seconds and verifies a slice of the remote parts and local archives each time,
+#   so that everything is verified once every SCRUB_PERIOD seconds; a single run never spends more than the budgets, and
+#   paces its S3 requests and local reads to the given rates
+SCRUB_INTERVAL = 60 * 60
+SCRUB_PERIOD = 7 * 24 * 60 * 60
+SCRUB_REQUEST_BUDGET = 2000
+SCRUB_REQUESTS_PER_SECOND = 5
+SCRUB_BYTE_BUDGET = 16 * (2 ** 30)
+SCRUB_BYTES_PER_SECOND = 32 * (2 ** 20)
+#   Completed transfer jobs stay in the queue for this many seconds before they are moved into the job history
+TRANSFER_JOB_RETENTION = 7 * 24 * 60 * 60
+#   PRAGMAs run on every new SQLite connection (see archive/signals.py). WAL lets readers carry on while a process
+#   writes, busy_timeout (milliseconds) makes a writer wait for the lock instead of failing with "database is locked",
+#   NORMAL synchronous is durable in WAL mode except across power loss, and mmap_size (bytes) and cache_size (negative
+#   for KiB) size the memory used for reading
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 10000,
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * (2 ** 20),
+    'cache_size': -64 * (2 ** 10),
+}
+#   Fully uploaded archives with at least this many parts, none of them cached, are packed into an ArchivePartTable by
+#   scripts/pack_part_tables.py
+PART_TABLE_MIN_PARTS = 10000
+#   Each page of a user's archive listing is cached for this many seconds, or until one of the user's archives
+#   changes. Changes made by the scripts only reach the web server's cache if CACHES is shared between processes
+ARCHIVE_HOME_CACHE_TIMEOUT = 30
+#   How archive downloads (see archive.views.archive_download) are sent once the owner has been checked. None streams
+#   the file from Django with FileResponse, which the WSGI server sends with sendfile if it has a wsgi.file_wrapper,
+#   ARCHIVE_DOWNLOAD_BLOCK_SIZE bytes at a time otherwise. 'X-Accel-Redirect' hands the file off to nginx through an
+#   internal location that maps ARCHIVE_SENDFILE_URL_PREFIX to MEDIA_ROOT, and 'X-Sendfile' hands the file's absolute
+#   path off to Apache's mod_xsendfile or lighttpd
+ARCHIVE_SENDFILE_HEADER = None
+ARCHIVE_SENDFILE_URL_PREFIX = '/protected/'
+ARCHIVE_DOWNLOAD_BLOCK_SIZE = 2 ** 20
+#   An archive that isn't cached but is fully uploaded is streamed from its buckets when it is downloaded, fetching
+#   up to this many parts ahead of the one being sent; each of them is held in memory until it is sent
+ARCHIVE_STREAM_READ_AHEAD = 4
+#   The channel layer that the transfer workers publish archive progress to, and that the archive detail page's
+#   WebSocket listens on (see archive/progress.py). It has to be shared between processes, so it needs Redis at
+#   ARCHIVE_PROGRESS_REDIS_HOSTS; with None, there is no such layer and the detail page is not updated live. It has
+#   its own alias so that the other consumers, like the admin consoles, never depend on Redis
+ARCHIVE_PROGRESS_CHANNEL_LAYER = 'archive-progress'
+ARCHIVE_PROGRESS_REDIS_HOSTS = None
+CHANNEL_LAYERS = dict()
+if ARCHIVE_PROGRESS_REDIS_HOSTS:
+    CHANNEL_LAYERS[ARCHIVE_PROGRESS_CHANNEL_LAYER] = {
+        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'CONFIG': {
+            'hosts': ARCHIVE_PROGRESS_REDIS_HOSTS,
+        },
+    }
+#   The progress of each archive is published at most this many times per second
+ARCHIVE_PROGRESS_UPDATES_PER_SECOND = 4
+#   Cached archive files are evicted, the least recently accessed first, once the files under MEDIA_ROOT/archives
+#   take up more than ARCHIVE_CACHE_HIGH_WATER of ARCHIVE_CACHE_BUDGET bytes, or once the disk holding MEDIA_ROOT is
+#   fuller than ARCHIVE_CACHE_HIGH_WATER, until they are back to ARCHIVE_CACHE_LOW_WATER (see
+#   scripts/evict_archives.py). Only fully uploaded archives are evicted. A budget of None only watches the disk
+ARCHIVE_CACHE_BUDGET = None
+ARCHIVE_CACHE_HIGH_WATER = 0.9
+ARCHIVE_CACHE_LOW_WATER = 0.75
+#   An archive's last access is written at most once every this many seconds (see Archive.touch)
+ARCHIVE_ACCESS_RESOLUTION = 60
+#   The download hits and misses are counted in memory and written once every this many seconds (see
+#   archive.utils.CacheEventCounter); the counts of the last interval are lost if the server exits before then
+CACHE_EVENT_FLUSH_INTERVAL = 60
+#   The cache hits, misses and evictions (see archive.models.CacheEvent) are kept for this many seconds
+CACHE_EVENT_RETENTION = 30 * 24 * 60 * 60
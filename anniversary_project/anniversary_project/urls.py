@@ -1,9 +1,9 @@
 from django.contrib import admin
 from django.contrib.auth import views as auth_views
-from django.urls import path, include
+from django.urls import path, re_path, include
 from users import views as user_views
 from django.conf import settings
-from django.conf.urls.static import static
+from django.views.static import serve
 
 urlpatterns = [
     path('', auth_views.LoginView.as_view(template_name='users/login.html'), name='login'),
@@ -18,4 +18,8 @@ urlpatterns = [
 ]
 
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    #   Archive files are left out, since they are only served by archive-download, which checks the owner
+    urlpatterns += [
+        re_path(r'^%s(?!archives/)(?P<path>.*)$' % settings.MEDIA_URL.lstrip('/'), serve,
+                kwargs={'document_root': settings.MEDIA_ROOT}),
+    ]
\ No newline at end of file
@@ -0,0 +1,109 @@
+import json
+import asyncio
+
+from asgiref.sync import sync_to_async, async_to_sync
+from channels.exceptions import RequestAborted, RequestTimeout
+from channels.generic.websocket import WebsocketConsumer
+from channels.http import AsgiHandler
+from django.conf import settings
+from django.core import signals
+from django.core.exceptions import RequestDataTooBig
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.urls import set_script_prefix
+
+from anniversary_project.settings import ARCHIVE_PROGRESS_CHANNEL_LAYER
+from .models import Archive
+from .progress import get_progress_group
+
+
+class AsyncStreamingHandler(AsgiHandler):
+    """
+    AsgiHandler only sends a response once the view and the whole response body have been through a worker thread,
+    which a streaming download holds for as long as the client takes to receive it. This handler runs the view the
+    same way, but then reads the body a block at a time in the thread pool and sends each block from the event loop,
+    so that a slow client holds no thread while it receives. Routed to the views with long-running I/O (see
+    archive/routing.py)
+    """
+
+    async def __call__(self, receive, send):
+        try:
+            body_stream = await self.read_body(receive)
+        except RequestAborted:
+            return
+        response = await sync_to_async(self.get_streaming_response, thread_sensitive=False)(body_stream)
+        if response is None:
+            return
+        #   Once the request has been read, the only message left to receive is the client going away
+        disconnected = asyncio.ensure_future(receive())
+        try:
+            messages = self.encode_response(response)
+            #   The first message is the response's headers
+            await send(next(messages))
+            if not response.streaming:
+                for message in messages:
+                    await send(message)
+            else:
+                read_message = sync_to_async(next, thread_sensitive=False)
+                message = await read_message(messages, None)
+                while message is not None and not disconnected.done():
+                    await send(message)
+                    message = await read_message(messages, None)
+        finally:
+            disconnected.cancel()
+            await sync_to_async(response.close, thread_sensitive=False)()
+
+    def get_streaming_response(self, body_stream):
+        """
+        :param body_stream: the request body, as read by read_body
+        :return: the response of the view, whose body is yet to be read, or None if the client went away; the same as
+        AsgiHandler.handle otherwise
+        """
+        script_prefix = settings.FORCE_SCRIPT_NAME or self.scope.get("root_path", "") or ""
+        set_script_prefix(script_prefix)
+        signals.request_started.send(sender=self.__class__, scope=self.scope)
+        try:
+            try:
+                request = self.request_class(self.scope, body_stream)
+            except UnicodeDecodeError:
+                return HttpResponseBadRequest()
+            except RequestAborted:
+                return None
+            except RequestTimeout:
+                return HttpResponse("408 Request Timeout (upload too slow)", status=408)
+            except RequestDataTooBig:
+                return HttpResponse("413 Payload too large", status=413)
+            return self.get_response(request)
+        finally:
+            #   The response is closed, and request_finished sent, from another thread of the pool, which leaves the
+            #   database connection this thread opened for the view; close it here instead
+            close_old_connections()
+
+
+class ArchiveProgressConsumer(WebsocketConsumer):
+    """
+    Relay the progress that the transfer workers publish about an archive (see archive/progress.py) to its owner's
+    detail page
+    """
+
+    channel_layer_alias = ARCHIVE_PROGRESS_CHANNEL_LAYER
+
+    def connect(self):
+        """
+        Only the archive's owner may listen to its progress, and only if the progress channel layer is configured
+        """
+        archive_id = self.scope['url_route']['kwargs']['pk']
+        user = self.scope['user']
+        if self.channel_layer is None or not Archive.objects.filter(pk=archive_id, owner_id=user.pk).exists():
+            self.close()
+            return
+        self.group_name = get_progress_group(archive_id)
+        async_to_sync(self.channel_layer.group_add)(self.group_name, self.channel_name)
+        self.accept()
+
+    def disconnect(self, close_code):
+        if getattr(self, 'group_name', None):
+            async_to_sync(self.channel_layer.group_discard)(self.group_name, self.channel_name)
+
+    def archive_progress(self, event):
+        self.send(text_data=json.dumps({key: value for key, value in event.items() if key != 'type'}))
@@ -1,15 +1,34 @@
 import uuid
 import os
+import json
 import shutil
 import typing as ty
 import hashlib
 
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.contrib.auth.models import User
 from django.urls import reverse
 
 from anniversary_project.settings import MEDIA_ROOT
+from s3connections.models import S3Connection
+
+
+PART_SIZE = models.F('end_byte_index') - models.F('start_byte_index')
+#   How Archive's counters are counted from its parts
+COUNTER_AGGREGATES = {
+    'parts_total': models.Count('pk'),
+    'parts_uploaded': models.Count('pk', filter=models.Q(uploaded=True)),
+    'parts_cached': models.Count('pk', filter=models.Q(cached=True)),
+    'bytes_uploaded': models.Sum(PART_SIZE, filter=models.Q(uploaded=True)),
+    'archive_size': models.Max('end_byte_index'),
+}
+#   The counter that each part state is counted by
+STATE_COUNTERS = {"uploaded": "parts_uploaded", "cached": "parts_cached"}
+#   Each archive's manifest is stored as "username/archive_id/manifest.json", next to the archive's parts
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
 
 
 def archive_file_save_path(instance, filename) -> str:
@@ -38,6 +57,20 @@ def get_file_checksum(file_path, hash_func=hashlib.md5, chunk_size=8192) -> str:
     return file_hash.hexdigest()
 
 
+def get_file_fingerprint(file_path, include_ctime=False) -> str:
+    """
+    :param file_path: path to a file or a directory
+    :param include_ctime: if True, then also include the inode change time, which catches changes that preserve mtime
+    :return: a string made of the size, the modification time in nanoseconds, and the inode number of the file. If
+    the fingerprint hasn't changed since the file was verified, then the file is assumed not to have changed either
+    """
+    stat = os.stat(file_path)
+    fingerprint = f"{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}"
+    if include_ctime:
+        fingerprint += f":{stat.st_ctime_ns}"
+    return fingerprint
+
+
 class Archive(models.Model):
     """
     Abstraction of the an archive. Each archive corresponds to a file (possibly not distinct).
@@ -51,6 +84,24 @@ class Archive(models.Model):
         the datetime (of local timezone) at which this archive instance is uploaded and created
     -   cached:
         True if and only if the archive_file exists in its original place
+    -   processing:
+        True from the moment the archive file is stored until the background ingest has hashed it and created its
+        parts (see archive.utils.ingest_archive); the archive has no parts and cannot be uncached in the meantime
+    -   cache_dir_fingerprint:
+        the fingerprint of the archive's part cache directory when its parts were last checked; the parts are only
+        checked again once the directory changes
+    -   local_checksum, local_fingerprint, date_local_verified:
+        the checksum of the local archive file when it was last hashed, the file's fingerprint at that time, and when
+        that was; the file is only hashed again once its fingerprint changes or the checksum grows too old
+    -   date_last_accessed:
+        when the archive was last downloaded, ingested or assembled, written by touch; the cached archives that were
+        accessed least recently are evicted first once MEDIA_ROOT runs out of budget (see scripts/evict_archives.py)
+    -   parts_total, parts_uploaded, parts_cached, bytes_uploaded:
+        counters over the archive's parts, kept up to date by ArchivePartMeta.set_state whenever a part is uploaded,
+        cached, or stops being so; repair_counters recounts them from the parts
+    -   archive_size:
+        the size of the archive file in bytes, as partitioned into its parts, set when the archive is ingested so that
+        the archive listing need not add up the parts; repair_counters recounts it along with the counters
     """
 
     archive_id = models.CharField(max_length=64, default=uuid.uuid4, primary_key=True)
@@ -60,6 +111,23 @@ class Archive(models.Model):
     owner: User = models.ForeignKey(to=User, on_delete=models.CASCADE)
     date_created = models.DateTimeField(default=timezone.now)
     cached = models.BooleanField(default=True, null=False)
+    processing = models.BooleanField(default=False, null=False, db_index=True)
+    cache_dir_fingerprint = models.CharField(max_length=128, null=True)
+    local_checksum = models.CharField(max_length=32, null=True)
+    local_fingerprint = models.CharField(max_length=128, null=True)
+    date_local_verified = models.DateTimeField(null=True)
+    date_last_accessed = models.DateTimeField(null=True, db_index=True)
+    parts_total = models.IntegerField(default=0, null=False)
+    parts_uploaded = models.IntegerField(default=0, null=False)
+    parts_cached = models.IntegerField(default=0, null=False)
+    bytes_uploaded = models.BigIntegerField(default=0, null=False)
+    archive_size = models.BigIntegerField(default=0, null=False)
+
+    class Meta:
+        indexes = [
+            #   The home page lists a user's archives newest first, a page at a time (see archive.views.home)
+            models.Index(fields=['owner', '-date_created', '-archive_id']),
+        ]
 
     def __str__(self):
         return self.archive_id + " owned by " + self.owner.username
@@ -68,6 +136,35 @@ class Archive(models.Model):
     def get_absolute_url(self):
         return reverse("archive-detail", kwargs={"pk": self.archive_id})
 
+    def save(self, *args, **kwargs):
+        """
+        Overwrite the default save method so that the counters, which ArchivePartMeta.set_state updates in the
+        database, and date_last_accessed, which touch updates in the database, are not overwritten by a stale copy;
+        they are only saved when they are named in update_fields
+        """
+        if not (self._state.adding or kwargs.get('force_insert') or kwargs.get('update_fields') is not None):
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not (field.primary_key or field.name in COUNTER_AGGREGATES
+                                               or field.name == 'date_last_accessed')]
+        super().save(*args, **kwargs)
+
+    def touch(self, resolution: int = 0) -> bool:
+        """
+        :param resolution: in seconds; the access is not written if the last one recorded is more recent than this,
+        so that the many Range requests of a single download write it only once
+        :return: True if the access was written; record that the archive was accessed now. It is written with
+        update(), so it neither races with a stale copy being saved nor invalidates the home page's cache
+        """
+        now = timezone.now()
+        archives = Archive.objects.filter(pk=self.pk)
+        if resolution:
+            archives = archives.filter(models.Q(date_last_accessed__isnull=True) |
+                                       models.Q(date_last_accessed__lt=now - timezone.timedelta(seconds=resolution)))
+        if not archives.update(date_last_accessed=now):
+            return False
+        self.date_last_accessed = now
+        return True
+
     def delete(self, using=None, keep_parents=False):
         """
         Overwrite the default delete method so the file would be deleted when the model instance is deleted
@@ -77,17 +174,122 @@ class Archive(models.Model):
         wrapper_dir_path = os.path.split(abs_path)[0]
         self.archive_file.storage.delete(self.archive_file.name)
         shutil.rmtree(wrapper_dir_path)
+        ArchiveChange.record(self, "delete")
         super().delete()
 
-    def get_local_checksum(self) -> ty.Optional[str]:
+    def get_local_checksum(self, reverify_interval: ty.Optional[int] = None) -> ty.Optional[str]:
         """
-        if local file exists, then return its checksum as a string; otherwise, return None
+        :param reverify_interval: if given, then reuse the last checksum as long as the file's fingerprint hasn't
+        changed and the checksum is less than this many seconds old; otherwise, always hash the file
+        :return: if local file exists, then return its checksum as a string; otherwise, return None
         """
-        archive_file_path = self.archive_file.file.name
-        if os.path.exists(archive_file_path) and os.path.isfile(archive_file_path):
-            return get_file_checksum(file_path=archive_file_path)
-        else:
+        archive_file_path = os.path.join(MEDIA_ROOT, self.archive_file.name)
+        if not (os.path.exists(archive_file_path) and os.path.isfile(archive_file_path)):
             return None
+        fingerprint = get_file_fingerprint(archive_file_path, include_ctime=True)
+        if reverify_interval is not None and self.local_checksum and self.local_fingerprint == fingerprint \
+                and (timezone.now() - self.date_local_verified).total_seconds() < reverify_interval:
+            return self.local_checksum
+        self.set_local_checksum(get_file_checksum(file_path=archive_file_path), fingerprint)
+        return self.local_checksum
+
+    def is_fully_uploaded(self) -> bool:
+        """
+        :return: True if and only if every part of the archive is uploaded; an archive that is still processing has no
+        parts yet, and is not
+        """
+        return (not self.processing) and self.parts_uploaded == self.parts_total
+
+    def get_part_table(self) -> ty.Optional["ArchivePartTable"]:
+        """
+        :return: the archive's packed part table, or None if its parts are stored as ArchivePartMeta rows
+        """
+        return ArchivePartTable.objects.filter(archive=self).first()
+
+    def get_size(self) -> int:
+        """
+        :return: the size of the archive file in bytes, as partitioned into its parts, whether or not it is cached
+        """
+        return self.archive_size
+
+    def count_parts(self) -> ty.Dict[str, int]:
+        """
+        :return: the counters, recounted from the archive's parts
+        """
+        part_table = self.get_part_table()
+        if part_table:
+            return part_table.count_parts()
+        counters = self.archivepartmeta_set.aggregate(**COUNTER_AGGREGATES)
+        return {counter: value or 0 for counter, value in counters.items()}
+
+    def repair_counters(self) -> bool:
+        """
+        :return: True if the counters were wrong, in which case they are replaced by the ones recounted from the parts
+        """
+        counters = self.count_parts()
+        if all(getattr(self, counter) == value for counter, value in counters.items()):
+            return False
+        for counter, value in counters.items():
+            setattr(self, counter, value)
+        self.save(update_fields=list(counters))
+        return True
+
+    def get_manifest_key(self) -> str:
+        """
+        :return: the S3 file key of the archive's manifest, which lives next to the archive's parts
+        """
+        return f"{self.owner.username}/{self.archive_id}/{MANIFEST_NAME}"
+
+    def get_manifest(self) -> dict:
+        """
+        :return: everything needed to restore the archive and its parts into the database without looking at any
+        other remote object; each part is [part_index, start_byte_index, end_byte_index, part_checksum, connection_id]
+        """
+        part_table = self.get_part_table()
+        if part_table:
+            parts = ((part.part_index, part.start_byte_index, part.end_byte_index, part.part_checksum,
+                      part.connection_id) for part in part_table.iter_parts())
+        else:
+            parts = self.archivepartmeta_set.order_by('part_index')\
+                .values_list('part_index', 'start_byte_index', 'end_byte_index', 'part_checksum', 'connection_id')
+        return {
+            "version": MANIFEST_VERSION,
+            "archive_id": str(self.archive_id),
+            "archive_name": self.archive_name,
+            "archive_file": self.archive_file.name,
+            "archive_file_checksum": self.archive_file_checksum,
+            "owner": self.owner.username,
+            "date_created": self.date_created.isoformat(),
+            "parts": [list(part) for part in parts],
+        }
+
+    def upload_manifest(self) -> ty.List[str]:
+        """
+        :return: the connection_id of every bucket the manifest was written to; the manifest is written to every
+        bucket that holds at least one of the archive's parts, so that any of them is enough to restore the archive
+        """
+        body = json.dumps(self.get_manifest(), separators=(',', ':')).encode()
+        part_table = self.get_part_table()
+        if part_table:
+            conns = S3Connection.objects.filter(pk__in=part_table.get_connection_ids())
+        else:
+            conns = S3Connection.objects.filter(archivepartmeta__archive=self).distinct()
+        for conn in conns:
+            conn.get_client('s3').put_object(Body=body, Bucket=conn.connection_id, Key=self.get_manifest_key())
+        return [conn.connection_id for conn in conns]
+
+    def set_local_checksum(self, checksum: ty.Optional[str], fingerprint: ty.Optional[str] = None):
+        """
+        :param checksum: the checksum of the local archive file that was just hashed, or None if there is no such file
+        :param fingerprint: the fingerprint of the file when it was hashed; taken now if not given
+        :return: None; remember the checksum so that get_local_checksum need not hash the file again
+        """
+        if checksum and fingerprint is None:
+            fingerprint = get_file_fingerprint(os.path.join(MEDIA_ROOT, self.archive_file.name), include_ctime=True)
+        self.local_checksum = checksum
+        self.local_fingerprint = fingerprint if checksum else None
+        self.date_local_verified = timezone.now() if checksum else None
+        self.save(update_fields=['local_checksum', 'local_fingerprint', 'date_local_verified'])
 
 
 class ArchivePartMeta(models.Model):
@@ -99,6 +301,14 @@ class ArchivePartMeta(models.Model):
         True if and only if this sequence of bytes exist in the cache folder in the correct subdirectory
         Note that whether the archive is cached is entirely independent of whether specific archive part is cached;
         the two things live in different places and are relatively independent of each other's statuses.
+    -   cache_fingerprint:
+        the fingerprint of the cached part file when its checksum was last verified; as long as the file's fingerprint
+        is the same, it doesn't need to be hashed again
+    -   connection:
+        the S3Connection whose bucket this part is placed on. Parts of the same archive can be striped across several
+        connections; a part without a connection is placed on whichever connection is active when it is transferred
+    -   date_last_verified:
+        when the remote part was last checked by the scrub; the parts checked least recently are checked first
 
     Note that I call it ArchivePartMeta, not ArchivePart, because unlike Archive, ArchivePartMeta has no field that
     points to actual data. Archive is called Archive instead of ArchiveMeta because Archive.archive_file actually points
@@ -112,6 +322,9 @@ class ArchivePartMeta(models.Model):
     part_checksum = models.CharField(max_length=32, null=True)
     uploaded = models.BooleanField(null=False)
     cached = models.BooleanField(null=False)
+    cache_fingerprint = models.CharField(max_length=128, null=True)
+    connection: S3Connection = models.ForeignKey(to=S3Connection, on_delete=models.SET_NULL, null=True)
+    date_last_verified = models.DateTimeField(null=True, db_index=True)
 
     def __str__(self):
         return f"Archive {self.archive.archive_name}'s part {self.part_index}"
@@ -119,6 +332,62 @@ class ArchivePartMeta(models.Model):
     def get_size(self):
         return self.end_byte_index - self.start_byte_index
 
+    @classmethod
+    def set_state(cls, archive_parts_meta: models.QuerySet, state: str, value: bool) -> int:
+        """
+        :param archive_parts_meta: the parts whose state to set
+        :param state: either "uploaded" or "cached"
+        :param value:
+        :return: the number of parts whose state changed. The parts and their archives' counters are updated in the
+        same transaction, and only the parts whose state actually changes are counted, so that two processes setting
+        the same state can't count a part twice
+        """
+        counter = STATE_COUNTERS[state]
+        sign = 1 if value else -1
+        with transaction.atomic():
+            changing_parts = archive_parts_meta.exclude(**{state: value})
+            deltas = list(changing_parts.order_by().values('archive_id').annotate(
+                num_parts=models.Count('pk'), num_bytes=models.Sum(PART_SIZE)))
+            changed = changing_parts.update(**{state: value})
+            for delta in deltas:
+                counters = {counter: models.F(counter) + sign * delta['num_parts']}
+                if state == "uploaded":
+                    counters["bytes_uploaded"] = models.F("bytes_uploaded") + sign * delta['num_bytes']
+                Archive.objects.filter(pk=delta['archive_id']).update(**counters)
+        return changed
+
+    @classmethod
+    def save_state(cls, archive_parts_meta: ty.List["ArchivePartMeta"], state: str, batch_size: int = 500) -> int:
+        """
+        :param archive_parts_meta: parts whose state was changed in memory
+        :param state: either "uploaded" or "cached"
+        :param batch_size:
+        :return: the number of parts whose state changed; write the parts' state with set_state, in batches
+        """
+        changed = 0
+        for value in (True, False):
+            part_ids = [archive_part_meta.pk for archive_part_meta in archive_parts_meta
+                        if getattr(archive_part_meta, state) == value]
+            for start in range(0, len(part_ids), batch_size):
+                changed += cls.set_state(cls.objects.filter(pk__in=part_ids[start:start + batch_size]), state, value)
+        return changed
+
+    def set_uploaded(self, uploaded: bool) -> bool:
+        """
+        :param uploaded:
+        :return: True if and only if the part's uploaded flag changed; see set_state
+        """
+        self.uploaded = uploaded
+        return bool(ArchivePartMeta.set_state(ArchivePartMeta.objects.filter(pk=self.pk), "uploaded", uploaded))
+
+    def set_cached(self, cached: bool) -> bool:
+        """
+        :param cached:
+        :return: True if and only if the part's cached flag changed; see set_state
+        """
+        self.cached = cached
+        return bool(ArchivePartMeta.set_state(ArchivePartMeta.objects.filter(pk=self.pk), "cached", cached))
+
     def get_remote_key(self):
         """
         :return: a string that is the S3 file key for this archive part, if it were to exist on S3
@@ -128,6 +397,13 @@ class ArchivePartMeta(models.Model):
         part_index = self.part_index
         return f"{username}/{archive_id}/{part_index}"
 
+    def get_cache_path(self) -> str:
+        """
+        :return: the path to which this archive part is cached when it is downloaded:
+        MEDIA_ROOT/cache/username/archive_id/part_index
+        """
+        return os.path.join(MEDIA_ROOT, "cache", self.get_remote_key())
+
 
 class PersistentTransferJob(models.Model):
     """
@@ -137,11 +413,14 @@ class PersistentTransferJob(models.Model):
         -   file_part_index ranges from 0 to n, where n+1 is the number of file chunks
         -   start_byte_index, end_byte_index will be passed into .seek() and .read() to extract the file part from the
             file
-
+    A scheduled job is claimed by an s3portal worker by atomically setting its status to "running" and its worker_id
+    to the worker's id; if the worker does not complete it, the job goes back to "scheduled".
+    Completed jobs are moved into PersistentTransferJobHistory once they are older than the retention window, so that
+    the queue only holds the jobs that are, or were recently, in flight.
     """
 
     TRANSFER_TYPES = [("upload", "upload"), ("download", "download")]
-    JOB_STATUSES = [("scheduled", "scheduled"), ("completed", "completed")]
+    JOB_STATUSES = [("scheduled", "scheduled"), ("running", "running"), ("completed", "completed")]
 
     content_meta: ArchivePartMeta = models.ForeignKey(
         to=ArchivePartMeta, on_delete=models.CASCADE
@@ -153,6 +432,19 @@ class PersistentTransferJob(models.Model):
     date_created = models.DateTimeField(default=timezone.now, null=False)
     date_started = models.DateTimeField(null=True)
     date_completed = models.DateTimeField(null=True)
+    worker_id = models.CharField(max_length=256, null=True)
+
+    class Meta:
+        indexes = [
+            #   Polling and claiming the oldest scheduled jobs
+            models.Index(fields=['status', 'date_created']),
+            #   Checking whether a part already has a scheduled or running job
+            models.Index(fields=['content_meta', 'status']),
+            #   Releasing the jobs claimed by a worker
+            models.Index(fields=['status', 'worker_id']),
+            #   Finding the completed jobs to compact
+            models.Index(fields=['status', 'date_completed']),
+        ]
 
     def __str__(self):
         transfer_type = self.transfer_type
@@ -161,3 +453,478 @@ class PersistentTransferJob(models.Model):
         archive_id = self.content_meta.archive.archive_id
         part_index = self.content_meta.part_index
         return f"{transfer_type} {direction} {username}/{archive_id}/{part_index}"
+
+
+class PersistentTransferJobHistory(models.Model):
+    """
+    A completed PersistentTransferJob that has been compacted out of the queue. The part is identified by plain fields
+    rather than a foreign key, so that the history outlives the archive
+    """
+
+    archive_id = models.CharField(max_length=64, null=False)
+    username = models.CharField(max_length=150, null=False)
+    part_index = models.IntegerField(null=False)
+    transfer_type = models.CharField(max_length=10, null=False, choices=PersistentTransferJob.TRANSFER_TYPES)
+    worker_id = models.CharField(max_length=256, null=True)
+    date_created = models.DateTimeField(null=False)
+    date_started = models.DateTimeField(null=True)
+    date_completed = models.DateTimeField(null=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.transfer_type} {self.username}/{self.archive_id}/{self.part_index}"
+
+
+def pack_bits(flags: ty.Iterable[bool]) -> bytes:
+    """
+    :param flags:
+    :return: a bitmap holding flag i in bit (7 - i % 8) of byte i // 8
+    """
+    bitmap = bytearray()
+    for index, flag in enumerate(flags):
+        if index % 8 == 0:
+            bitmap.append(0)
+        if flag:
+            bitmap[-1] |= 0x80 >> (index % 8)
+    return bytes(bitmap)
+
+
+def get_bit(bitmap: bytes, index: int) -> bool:
+    return bool(bitmap[index >> 3] & (0x80 >> (index & 7)))
+
+
+class ArchivePartTable(models.Model):
+    """
+    A compact alternative to an archive's ArchivePartMeta rows, for archives with a great many parts. Instead of one
+    row per part, the archive has a single row:
+    -   part_size, archive_size:
+        every part but the last one is part_size bytes long, so the byte indices of part i are implicit
+    -   checksums:
+        the parts' MD5 digests, packed as 16 bytes per part
+    -   uploaded, cached:
+        bitmaps with one bit per part
+    -   connection_ids, placements:
+        the connections the parts are placed on, as a JSON list, and one byte per part indexing into that list
+    -   revision:
+        incremented on every change to the bitmaps, so that two processes updating the same table can't overwrite
+        each other's changes
+    -   next_part_to_verify, date_last_verified:
+        the part that scripts/scrub.py verifies next, and when it last verified some of the table's parts; the
+        scrub goes through the parts in order, a slice at a time, and starts over once it reaches the end
+    A packed archive has no ArchivePartMeta rows, so it can't have transfer jobs either; it is unpacked back into rows
+    whenever its parts need to be transferred. Parts are read through PartRef, which has the same attributes as
+    ArchivePartMeta, and updated with set_state, without creating a model instance per part.
+    """
+
+    DIGEST_SIZE = 16
+    NO_CONNECTION = 255
+
+    archive: Archive = models.OneToOneField(to=Archive, on_delete=models.CASCADE, primary_key=True)
+    part_size = models.IntegerField(null=False)
+    archive_size = models.BigIntegerField(null=False)
+    checksums = models.BinaryField(null=False)
+    uploaded = models.BinaryField(null=False)
+    cached = models.BinaryField(null=False)
+    connection_ids = models.TextField(null=False, default="[]")
+    placements = models.BinaryField(null=False)
+    revision = models.IntegerField(default=0, null=False)
+    next_part_to_verify = models.IntegerField(default=0, null=False)
+    date_last_verified = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"part table of {self.archive_id}"
+
+    def get_num_parts(self) -> int:
+        return len(self.checksums) // self.DIGEST_SIZE
+
+    def get_range(self, part_index: int) -> ty.Tuple[int, int]:
+        """
+        :param part_index:
+        :return: the start and end byte indices of the part
+        """
+        start_byte_index = part_index * self.part_size
+        return start_byte_index, min(self.archive_size, start_byte_index + self.part_size)
+
+    def get_checksum(self, part_index: int) -> str:
+        return bytes(self.checksums[part_index * self.DIGEST_SIZE:(part_index + 1) * self.DIGEST_SIZE]).hex()
+
+    @cached_property
+    def _connection_ids(self) -> ty.List[str]:
+        #   Parsed once per instance, since get_connection_id is called for every part
+        return json.loads(self.connection_ids)
+
+    def get_connection_ids(self) -> ty.List[str]:
+        return list(self._connection_ids)
+
+    def get_connection_id(self, part_index: int) -> ty.Optional[str]:
+        placement = self.placements[part_index]
+        return None if placement == self.NO_CONNECTION else self._connection_ids[placement]
+
+    def is_set(self, state: str, part_index: int) -> bool:
+        """
+        :param state: either "uploaded" or "cached"
+        :param part_index:
+        """
+        return get_bit(getattr(self, state), part_index)
+
+    def iter_part_indices(self, state: str, value: bool) -> ty.Iterator[int]:
+        """
+        :param state: either "uploaded" or "cached"
+        :param value:
+        :return: the indices of the parts whose state is value, skipping over whole bytes of parts that aren't
+        """
+        bitmap = bytes(getattr(self, state))
+        skipped_byte = 0x00 if value else 0xff
+        num_parts = self.get_num_parts()
+        for byte_index, byte in enumerate(bitmap):
+            if byte == skipped_byte:
+                continue
+            for part_index in range(byte_index * 8, min(num_parts, byte_index * 8 + 8)):
+                if get_bit(bitmap, part_index) == value:
+                    yield part_index
+
+    def iter_parts(self) -> ty.Iterator["PartRef"]:
+        for part_index in range(self.get_num_parts()):
+            yield PartRef(self, part_index)
+
+    def count_parts(self) -> ty.Dict[str, int]:
+        """
+        :return: the archive's counters, counted from the table
+        """
+        uploaded_part_indices = list(self.iter_part_indices("uploaded", True))
+        return {
+            'parts_total': self.get_num_parts(),
+            'parts_uploaded': len(uploaded_part_indices),
+            'parts_cached': bin(int.from_bytes(bytes(self.cached), 'big')).count('1'),
+            'bytes_uploaded': sum(end - start for start, end in map(self.get_range, uploaded_part_indices)),
+            'archive_size': self.archive_size,
+        }
+
+    def set_state(self, state: str, part_indices: ty.Iterable[int], value: bool) -> int:
+        """
+        :param state: either "uploaded" or "cached"
+        :param part_indices:
+        :param value:
+        :return: the number of parts whose state changed. Like ArchivePartMeta.set_state, the bitmap and the archive's
+        counters are updated in the same transaction; the bitmap is only written if nobody else changed the table
+        since it was read, and otherwise it is read again and the change is retried
+        """
+        part_indices = list(part_indices)
+        counter = STATE_COUNTERS[state]
+        sign = 1 if value else -1
+        while True:
+            bitmap = bytearray(getattr(self, state))
+            changed_part_indices = [part_index for part_index in part_indices
+                                    if get_bit(bitmap, part_index) != value]
+            if not changed_part_indices:
+                return 0
+            for part_index in changed_part_indices:
+                if value:
+                    bitmap[part_index >> 3] |= 0x80 >> (part_index & 7)
+                else:
+                    bitmap[part_index >> 3] &= ~(0x80 >> (part_index & 7)) & 0xff
+            with transaction.atomic():
+                updated = ArchivePartTable.objects.filter(pk=self.pk, revision=self.revision)\
+                    .update(**{state: bytes(bitmap), 'revision': models.F('revision') + 1})
+                if updated:
+                    counters = {counter: models.F(counter) + sign * len(changed_part_indices)}
+                    if state == "uploaded":
+                        num_bytes = sum(end - start for start, end in map(self.get_range, changed_part_indices))
+                        counters["bytes_uploaded"] = models.F("bytes_uploaded") + sign * num_bytes
+                    Archive.objects.filter(pk=self.archive_id).update(**counters)
+            if updated:
+                setattr(self, state, bytes(bitmap))
+                self.revision += 1
+                return len(changed_part_indices)
+            self.refresh_from_db(fields=['uploaded', 'cached', 'revision'])
+
+    @classmethod
+    def pack(cls, archive: Archive) -> "ArchivePartTable":
+        """
+        :param archive:
+        :return: the archive's part table, built from its ArchivePartMeta rows, which are deleted along with their
+        completed transfer jobs. Raises ValueError if the archive has no parts, if its parts aren't all part_size
+        bytes long (but the last one), or if any of them has a scheduled or running transfer job
+        """
+        with transaction.atomic():
+            parts = list(archive.archivepartmeta_set.order_by('part_index').values_list(
+                'part_index', 'start_byte_index', 'end_byte_index', 'part_checksum', 'uploaded', 'cached',
+                'connection_id'))
+            if not parts:
+                raise ValueError(f"Archive {archive.archive_id} has no parts")
+            archive_jobs = PersistentTransferJob.objects.filter(content_meta__archive=archive)
+            if archive_jobs.filter(status__in=['scheduled', 'running']).exists():
+                raise ValueError(f"Archive {archive.archive_id} has parts being transferred")
+            part_size, archive_size = parts[0][2] - parts[0][1], parts[-1][2]
+            connection_ids = sorted({part[6] for part in parts if part[6] is not None})
+            if len(connection_ids) >= cls.NO_CONNECTION:
+                raise ValueError(f"Archive {archive.archive_id} is placed on too many connections")
+            for part_index, start_byte_index, end_byte_index, part_checksum, *_ in parts:
+                expected_range = (part_index * part_size, min(archive_size, (part_index + 1) * part_size))
+                if (start_byte_index, end_byte_index) != expected_range or not part_checksum:
+                    raise ValueError(f"Archive {archive.archive_id}'s part {part_index} can't be packed")
+            part_table = cls.objects.create(
+                archive=archive,
+                part_size=part_size,
+                archive_size=archive_size,
+                checksums=b"".join(bytes.fromhex(part[3]) for part in parts),
+                uploaded=pack_bits(part[4] for part in parts),
+                cached=pack_bits(part[5] for part in parts),
+                connection_ids=json.dumps(connection_ids),
+                placements=bytes(cls.NO_CONNECTION if part[6] is None else connection_ids.index(part[6])
+                                 for part in parts),
+            )
+            archive_jobs.delete()
+            archive.archivepartmeta_set.all().delete()
+        return part_table
+
+    def unpack(self) -> int:
+        """
+        :return: the number of parts; turn the table back into ArchivePartMeta rows, and delete the table
+        """
+        with transaction.atomic():
+            archive_parts_meta = [ArchivePartMeta(archive_id=self.archive_id,
+                                                  part_index=part.part_index,
+                                                  start_byte_index=part.start_byte_index,
+                                                  end_byte_index=part.end_byte_index,
+                                                  part_checksum=part.part_checksum,
+                                                  uploaded=part.uploaded,
+                                                  cached=part.cached,
+                                                  connection_id=part.connection_id)
+                                  for part in self.iter_parts()]
+            ArchivePartMeta.objects.bulk_create(archive_parts_meta)
+            self.delete()
+        return len(archive_parts_meta)
+
+
+class PartRef:
+    """
+    One part of an ArchivePartTable, read on demand from the table, with the attributes and methods of ArchivePartMeta
+    that the transfer and sync code uses
+    """
+    __slots__ = ('part_table', 'part_index')
+
+    def __init__(self, part_table: ArchivePartTable, part_index: int):
+        self.part_table = part_table
+        self.part_index = part_index
+
+    def __str__(self):
+        return f"Archive {self.archive.archive_name}'s part {self.part_index}"
+
+    @property
+    def archive(self) -> Archive:
+        return self.part_table.archive
+
+    @property
+    def start_byte_index(self) -> int:
+        return self.part_table.get_range(self.part_index)[0]
+
+    @property
+    def end_byte_index(self) -> int:
+        return self.part_table.get_range(self.part_index)[1]
+
+    @property
+    def part_checksum(self) -> str:
+        return self.part_table.get_checksum(self.part_index)
+
+    @property
+    def uploaded(self) -> bool:
+        return self.part_table.is_set("uploaded", self.part_index)
+
+    @property
+    def cached(self) -> bool:
+        return self.part_table.is_set("cached", self.part_index)
+
+    @property
+    def connection_id(self) -> ty.Optional[str]:
+        return self.part_table.get_connection_id(self.part_index)
+
+    def get_size(self) -> int:
+        start_byte_index, end_byte_index = self.part_table.get_range(self.part_index)
+        return end_byte_index - start_byte_index
+
+    def get_remote_key(self) -> str:
+        return f"{self.archive.owner.username}/{self.part_table.archive_id}/{self.part_index}"
+
+    def set_uploaded(self, uploaded: bool) -> bool:
+        return bool(self.part_table.set_state("uploaded", [self.part_index], uploaded))
+
+    def set_cached(self, cached: bool) -> bool:
+        return bool(self.part_table.set_state("cached", [self.part_index], cached))
+
+
+class ArchiveChange(models.Model):
+    """
+    Journal of the changes made to archives and their parts, so that the sync scripts only need to look at the
+    archives that changed since they last ran, instead of at all of them. The auto-incremented id orders the changes;
+    each sync script remembers the last id it processed in SyncWatermark.
+    -   archive_id, username:
+        identify the archive and the remote prefix of its parts; they are not foreign keys so that the change of a
+        deleted archive outlives the archive
+    -   part_id:
+        the ArchivePartMeta that changed, if the change is about a single part
+    """
+
+    CHANGE_TYPES = [
+        ("create", "create"),
+        ("upload", "upload"),
+        ("download", "download"),
+        ("cache", "cache"),
+        ("uncache", "uncache"),
+        ("delete", "delete"),
+    ]
+
+    archive_id = models.CharField(max_length=64, null=False)
+    username = models.CharField(max_length=150, null=False)
+    part_id = models.IntegerField(null=True)
+    change_type = models.CharField(max_length=16, null=False, choices=CHANGE_TYPES)
+    date_created = models.DateTimeField(default=timezone.now, null=False)
+
+    def __str__(self):
+        return f"{self.change_type} {self.username}/{self.archive_id}"
+
+    @classmethod
+    def record(cls, archive: Archive, change_type: str, archive_part: ty.Optional[ArchivePartMeta] = None):
+        """
+        :param archive:
+        :param change_type: one of CHANGE_TYPES
+        :param archive_part: the part that changed, if the change is about a single part
+        :return: the ArchiveChange written to the journal
+        """
+        return cls.objects.create(archive_id=str(archive.archive_id),
+                                  username=archive.owner.username,
+                                  part_id=archive_part.pk if archive_part else None,
+                                  change_type=change_type)
+
+    @classmethod
+    def prune(cls):
+        """
+        :return: None; delete the changes that every sync script with a watermark has already processed. A sync script
+        that has not run yet does not hold the journal back, since its first run goes through every archive anyway
+        """
+        processed_change_id = SyncWatermark.objects.aggregate(processed=models.Min('last_change_id'))['processed']
+        if processed_change_id is not None:
+            cls.objects.filter(pk__lte=processed_change_id).delete()
+
+
+class CacheEvent(models.Model):
+    """
+    What happened to the local tier of archive files, from which it can be sized. A download served from the archive
+    file or its cached parts is a "hit", one that had to go to the buckets or could not be served is a "miss", and an
+    archive file uncached to keep MEDIA_ROOT within its budget is an "evict". The hits and misses of an archive are
+    counted in memory and written as a single row every so often (see archive.utils.CacheEventCounter)
+    -   archive_id, username:
+        identify the archive, as in ArchiveChange, so that the events of a deleted archive still count
+    -   num_events, num_bytes:
+        the number of events the row stands for, and the bytes they requested or, for evictions, freed
+    """
+
+    EVENT_TYPES = [
+        ("hit", "hit"),
+        ("miss", "miss"),
+        ("evict", "evict"),
+    ]
+
+    archive_id = models.CharField(max_length=64, null=False)
+    username = models.CharField(max_length=150, null=False)
+    event_type = models.CharField(max_length=16, null=False, choices=EVENT_TYPES)
+    num_events = models.IntegerField(default=1, null=False)
+    num_bytes = models.BigIntegerField(default=0, null=False)
+    date_created = models.DateTimeField(default=timezone.now, null=False, db_index=True)
+
+    def __str__(self):
+        return f"{self.event_type} {self.username}/{self.archive_id}"
+
+    @classmethod
+    def record(cls, archive: Archive, event_type: str, num_bytes: int):
+        """
+        :param archive:
+        :param event_type: one of EVENT_TYPES
+        :param num_bytes:
+        :return: the CacheEvent recorded
+        """
+        return cls.objects.create(archive_id=str(archive.archive_id),
+                                  username=archive.owner.username,
+                                  event_type=event_type,
+                                  num_bytes=num_bytes)
+
+    @classmethod
+    def get_stats(cls, since: ty.Optional[timezone.datetime] = None) -> ty.Dict[str, ty.Tuple[int, int]]:
+        """
+        :param since: only count the events recorded since then, or all of them if None
+        :return: the number of events and their bytes, by event type
+        """
+        events = cls.objects.all()
+        if since is not None:
+            events = events.filter(date_created__gte=since)
+        stats = {event_type: (0, 0) for event_type, _ in cls.EVENT_TYPES}
+        for row in events.values('event_type').annotate(count=models.Sum('num_events'), size=models.Sum('num_bytes')):
+            stats[row['event_type']] = (row['count'], row['size'] or 0)
+        return stats
+
+    @classmethod
+    def prune(cls, retention: int) -> int:
+        """
+        :param retention: the number of seconds for which events are kept
+        :return: the number of events deleted
+        """
+        deleted, _ = cls.objects.filter(date_created__lt=timezone.now() - timezone.timedelta(seconds=retention))\
+            .delete()
+        return deleted
+
+
+class SyncWatermark(models.Model):
+    """
+    How far each sync script has gone through the ArchiveChange journal
+    -   last_change_id:
+        the id of the last ArchiveChange that the sync script has processed
+    -   date_last_full_audit:
+        when the sync script last checked every archive regardless of the journal
+    """
+
+    SYNC_NAMES = ["sync_remote_to_db", "sync_archive_to_db"]
+
+    sync_name = models.CharField(max_length=64, primary_key=True)
+    last_change_id = models.IntegerField(default=0, null=False)
+    date_last_full_audit = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"{self.sync_name} at change {self.last_change_id}"
+
+    def is_full_audit_due(self, full_audit_interval: int) -> bool:
+        """
+        :param full_audit_interval: the number of seconds between two full audits
+        """
+        if self.date_last_full_audit is None:
+            return True
+        return (timezone.now() - self.date_last_full_audit).total_seconds() >= full_audit_interval
+
+    def get_changed_archives(self, last_change_id: int,
+                             change_types: ty.Optional[ty.Iterable[str]] = None) -> ty.Set[ty.Tuple[str, str]]:
+        """
+        :param last_change_id: the id of the last change to include; later changes are left for the next run
+        :param change_types: only consider these CHANGE_TYPES, or all of them if None
+        :return: the (username, archive_id) of every archive that changed since the watermark
+        """
+        changes = ArchiveChange.objects.filter(pk__gt=self.last_change_id, pk__lte=last_change_id)
+        if change_types is not None:
+            changes = changes.filter(change_type__in=list(change_types))
+        return set(changes.values_list('username', 'archive_id'))
+
+    def advance(self, last_change_id: int, full_audit: bool = False):
+        """
+        :param last_change_id: the id of the last change that was processed
+        :param full_audit: whether every archive was checked, regardless of the journal
+        :return: None; move the watermark and prune the changes that every sync script has processed
+        """
+        self.last_change_id = max(self.last_change_id, last_change_id)
+        if full_audit:
+            self.date_last_full_audit = timezone.now()
+        self.save()
+        ArchiveChange.prune()
+
+    @classmethod
+    def get_last_change_id(cls) -> int:
+        """
+        :return: the id of the latest change in the journal, or 0 if the journal is empty
+        """
+        return ArchiveChange.objects.aggregate(last_change_id=models.Max('pk'))['last_change_id'] or 0
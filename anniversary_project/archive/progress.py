@@ -0,0 +1,86 @@
+import time
+import threading
+import typing as ty
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from anniversary_project.settings import ARCHIVE_PROGRESS_UPDATES_PER_SECOND, ARCHIVE_PROGRESS_CHANNEL_LAYER
+from .models import Archive, COUNTER_AGGREGATES
+from .utils import DeferredFlush
+
+
+def get_progress_group(archive_id: str) -> str:
+    """
+    :param archive_id:
+    :return: the name of the channel layer group that the archive's progress is published to
+    """
+    return f"archive-progress-{archive_id}"
+
+
+class ProgressPublisher:
+    """
+    Publish the state transitions and the byte progress of archive parts to the archives' channel layer groups. The
+    updates of each archive are coalesced and published at most updates_per_second times per second, along with the
+    archive's counters, so that a transfer worker can report every chunk without flooding the channel layer. An update
+    that is not due yet is published by a timer once it is, so the last one is never held back. Thread-safe, since
+    the transfer jobs of different connections run in parallel threads
+    """
+
+    def __init__(self, updates_per_second: float):
+        self.interval = 1 / updates_per_second
+        self.lock = threading.Lock()
+        #   The parts' updates that are yet to be published, by archive_id and then by part_index
+        self.pending: ty.Dict[str, ty.Dict[int, dict]] = dict()
+        #   When each archive was last published, only kept while its interval has not passed yet
+        self.last_published: ty.Dict[str, float] = dict()
+        self.deferred_flush = DeferredFlush(self.flush)
+
+    def publish(self, archive_id: str, part_index: int, **update):
+        """
+        :param archive_id:
+        :param part_index:
+        :param update: the part's new "uploaded" or "cached" state, and/or its "transfer", as a dict of "type"
+        ("upload" or "download"), "done" and "total" bytes, or None once the transfer is over
+        :return: None; publish the update now if the archive's last update was long enough ago, and later otherwise
+        """
+        with self.lock:
+            self.pending.setdefault(archive_id, dict()).setdefault(part_index, {'part_index': part_index})\
+                .update(update)
+            delay = self.last_published.get(archive_id, 0) + self.interval - time.monotonic()
+        if delay > 0:
+            self.deferred_flush.schedule(delay, archive_id)
+        else:
+            self.flush(archive_id)
+
+    def flush(self, archive_id: str):
+        """
+        :param archive_id:
+        :return: None; publish the archive's pending updates along with its counters
+        """
+        with self.lock:
+            parts = self.pending.pop(archive_id, None)
+            now = time.monotonic()
+            #   An archive whose interval has passed is published right away, just as one that never was, so forget it
+            #   instead of keeping an entry for every archive ever published
+            self.last_published = {published_id: published for published_id, published in self.last_published.items()
+                                   if published + self.interval > now}
+            if parts:
+                self.last_published[archive_id] = now
+        channel_layer = get_channel_layer(ARCHIVE_PROGRESS_CHANNEL_LAYER)
+        if not (parts and channel_layer):
+            return
+        counters = Archive.objects.filter(pk=archive_id).values(*COUNTER_AGGREGATES).first() or dict()
+        try:
+            async_to_sync(channel_layer.group_send)(get_progress_group(archive_id), {
+                'type': 'archive.progress',
+                'archive_id': archive_id,
+                'parts': sorted(parts.values(), key=lambda part: part['part_index']),
+                **counters,
+            })
+        except Exception as e:
+            #   Progress is only informative; never let it fail a transfer
+            print(f"Failed to publish the progress of archive {archive_id}: {e}")
+
+
+progress_publisher = ProgressPublisher(ARCHIVE_PROGRESS_UPDATES_PER_SECOND)
@@ -0,0 +1,41 @@
+from django.urls import re_path, resolve, Resolver404
+from channels.http import AsgiHandler
+
+from .consumers import AsyncStreamingHandler, ArchiveProgressConsumer
+
+#   The views whose responses take long to send, by URL name; Django still resolves the URL and runs the view and its
+#   middleware
+STREAMING_URL_NAMES = {'archive-download', 'archive-parts'}
+
+
+class StreamingViewRouter:
+    """
+    Route the HTTP requests for the views named in url_names to streaming_application, and every other request to
+    application. The path is resolved with the project's own URLconf, so the routing follows archive/urls.py instead
+    of repeating its patterns
+    """
+
+    def __init__(self, url_names, streaming_application, application):
+        self.url_names = set(url_names)
+        self.streaming_application = streaming_application
+        self.application = application
+
+    def __call__(self, scope):
+        path = scope['path']
+        root_path = scope.get('root_path', '')
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        try:
+            url_name = resolve(path).url_name
+        except Resolver404:
+            url_name = None
+        if url_name in self.url_names:
+            return self.streaming_application(scope)
+        return self.application(scope)
+
+
+http_application = StreamingViewRouter(STREAMING_URL_NAMES, AsyncStreamingHandler, AsgiHandler)
+
+websocket_urlpatterns = [
+    re_path(r'ws/archive/(?P<pk>[^/]+)/progress/$', ArchiveProgressConsumer),
+]
@@ -0,0 +1,39 @@
+import typing as ty
+
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from anniversary_project.settings import SQLITE_PRAGMAS
+from .models import Archive, ArchiveChange
+from .utils import invalidate_home_cache
+
+
+def apply_sqlite_pragmas(cursor, pragmas: ty.Dict[str, ty.Union[str, int]]):
+    """
+    :param cursor: a cursor of an SQLite connection
+    :param pragmas: the PRAGMAs to run, by name
+    :return: None; busy_timeout is set first, since changing the journal mode has to wait for the other connections
+    """
+    for name, value in sorted(pragmas.items(), key=lambda pragma: pragma[0] != 'busy_timeout'):
+        cursor.execute(f"PRAGMA {name} = {value}")
+
+
+@receiver(connection_created)
+def tune_sqlite_connection(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            apply_sqlite_pragmas(cursor, SQLITE_PRAGMAS)
+
+
+@receiver(post_save, sender=Archive)
+def invalidate_home_cache_on_archive_change(sender, instance: Archive, **kwargs):
+    invalidate_home_cache(instance.owner.username)
+
+
+@receiver(post_save, sender=ArchiveChange)
+def invalidate_home_cache_on_journal_change(sender, instance: ArchiveChange, created: bool, **kwargs):
+    #   Uploads and downloads only update the counters in the database, and Archive.delete doesn't save, but each of
+    #   them is journaled
+    if created:
+        invalidate_home_cache(instance.username)
@@ -6,5 +6,7 @@ urlpatterns = [
     path('archive/new/', views.create, name='archive-create'),
     path('archive/<pk>/update/', views.ArchiveUpdateView.as_view(), name='archive-update'),
     path('archive/<pk>/delete/', views.ArchiveDeleteView.as_view(), name='archive-delete'),
+    path('archive/<pk>/download/', views.archive_download, name='archive-download'),
+    path('archive/<pk>/parts/', views.archive_parts, name='archive-parts'),
     path('archive/<pk>/', views.ArchiveDetailView.as_view(), name='archive-detail'),
 ]
\ No newline at end of file
@@ -1,15 +1,109 @@
 import os
+import re
+import errno
+import uuid
+import hashlib
+import threading
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor
 
-from .models import Archive, ArchivePartMeta, PersistentTransferJob
-from anniversary_project.settings import MEDIA_ROOT
+from botocore.errorfactory import ClientError
+from botocore.exceptions import BotoCoreError
+from django.core.cache import cache
+from django import db
+from django.db import transaction
+from django.utils import timezone
+
+from s3connections.models import S3Connection
+from s3connections.utils import get_placement
+from .models import Archive, ArchiveChange, ArchivePartMeta, CacheEvent, PersistentTransferJob, PART_SIZE, \
+    get_file_fingerprint
+from anniversary_project.settings import MEDIA_ROOT, CACHE_EVENT_FLUSH_INTERVAL
+
+#   Archive files are split into parts of at most ARCHIVE_PART_SIZE bytes when they are ingested
+ARCHIVE_PART_SIZE = 5 * (2 ** 20)
+COPY_METHODS = ('copy_file_range', 'sendfile', 'buffered')
+COPY_BUFFER_SIZE = 2 ** 20
+#   copy_file_range and sendfile refuse some pairs of files (e.g. across file systems); fall back to the next method
+_KERNEL_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+#   The cached pages of a user's archive listing are keyed by a per-user version, which changes whenever one of the
+#   user's archives changes, so that every page is invalidated at once
+HOME_CACHE_VERSION_KEY = "archive-home-version:{username}"
+HOME_CACHE_PAGE_KEY = "archive-home:{username}:{version}:{after}"
+#   A Range header asking for more than MAX_BYTE_RANGES ranges is ignored, and the whole archive is sent instead
+MAX_BYTE_RANGES = 64
+_BYTE_RANGE_PATTERN = re.compile(r"^(\d*)-(\d*)$")
+
+
+def ingest_archive(archive: Archive, part_size: int = ARCHIVE_PART_SIZE, buffer_size: int = COPY_BUFFER_SIZE) -> bool:
+    """
+    :param archive: an archive that is processing, whose file was just stored
+    :param part_size: the maximal number of bytes for each archive's part
+    :param buffer_size:
+    :return: True if this call ingested the archive, False if its file is gone or another ingest got there first.
+    The file and each of its parts are hashed in a single pass; then, in one transaction, the archive stops
+    processing, and its parts are created, placed on S3 connections, and queued for upload
+    """
+    archive_file_path = os.path.join(MEDIA_ROOT, archive.archive_file.name)
+    if not os.path.isfile(archive_file_path):
+        return False
+    fingerprint = get_file_fingerprint(archive_file_path, include_ctime=True)
+    archive_file_size = os.path.getsize(archive_file_path)
+    file_hash = hashlib.md5()
+    part_checksums = list()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(archive_file_path, 'rb', buffering=0) as f:
+        for start_byte_index in range(0, archive_file_size, part_size):
+            part_hash = hashlib.md5()
+            remains = min(part_size, archive_file_size - start_byte_index)
+            while remains:
+                count = f.readinto(view[:min(buffer_size, remains)])
+                if not count:
+                    raise IOError(f"{archive_file_path} is shorter than expected")
+                file_hash.update(view[:count])
+                part_hash.update(view[:count])
+                remains -= count
+            part_checksums.append(part_hash.hexdigest())
+    checksum = file_hash.hexdigest()
+
+    placement = get_placement()
+    archive_parts = [ArchivePartMeta(archive=archive,
+                                     part_index=part_index,
+                                     start_byte_index=part_index * part_size,
+                                     end_byte_index=min(archive_file_size, (part_index + 1) * part_size),
+                                     part_checksum=part_checksum,
+                                     uploaded=False,
+                                     cached=False,
+                                     connection=next(placement))
+                     for part_index, part_checksum in enumerate(part_checksums)]
+    with transaction.atomic():
+        #   Only one ingest can take the archive out of processing
+        if not Archive.objects.filter(pk=archive.pk, processing=True).update(
+                processing=False, archive_file_checksum=checksum, parts_total=len(archive_parts),
+                archive_size=archive_file_size, date_last_accessed=timezone.now()):
+            return False
+        ArchivePartMeta.objects.bulk_create(archive_parts)
+        #   bulk_create doesn't set the primary keys on every database, so the parts are read back for their jobs
+        PersistentTransferJob.objects.bulk_create([
+            PersistentTransferJob(content_meta=archive_part, transfer_type="upload", status="scheduled")
+            for archive_part in archive.archivepartmeta_set.order_by('part_index')
+        ])
+    archive.refresh_from_db()
+    archive.set_local_checksum(checksum, fingerprint)
+    ArchiveChange.record(archive, "create")
+    return True
 
 
 def queue_archive_caching(archive: Archive):
     """
     :param archive: an archive object
     :return: None. However, create download job for each of the ArchiveMetaPart instance of archive instance and save
-    them
+    them. A packed archive is unpacked first, since transfer jobs need ArchivePartMeta rows
     """
+    part_table = archive.get_part_table()
+    if part_table:
+        part_table.unpack()
     archive_parts = ArchivePartMeta.objects.filter(archive=archive)
     for archive_part in archive_parts:
         download_job = PersistentTransferJob(
@@ -18,16 +112,54 @@ def queue_archive_caching(archive: Archive):
         download_job.save()
 
 
+def iter_part_states(archive: Archive, start: int = 0,
+                     stop: ty.Optional[int] = None) -> ty.Iterator[ty.Tuple[int, int, str, bool, bool]]:
+    """
+    :param archive:
+    :param start: the index of the first part
+    :param stop: the index after the last part, or None for all of the remaining parts
+    :return: (part_index, size, part_checksum, uploaded, cached) for each of the archive's parts in that range, in
+    order, read from its ArchivePartMeta rows or its packed part table without creating a model instance per part
+    """
+    part_table = archive.get_part_table()
+    if part_table:
+        stop = part_table.get_num_parts() if stop is None else min(stop, part_table.get_num_parts())
+        for part_index in range(start, stop):
+            start_byte_index, end_byte_index = part_table.get_range(part_index)
+            yield (part_index, end_byte_index - start_byte_index, part_table.get_checksum(part_index),
+                   part_table.is_set("uploaded", part_index), part_table.is_set("cached", part_index))
+        return
+    archive_parts_meta = ArchivePartMeta.objects.filter(archive=archive, part_index__gte=start)
+    if stop is not None:
+        archive_parts_meta = archive_parts_meta.filter(part_index__lt=stop)
+    yield from archive_parts_meta.order_by('part_index').annotate(size=PART_SIZE)\
+        .values_list('part_index', 'size', 'part_checksum', 'uploaded', 'cached').iterator()
+
+
+def collapse_part_states(part_states: ty.Iterable[ty.Tuple[int, int, str, bool, bool]]) -> ty.List[dict]:
+    """
+    :param part_states: as returned by iter_part_states
+    :return: the runs of consecutive parts in the same state, like "parts 0 to 9999 are uploaded and not cached", each
+    with the first and last part index, the number of bytes, and the state
+    """
+    part_ranges = list()
+    for part_index, size, _, uploaded, cached in part_states:
+        if part_ranges and (part_ranges[-1]['uploaded'], part_ranges[-1]['cached']) == (uploaded, cached):
+            part_ranges[-1]['last'] = part_index
+            part_ranges[-1]['size'] += size
+        else:
+            part_ranges.append({'first': part_index, 'last': part_index, 'size': size,
+                                'uploaded': uploaded, 'cached': cached})
+    return part_ranges
+
+
 def can_uncache(archive) -> bool:
     """
     :param archive:
-    :return: return True if and only if all instances of ArchivePartMeta of this archive is uploaded
+    :return: return True if and only if all instances of ArchivePartMeta of this archive is uploaded, according to the
+    archive's counters
     """
-    archive_parts = ArchivePartMeta.objects.filter(archive=archive)
-    for archive_part_meta in archive_parts:
-        if not archive_part_meta.uploaded:
-            return False
-    return True
+    return archive.is_fully_uploaded()
 
 
 def uncache(archive):
@@ -38,3 +170,350 @@ def uncache(archive):
     archive.archive_file.storage.delete(archive.archive_file.name)
     archive.cached = False
     archive.save()
+    archive.set_local_checksum(None)
+    ArchiveChange.record(archive, "uncache")
+
+
+def append_file(dst_file, src_path: str, methods: ty.Iterable[str] = COPY_METHODS,
+                buffer_size: int = COPY_BUFFER_SIZE) -> int:
+    """
+    :param dst_file: an unbuffered binary file object, opened with open(path, 'wb', buffering=0); it cannot be opened
+    in append mode, which copy_file_range does not support
+    :param src_path: the path to the file to append to dst_file
+    :param methods: the copying methods to try, in order, among COPY_METHODS. copy_file_range and sendfile keep the
+    bytes in the kernel; if one of them is unavailable or refuses the pair of files, then the next one picks up where
+    it stopped. 'buffered' copies through a single buffer of buffer_size bytes, so memory stays bounded either way
+    :param buffer_size:
+    :return: the number of bytes appended
+    """
+    dst_fd = dst_file.fileno()
+    with open(src_path, 'rb', buffering=0) as src:
+        src_fd = src.fileno()
+        size = os.fstat(src_fd).st_size
+        copied = 0
+        for method in methods:
+            if copied >= size:
+                break
+            try:
+                if method == 'copy_file_range' and hasattr(os, 'copy_file_range'):
+                    #   Without offsets, copy_file_range advances the positions of both files
+                    os.lseek(src_fd, copied, os.SEEK_SET)
+                    while copied < size:
+                        count = os.copy_file_range(src_fd, dst_fd, size - copied)
+                        if count == 0:
+                            break
+                        copied += count
+                elif method == 'sendfile' and hasattr(os, 'sendfile'):
+                    while copied < size:
+                        count = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                        if count == 0:
+                            break
+                        copied += count
+                elif method == 'buffered':
+                    src.seek(copied)
+                    buffer = bytearray(buffer_size)
+                    view = memoryview(buffer)
+                    count = src.readinto(buffer)
+                    while count:
+                        written = 0
+                        while written < count:
+                            written += dst_file.write(view[written:count])
+                        copied += count
+                        count = src.readinto(buffer)
+            except OSError as oe:
+                if oe.errno not in _KERNEL_COPY_FALLBACK_ERRNOS or method == 'buffered':
+                    raise
+    return copied
+
+
+def append_file_with_digests(dst_file, src_path: str, digests: ty.Iterable, buffer_size: int = COPY_BUFFER_SIZE) -> int:
+    """
+    :param dst_file: a binary file object opened for writing
+    :param src_path: the path to the file to append to dst_file
+    :param digests: hash objects (e.g. hashlib.md5()) that every byte of the file is fed into as it is copied
+    :param buffer_size:
+    :return: the number of bytes appended. The file is read once, through a single buffer of buffer_size bytes
+    """
+    digests = list(digests)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    copied = 0
+    with open(src_path, 'rb', buffering=0) as src:
+        count = src.readinto(buffer)
+        while count:
+            chunk = view[:count]
+            for digest in digests:
+                digest.update(chunk)
+            written = 0
+            while written < count:
+                written += dst_file.write(chunk[written:])
+            copied += count
+            count = src.readinto(buffer)
+    return copied
+
+
+def get_home_cache_key(username: str, after: ty.Optional[str]) -> str:
+    """
+    :param username:
+    :param after: the archive_id after which the page starts, or None for the first page
+    :return: the cache key of the page of the user's archive listing
+    """
+    version = cache.get_or_set(HOME_CACHE_VERSION_KEY.format(username=username), lambda: uuid.uuid4().hex, None)
+    return HOME_CACHE_PAGE_KEY.format(username=username, version=version, after=after or '')
+
+
+def invalidate_home_cache(username: str):
+    """
+    :param username:
+    :return: None; invalidate every cached page of the user's archive listing
+    """
+    cache.set(HOME_CACHE_VERSION_KEY.format(username=username), uuid.uuid4().hex, None)
+
+
+def parse_range_header(range_header: ty.Optional[str], size: int) -> ty.Optional[ty.List[ty.Tuple[int, int]]]:
+    """
+    :param range_header: the value of the request's Range header, like "bytes=0-499,1000-,-500"
+    :param size: the size of the file in bytes
+    :return: None if the whole file should be sent, because there is no Range header, or one that is malformed, isn't
+    in bytes, or asks for more than MAX_BYTE_RANGES ranges. Otherwise, the satisfiable ranges as (first, last) byte
+    indices, both inclusive, sorted and with overlapping or adjacent ranges merged; an empty list means that none of
+    the ranges can be satisfied
+    """
+    if not range_header:
+        return None
+    unit, _, range_specs = range_header.partition('=')
+    range_specs = [range_spec.strip() for range_spec in range_specs.split(',')]
+    if unit.strip().lower() != 'bytes' or len(range_specs) > MAX_BYTE_RANGES:
+        return None
+    byte_ranges = list()
+    for range_spec in range_specs:
+        match = _BYTE_RANGE_PATTERN.match(range_spec)
+        if not match or match.groups() == ('', ''):
+            return None
+        first_spec, last_spec = match.groups()
+        if not first_spec:
+            #   "-N" is the last N bytes
+            first, last = max(0, size - int(last_spec)), size - 1
+        else:
+            first = int(first_spec)
+            if last_spec and int(last_spec) < first:
+                return None
+            last = min(int(last_spec), size - 1) if last_spec else size - 1
+        if first <= last:
+            byte_ranges.append((first, last))
+
+    merged_ranges = list()
+    for first, last in sorted(byte_ranges):
+        if merged_ranges and first <= merged_ranges[-1][1] + 1:
+            merged_ranges[-1] = (merged_ranges[-1][0], max(last, merged_ranges[-1][1]))
+        else:
+            merged_ranges.append((first, last))
+    return merged_ranges
+
+
+def get_archive_byte_sources(archive: Archive, first: int, last: int) -> ty.Optional[ty.List[ty.Tuple[str, int, int]]]:
+    """
+    :param archive:
+    :param first: the index of the first byte, inclusive
+    :param last: the index of the last byte, inclusive
+    :return: the local files that hold the bytes, in order, as (path, offset in the file, number of bytes). The bytes
+    are read from the archive file if it is cached, and otherwise from the cached parts that overlap them; None if
+    some of the bytes are not cached at all
+    """
+    archive_file_path = os.path.join(MEDIA_ROOT, archive.archive_file.name)
+    if os.path.isfile(archive_file_path):
+        return [(archive_file_path, first, last - first + 1)]
+    archive_parts = ArchivePartMeta.objects.filter(archive=archive, cached=True, start_byte_index__lte=last,
+                                                   end_byte_index__gt=first).select_related('archive__owner')
+    byte_sources = list()
+    next_byte = first
+    for archive_part in archive_parts.order_by('start_byte_index'):
+        part_path = archive_part.get_cache_path()
+        if archive_part.start_byte_index > next_byte or not os.path.isfile(part_path):
+            return None
+        end = min(last + 1, archive_part.end_byte_index)
+        byte_sources.append((part_path, next_byte - archive_part.start_byte_index, end - next_byte))
+        next_byte = end
+    return byte_sources if next_byte > last else None
+
+
+def iter_byte_sources(byte_sources: ty.Iterable[ty.Tuple[str, int, int]],
+                      block_size: int = COPY_BUFFER_SIZE) -> ty.Iterator[bytes]:
+    """
+    :param byte_sources: (path, offset in the file, number of bytes), as returned by get_archive_byte_sources
+    :param block_size:
+    :return: the bytes, block_size of them at a time; only the requested bytes of each file are read
+    """
+    for path, offset, length in byte_sources:
+        with open(path, 'rb', buffering=0) as f:
+            f.seek(offset)
+            while length > 0:
+                block = f.read(min(block_size, length))
+                if not block:
+                    raise IOError(f"{path} is shorter than expected")
+                length -= len(block)
+                yield block
+
+
+def get_remote_part_sources(archive: Archive) -> ty.Optional[ty.List[ty.Tuple[S3Connection, str, str, int]]]:
+    """
+    :param archive:
+    :return: every part of the archive, in order, as (connection, remote key, part_checksum, size), or None if some
+    part is not uploaded or its connection is gone. Parts that have not been placed are on the active connection
+    """
+    if archive.processing:
+        return None
+    part_table = archive.get_part_table()
+    if part_table:
+        archive_parts = list(part_table.iter_parts())
+    else:
+        archive_parts = list(archive.archivepartmeta_set.select_related('archive__owner').order_by('part_index'))
+    conns = S3Connection.objects.in_bulk({archive_part.connection_id for archive_part in archive_parts} - {None})
+    active_conn = S3Connection.objects.filter(is_active=True).first()
+
+    part_sources = list()
+    for archive_part in archive_parts:
+        conn = conns.get(archive_part.connection_id) if archive_part.connection_id else active_conn
+        if not (archive_part.uploaded and conn):
+            return None
+        part_sources.append((conn, archive_part.get_remote_key(), archive_part.part_checksum,
+                             archive_part.get_size()))
+    return part_sources
+
+
+def fetch_remote_part(s3, conn: S3Connection, key: str, part_checksum: str, size: int,
+                      chunk_size: int = COPY_BUFFER_SIZE) -> bytes:
+    """
+    :param s3: an S3 client of conn
+    :param conn:
+    :param key:
+    :param part_checksum:
+    :param size:
+    :param chunk_size:
+    :return: the remote part, hashed as it is read; IOError is raised if it can't be read or fails checksum matching
+    """
+    part_hash = hashlib.md5()
+    part = bytearray()
+    try:
+        body = s3.get_object(Bucket=conn.connection_id, Key=key)['Body']
+        chunk = body.read(chunk_size)
+        while chunk:
+            part_hash.update(chunk)
+            part += chunk
+            chunk = body.read(chunk_size)
+    except (ClientError, BotoCoreError) as e:
+        raise IOError(f"Failed to read s3://{conn.connection_id}/{key}: {e}")
+    if len(part) != size or part_hash.hexdigest() != part_checksum:
+        raise IOError(f"s3://{conn.connection_id}/{key} fails checksum matching")
+    return bytes(part)
+
+
+def iter_remote_parts(part_sources: ty.List[ty.Tuple[S3Connection, str, str, int]],
+                      read_ahead: int) -> ty.Iterator[bytes]:
+    """
+    :param part_sources: (connection, remote key, part_checksum, size), as returned by get_remote_part_sources
+    :param read_ahead: the number of parts fetched at the same time, ahead of the one being sent
+    :return: the parts, in order, each of which is verified against its checksum before it is handed out. At most
+    read_ahead parts are held in memory, nothing is written to disk, and the parts that haven't been fetched yet are
+    cancelled if the iteration stops early (e.g. the client went away)
+    """
+    clients = dict()
+    for conn, _, _, _ in part_sources:
+        if conn.connection_id not in clients:
+            clients[conn.connection_id] = conn.get_client('s3')
+    executor = ThreadPoolExecutor(max_workers=read_ahead)
+    pending = list()
+    try:
+        for conn, key, part_checksum, size in part_sources:
+            pending.append(executor.submit(fetch_remote_part, clients[conn.connection_id], conn, key, part_checksum,
+                                           size))
+            if len(pending) >= read_ahead:
+                yield pending.pop(0).result()
+        while pending:
+            yield pending.pop(0).result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+class DeferredFlush:
+    """
+    Call function(*key) once delay seconds have passed since the first time the key was scheduled, on a timer thread,
+    and then forget the key, so that the updates that are not due yet are flushed once they are. Scheduling a key that
+    is already due to be flushed does nothing. Thread-safe
+    """
+
+    def __init__(self, function: ty.Callable[..., ty.Any]):
+        self.function = function
+        self.lock = threading.Lock()
+        self.timers: ty.Dict[tuple, threading.Timer] = dict()
+
+    def schedule(self, delay: float, *key):
+        """
+        :param delay: in seconds
+        :param key: the arguments to call function with
+        :return: None; call function(*key) in delay seconds, unless it already is due to be called
+        """
+        with self.lock:
+            if key in self.timers:
+                return
+            timer = threading.Timer(delay, self._flush, args=key)
+            timer.daemon = True
+            self.timers[key] = timer
+            timer.start()
+
+    def _flush(self, *key):
+        with self.lock:
+            self.timers.pop(key, None)
+        try:
+            self.function(*key)
+        finally:
+            #   The timer's thread gets its own database connection; close it instead of leaking it
+            db.connection.close()
+
+
+class CacheEventCounter:
+    """
+    Count the cache hits and misses of each archive in memory, and write them as one CacheEvent per archive and event
+    type once every interval seconds, so that the thousands of Range requests of a download manager cost a single
+    insert instead of one each. The counts are written by a timer started by the first event of each interval; the
+    counts of the last interval are lost if the process exits before then. Thread-safe, since the views run in
+    parallel threads
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lock = threading.Lock()
+        #   The counts yet to be written, as [num_events, num_bytes], by (archive_id, username, event_type)
+        self.pending: ty.Dict[ty.Tuple[str, str, str], ty.List[int]] = dict()
+        self.deferred_flush = DeferredFlush(self.flush)
+
+    def count(self, archive: Archive, event_type: str, num_bytes: int):
+        """
+        :param archive:
+        :param event_type: "hit" or "miss"
+        :param num_bytes:
+        :return: None; count the event, to be written by the end of the interval
+        """
+        with self.lock:
+            counts = self.pending.setdefault((str(archive.archive_id), archive.owner.username, event_type), [0, 0])
+            counts[0] += 1
+            counts[1] += num_bytes
+        self.deferred_flush.schedule(self.interval)
+
+    def flush(self) -> int:
+        """
+        :return: the number of CacheEvents written; write the pending counts
+        """
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+        CacheEvent.objects.bulk_create([
+            CacheEvent(archive_id=archive_id, username=username, event_type=event_type, num_events=num_events,
+                       num_bytes=num_bytes)
+            for (archive_id, username, event_type), (num_events, num_bytes) in pending.items()
+        ])
+        return len(pending)
+
+
+cache_event_counter = CacheEventCounter(CACHE_EVENT_FLUSH_INTERVAL)
@@ -1,27 +1,78 @@
 import os
+import uuid
+import mimetypes
+import typing as ty
+from urllib.parse import quote
 
-from django.shortcuts import render, redirect
+from django.db.models import Q, F, Case, When, Value, IntegerField
+from django.core.cache import cache
+from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
-from django.http import HttpResponse, HttpRequest
+from django.http import HttpResponse, HttpRequest, JsonResponse, FileResponse, StreamingHttpResponse, Http404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.views.generic import DetailView, CreateView, UpdateView, DeleteView
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 
-from .models import Archive, ArchivePartMeta
+from anniversary_project.settings import MEDIA_ROOT, ARCHIVE_HOME_CACHE_TIMEOUT, ARCHIVE_SENDFILE_HEADER, \
+    ARCHIVE_SENDFILE_URL_PREFIX, ARCHIVE_DOWNLOAD_BLOCK_SIZE, ARCHIVE_STREAM_READ_AHEAD, ARCHIVE_ACCESS_RESOLUTION, \
+    ARCHIVE_PROGRESS_CHANNEL_LAYER, CHANNEL_LAYERS
+from .models import Archive
 from .forms import ArchiveForm
-from .utils import queue_archive_caching, can_uncache, uncache
+from .utils import queue_archive_caching, can_uncache, uncache, iter_part_states, collapse_part_states, \
+    get_home_cache_key, parse_range_header, get_archive_byte_sources, iter_byte_sources, get_remote_part_sources, \
+    iter_remote_parts, cache_event_counter
+
+#   The home page lists HOME_PAGE_SIZE archives at a time
+HOME_PAGE_SIZE = 20
+
+#   The detail page shows at most MAX_PART_RANGES runs of parts in the same state; the parts themselves are fetched
+#   from archive_parts, PARTS_PAGE_SIZE at a time by default and at most MAX_PARTS_PAGE_SIZE at a time
+MAX_PART_RANGES = 100
+PARTS_PAGE_SIZE = 200
+MAX_PARTS_PAGE_SIZE = 1000
+
+
+def get_archive_page(owner, after: ty.Optional[Archive]) -> ty.Tuple[ty.List[Archive], ty.Optional[str]]:
+    """
+    :param owner: the user whose archives are listed
+    :param after: the last archive of the previous page, or None for the first page
+    :return: at most HOME_PAGE_SIZE of the user's archives, newest first, and the archive_id that the next page starts
+    after, or None if this is the last page. The pages are keyed on (date_created, archive_id) instead of offsets, so
+    every page is a range scan of the (owner, date_created, archive_id) index. Each archive is annotated with its upload
+    progress in the same query, from its counters, so the cost of a page doesn't grow with the number of parts
+    """
+    archives = Archive.objects.filter(owner=owner).annotate(
+        upload_progress=Case(When(parts_total=0, then=Value(0)), default=F('parts_uploaded') * 100 / F('parts_total'),
+                             output_field=IntegerField()),
+    ).order_by('-date_created', '-archive_id')
+    if after:
+        archives = archives.filter(Q(date_created__lt=after.date_created) |
+                                   Q(date_created=after.date_created, archive_id__lt=after.archive_id))
+    archives = list(archives[:HOME_PAGE_SIZE + 1])
+    next_after = archives[HOME_PAGE_SIZE - 1].archive_id if len(archives) > HOME_PAGE_SIZE else None
+    return archives[:HOME_PAGE_SIZE], next_after
 
 
 @login_required
 def home(request: HttpRequest) -> HttpResponse:
     cur_user = request.user
-    user_archives = Archive.objects.filter(owner=cur_user).order_by('-date_created')
+    after_id = request.GET.get('after')
+    #   Each page is cached until one of the user's archives changes (see archive/signals.py)
+    cache_key = get_home_cache_key(cur_user.username, after_id)
+    page = cache.get(cache_key)
+    if page is None:
+        after = get_object_or_404(Archive, pk=after_id, owner=cur_user) if after_id else None
+        page = get_archive_page(cur_user, after)
+        cache.set(cache_key, page, ARCHIVE_HOME_CACHE_TIMEOUT)
+    user_archives, next_after = page
 
     return render(request,
                   'archive/home.html',
                   context={'title': 'Home',
-                           'archives': user_archives})
+                           'archives': user_archives,
+                           'is_first_page': not after_id,
+                           'next_after': next_after})
 
 
 @login_required
@@ -33,6 +84,7 @@ def create(request: HttpRequest) -> HttpResponse:
         form.instance.owner = cur_user
         if form.is_valid():
             form.save()
+            messages.success(request, 'Archive stored; it will be backed up once it has been processed')
             return redirect(reverse('archive-detail', kwargs={'pk': form.instance.archive_id}))
     else:
         form = ArchiveForm()
@@ -45,17 +97,36 @@ def create(request: HttpRequest) -> HttpResponse:
 class ArchiveDetailView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
     model = Archive
 
+    def get_queryset(self):
+        return Archive.objects.select_related('owner')
+
+    def get_object(self, queryset=None):
+        """
+        :param queryset:
+        :return: the archive, fetched once per request and then reused by test_func, get_context_data, and post
+        """
+        if getattr(self, 'object', None) is None:
+            self.object = super().get_object(queryset)
+        return self.object
+
     def get_context_data(self, **kwargs):
         """
         :param kwargs:
-        :return: Overwrite this method to provide additional context variables to the archive_detail.html template
+        :return: Overwrite this method to provide additional context variables to the archive_detail.html template.
+        Instead of a row per part, the parts are summarized as runs of parts in the same state; the parts themselves
+        are fetched by the page from archive_parts. The page only listens to the archive's progress if the progress
+        channel layer is configured
         """
         # Call the base implementation first to get a context
         archive = self.get_object()
         context = super().get_context_data(**kwargs)
 
-        context['parts'] = ArchivePartMeta.objects.filter(archive=self.get_object())
+        part_ranges = collapse_part_states(iter_part_states(archive))
+        context['part_ranges'] = part_ranges[:MAX_PART_RANGES]
+        context['num_hidden_part_ranges'] = max(0, len(part_ranges) - MAX_PART_RANGES)
+        context['parts_page_size'] = PARTS_PAGE_SIZE
         context['can_uncache'] = can_uncache(archive)
+        context['live_progress'] = ARCHIVE_PROGRESS_CHANNEL_LAYER in CHANNEL_LAYERS
         return context
 
     def test_func(self):
@@ -92,6 +163,30 @@ class ArchiveDetailView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
             return redirect(reverse('archive-detail', kwargs={'pk': archive.archive_id}))
 
 
+@login_required
+def archive_parts(request: HttpRequest, pk: str) -> JsonResponse:
+    """
+    :param request: may have the "start" and "limit" query parameters
+    :param pk: the archive_id
+    :return: at most "limit" of the archive's parts, from part index "start" on, as JSON, along with the "start" of the
+    next page, or null if this is the last page
+    """
+    archive = get_object_or_404(Archive.objects.select_related('owner'), pk=pk, owner=request.user)
+    try:
+        start = max(0, int(request.GET.get('start', 0)))
+        limit = min(MAX_PARTS_PAGE_SIZE, max(1, int(request.GET.get('limit', PARTS_PAGE_SIZE))))
+    except ValueError:
+        return JsonResponse({'error': '"start" and "limit" must be integers'}, status=400)
+    parts = [{'part_index': part_index, 'size': size, 'checksum': part_checksum, 'uploaded': uploaded,
+              'cached': cached}
+             for part_index, size, part_checksum, uploaded, cached in iter_part_states(archive, start, start + limit)]
+    return JsonResponse({'archive_id': archive.archive_id,
+                         'parts_total': archive.parts_total,
+                         'start': start,
+                         'next': start + limit if start + limit < archive.parts_total else None,
+                         'parts': parts})
+
+
 class ArchiveUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     model = Archive
     fields = ['archive_name']
@@ -116,3 +211,132 @@ class ArchiveDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
 
     def get_success_url(self):
         return reverse('archive-home')
+
+
+def get_content_disposition(filename: str) -> str:
+    """
+    :param filename:
+    :return: the Content-Disposition header that has the browser save the response as filename, the same way
+    FileResponse does
+    """
+    try:
+        filename.encode('ascii')
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        return f"attachment; filename*=utf-8''{quote(filename)}"
+
+
+def offload_archive_file(archive: Archive, archive_file_path: str) -> HttpResponse:
+    """
+    :param archive: a cached archive
+    :param archive_file_path:
+    :return: an empty response that hands the archive file off to the front proxy with ARCHIVE_SENDFILE_HEADER; the
+    proxy fills in Content-Length, honors Range requests, and keeps the other headers
+    """
+    response = HttpResponse()
+    if ARCHIVE_SENDFILE_HEADER == 'X-Accel-Redirect':
+        response['X-Accel-Redirect'] = ARCHIVE_SENDFILE_URL_PREFIX + quote(archive.archive_file.name)
+    else:
+        response['X-Sendfile'] = archive_file_path
+    return response
+
+
+def record_cache_access(archive: Archive, is_hit: bool, num_bytes: int):
+    """
+    :param archive:
+    :param is_hit: True if the bytes are served from the archive file or its cached parts
+    :param num_bytes: the number of bytes requested
+    :return: None; count the hit or miss (see CacheEventCounter), and on a hit, record that the archive was accessed,
+    which keeps it from being evicted (see scripts/evict_archives.py). Neither is written on every request
+    """
+    if is_hit:
+        archive.touch(ARCHIVE_ACCESS_RESOLUTION)
+    cache_event_counter.count(archive, "hit" if is_hit else "miss", num_bytes)
+
+
+@login_required
+def archive_download(request: HttpRequest, pk: str) -> HttpResponse:
+    """
+    :param request: may have a Range header, with one or several byte ranges, and an If-Range header
+    :param pk: the archive_id
+    :return: the archive file, or the requested byte ranges of it (206, or 416 if none of them can be satisfied), if
+    the user owns the archive. The bytes come from the archive file if it is cached, and otherwise from its cached
+    parts; only the requested bytes are read. A whole archive that isn't cached locally is streamed from its buckets
+    if it is fully uploaded (see iter_remote_parts). A cached archive file is either handed off to the front proxy with
+    ARCHIVE_SENDFILE_HEADER, or sent whole with FileResponse, which never buffers the file in memory and which the
+    WSGI server sends with sendfile if it can. Each download is recorded as a cache hit or miss
+    """
+    archive = get_object_or_404(Archive.objects.select_related('owner'), pk=pk, owner=request.user)
+    archive_file_path = os.path.join(MEDIA_ROOT, archive.archive_file.name)
+    is_cached = os.path.isfile(archive_file_path)
+    filename = os.path.basename(archive.archive_file.name)
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if is_cached and ARCHIVE_SENDFILE_HEADER:
+        record_cache_access(archive, True, os.path.getsize(archive_file_path))
+        response = offload_archive_file(archive, archive_file_path)
+        response['Content-Type'] = content_type
+        response['Content-Disposition'] = get_content_disposition(filename)
+        return response
+
+    size = os.path.getsize(archive_file_path) if is_cached else archive.get_size()
+    etag = f'"{archive.archive_file_checksum}"'
+    #   A Range request is only honored if the client's copy is still the same archive file
+    byte_ranges = None
+    if request.META.get('HTTP_IF_RANGE', etag) == etag:
+        byte_ranges = parse_range_header(request.META.get('HTTP_RANGE'), size)
+
+    if byte_ranges is None:
+        if is_cached:
+            record_cache_access(archive, True, size)
+            response = FileResponse(open(archive_file_path, 'rb'), as_attachment=True, filename=filename)
+            response.block_size = ARCHIVE_DOWNLOAD_BLOCK_SIZE
+        else:
+            byte_sources = get_archive_byte_sources(archive, 0, size - 1)
+            record_cache_access(archive, byte_sources is not None, size)
+            if byte_sources is not None:
+                archive_content = iter_byte_sources(byte_sources, ARCHIVE_DOWNLOAD_BLOCK_SIZE)
+            else:
+                #   Stream the parts straight from the buckets instead of waiting for the archive to be cached
+                part_sources = get_remote_part_sources(archive)
+                if part_sources is None:
+                    raise Http404("The archive is neither cached nor fully uploaded")
+                archive_content = iter_remote_parts(part_sources, ARCHIVE_STREAM_READ_AHEAD)
+            response = StreamingHttpResponse(archive_content, content_type=content_type)
+            response['Content-Length'] = size
+    elif not byte_ranges:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{size}"
+    else:
+        byte_sources = [get_archive_byte_sources(archive, first, last) for first, last in byte_ranges]
+        record_cache_access(archive, None not in byte_sources, sum(last - first + 1 for first, last in byte_ranges))
+        if None in byte_sources:
+            raise Http404("The requested bytes are not cached")
+        if len(byte_ranges) == 1:
+            (first, last), = byte_ranges
+            response = StreamingHttpResponse(iter_byte_sources(byte_sources[0], ARCHIVE_DOWNLOAD_BLOCK_SIZE),
+                                             status=206, content_type=content_type)
+            response['Content-Range'] = f"bytes {first}-{last}/{size}"
+            response['Content-Length'] = last - first + 1
+        else:
+            #   Several ranges are sent as the parts of a multipart/byteranges body
+            boundary = uuid.uuid4().hex
+            part_headers = [f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                            f"Content-Range: bytes {first}-{last}/{size}\r\n\r\n".encode()
+                            for first, last in byte_ranges]
+            closing = f"--{boundary}--\r\n".encode()
+
+            def iter_parts():
+                for part_header, part_byte_sources in zip(part_headers, byte_sources):
+                    yield part_header
+                    yield from iter_byte_sources(part_byte_sources, ARCHIVE_DOWNLOAD_BLOCK_SIZE)
+                    yield b"\r\n"
+                yield closing
+
+            response = StreamingHttpResponse(iter_parts(), status=206,
+                                             content_type=f"multipart/byteranges; boundary={boundary}")
+            response['Content-Length'] = sum(len(part_header) + last - first + 1 + 2 for part_header, (first, last)
+                                             in zip(part_headers, byte_ranges)) + len(closing)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Content-Disposition'] = get_content_disposition(filename)
+    return response
@@ -1,9 +1,14 @@
 import uuid
+import itertools
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor
+
 from boto3.session import Session
 from botocore.errorfactory import ClientError
 
 from django.urls import reverse
 from django.db import models
+from django.db.models.functions import Coalesce
 
 REGION_NAMES = [('us-west-2', 'us-west-2')]
 
@@ -23,6 +28,10 @@ class S3Connection(models.Model):
     is_valid = models.BooleanField(default=False, null=False)
     #   There can be exactly one entry in S3Connection whose is_active is True
     is_active = models.BooleanField(default=False, null=False)
+    #   Valid connections whose is_striped is True share the archive parts under the striped placement policy
+    is_striped = models.BooleanField(default=False, null=False)
+    #   Exponentially weighted moving average of the observed transfer throughput, in bytes per second
+    measured_throughput = models.FloatField(null=True)
 
     def __str__(self):
         return self.connection_name
@@ -43,6 +52,23 @@ class S3Connection(models.Model):
                           region_name=str(self.region_name))
         return session.resource(service_name)
 
+    def record_throughput(self, num_bytes: int, seconds: float, smoothing: float = 0.2):
+        """
+        :param num_bytes: the number of bytes transferred
+        :param seconds: the number of seconds the transfer took
+        :param smoothing: the weight given to the new observation
+        :return: None; fold the observation into measured_throughput. The average is updated in the database, so that
+        the jobs and workers transferring with the same connection at the same time don't overwrite each other's
+        observations, and then read back
+        """
+        if seconds <= 0:
+            return
+        observed = num_bytes / seconds
+        S3Connection.objects.filter(pk=self.pk).update(measured_throughput=Coalesce(
+            models.Value(smoothing * observed) + (1 - smoothing) * models.F('measured_throughput'),
+            models.Value(observed), output_field=models.FloatField()))
+        self.refresh_from_db(fields=['measured_throughput'])
+
     def delete(self, using=None, keep_parents=False):
         """
         Overwrite the default delete method so the bucket would be deleted when the model instance is deleted
@@ -59,6 +85,46 @@ class S3Connection(models.Model):
             pass
         super().delete()
 
+    def delete_keys(self, keys: ty.Iterable[str], batch_size: int = 1000, max_workers: int = 8) -> ty.Dict[str, str]:
+        """
+        :param keys: the keys to delete from this connection's bucket; they can come from a generator, in which case
+        the batches are sent while the keys are still being produced
+        :param batch_size: the number of keys per DeleteObjects request, at most 1000
+        :param max_workers: the number of DeleteObjects requests in flight at the same time
+        :return: the keys that could not be deleted, each mapped to the reason why
+        """
+        s3 = self.get_client('s3')
+
+        def delete_batch(batch: ty.List[str]) -> ty.Dict[str, str]:
+            try:
+                response = s3.delete_objects(Bucket=str(self.connection_id),
+                                             Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+                return {error['Key']: f"{error['Code']}: {error['Message']}" for error in response.get('Errors', [])}
+            except ClientError as ce:
+                return {key: str(ce) for key in batch}
+
+        failures = dict()
+        keys = iter(keys)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = list()
+            batch = list(itertools.islice(keys, batch_size))
+            while batch:
+                futures.append(executor.submit(delete_batch, batch))
+                batch = list(itertools.islice(keys, batch_size))
+            for future in futures:
+                failures.update(future.result())
+        return failures
+
+    def list_keys(self, prefix: str = '') -> ty.Iterator[str]:
+        """
+        :param prefix:
+        :return: the keys in this connection's bucket that start with prefix, one ListObjectsV2 page at a time
+        """
+        s3 = self.get_client('s3')
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=str(self.connection_id), Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
     def reset_bucket(self):
         """
         :return: if this connection has a bucket, then empty all of its content;
@@ -67,17 +133,14 @@ class S3Connection(models.Model):
         s3 = self.get_client('s3')
         try:
             response = s3.head_bucket(Bucket=str(self.connection_id))
-            #   If response is successful, then empty the bucket
-            bucket = self.get_resource('s3').Bucket(str(self.connection_id))
-            print(f"Emptying existing bucket {str(self.connection_id)}")
-            for obj in bucket.objects.all():
-                print(f"Deleting {obj}")
-                obj.delete()
         except ClientError as ce:
             #   head_bucket failed because there is no such bucket yet; create the bucket
             s3.create_bucket(Bucket=str(self.connection_id),
                              CreateBucketConfiguration={'LocationConstraint': self.region_name})
             print(f"New bucket {str(self.connection_id)} created")
-
-
-
+            return
+        #   If response is successful, then empty the bucket, deleting each page of keys as soon as it is listed
+        print(f"Emptying existing bucket {str(self.connection_id)}")
+        failures = self.delete_keys(self.list_keys())
+        for key, reason in failures.items():
+            print(f"Failed to delete {key}: {reason}")
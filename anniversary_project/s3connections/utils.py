@@ -1,8 +1,16 @@
 import uuid
+import random
+import itertools
+import typing as ty
 
 from boto3.session import Session
 from botocore.errorfactory import ClientError
 
+from anniversary_project.settings import ARCHIVE_PLACEMENT_POLICY
+from .models import S3Connection
+
+PLACEMENT_POLICIES = ['active', 'round-robin', 'throughput']
+
 
 def is_valid_connection_credentials(access_key: str, secret_key: str, region_name: str,
                                     validation_only: bool = True) -> bool:
@@ -27,3 +35,56 @@ def is_valid_connection_credentials(access_key: str, secret_key: str, region_nam
         return True
     except Exception as ce:
         return False
+
+
+def get_placement_conns(policy: str = ARCHIVE_PLACEMENT_POLICY) -> ty.List[S3Connection]:
+    """
+    :param policy: one of PLACEMENT_POLICIES
+    :return: the connections that new archive parts can be placed on. Under the striping policies these are all the
+    valid connections whose is_striped is True; if there is none of them, or if the policy is 'active', then fall back
+    to the active connection. Return an empty list if there is no usable connection at all
+    """
+    if policy != 'active':
+        striped_conns = list(S3Connection.objects.filter(is_valid=True, is_striped=True).order_by('connection_id'))
+        if striped_conns:
+            return striped_conns
+    return list(S3Connection.objects.filter(is_valid=True, is_active=True)[:1])
+
+
+def _weighted_cycle(conns: ty.List[S3Connection]) -> ty.Iterator[S3Connection]:
+    """
+    :param conns:
+    :return: an infinite iterator over conns where each connection appears in proportion to its measured_throughput,
+    interleaved the way smooth weighted round-robin does it. Connections that have not been measured yet get the
+    average of the measured ones, so that they get a chance to be measured
+    """
+    measured = [conn.measured_throughput for conn in conns if conn.measured_throughput]
+    default_weight = (sum(measured) / len(measured)) if measured else 1.0
+    weights = [conn.measured_throughput or default_weight for conn in conns]
+    total_weight = sum(weights)
+    current_weights = [0.0] * len(conns)
+    while True:
+        for i, weight in enumerate(weights):
+            current_weights[i] += weight
+        chosen = max(range(len(conns)), key=lambda i: current_weights[i])
+        current_weights[chosen] -= total_weight
+        yield conns[chosen]
+
+
+def get_placement(policy: str = ARCHIVE_PLACEMENT_POLICY) -> ty.Iterator[ty.Optional[S3Connection]]:
+    """
+    :param policy: one of PLACEMENT_POLICIES
+    :return: an infinite iterator that yields the connection on which each successive part of an archive should be
+    placed. If there is no usable connection, then yield None, and the part will be placed on whichever connection
+    is active when it is transferred
+    """
+    if policy not in PLACEMENT_POLICIES:
+        raise ValueError(f"Unknown placement policy {policy}")
+    conns = get_placement_conns(policy)
+    if not conns:
+        return itertools.repeat(None)
+    if policy == 'throughput':
+        return _weighted_cycle(conns)
+    #   Start each archive at a random connection so that single-part archives don't all land in the same bucket
+    offset = random.randrange(len(conns))
+    return itertools.cycle(conns[offset:] + conns[:offset])
@@ -97,6 +97,16 @@ def detail(request: HttpRequest, pk) -> HttpResponse:
                 messages.success(request, message='Connection successfully activated')
             else:
                 messages.warning(request, message='Connection is not valid; validate it first')
+        elif 'toggle_striping' in request.POST:
+            #   Only valid connections can receive striped archive parts; removing a connection from striping only
+            #   affects the placement of new archive parts
+            if connection.is_striped or connection.is_valid:
+                connection.is_striped = not connection.is_striped
+                connection.save()
+                messages.success(request, message='Connection ' + ('added to' if connection.is_striped else
+                                                                   'removed from') + ' striped placement')
+            else:
+                messages.warning(request, message='Connection is not valid; validate it first')
 
         return redirect(reverse('s3-connection-detail', kwargs={'pk': pk}))
     else:
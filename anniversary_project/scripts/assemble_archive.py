@@ -1,8 +1,11 @@
 import os
 import shutil
+import hashlib
 import logging
+import typing as ty
 
-from archive.models import Archive, ArchivePartMeta, get_file_checksum
+from archive.models import Archive, ArchiveChange, ArchivePartMeta, get_file_checksum, get_file_fingerprint
+from archive.utils import append_file, append_file_with_digests
 from archive.forms import ArchiveForm
 from anniversary_project.settings import MEDIA_ROOT
 
@@ -10,100 +13,188 @@ from anniversary_project.settings import MEDIA_ROOT
 CACHE_DIR = os.path.join(MEDIA_ROOT, "cache")
 
 
-def check_cache_health(archive_id: str) -> bool:
+def get_archive_cache_dir(archive: Archive) -> str:
+    return os.path.join(CACHE_DIR, str(archive.owner.username), str(archive.archive_id))
+
+
+def iter_changed_cache_archives() -> ty.Iterator[Archive]:
+    """
+    :return: the archives whose cache directory has changed since its parts were last checked. The new fingerprint of
+    each directory is recorded before the archive is handed out, so that a part arriving while the archive is being
+    checked changes the directory again and gets the archive checked again on the next run; check_and_assemble
+    forgets the fingerprint again if the assembly fails
+    """
+    if not (os.path.exists(CACHE_DIR) and os.path.isdir(CACHE_DIR)):
+        return
+    for username in os.listdir(CACHE_DIR):
+        user_cache_dir = os.path.join(CACHE_DIR, username)
+        if not os.path.isdir(user_cache_dir):
+            continue
+        for archive_id in os.listdir(user_cache_dir):
+            archive = Archive.objects.filter(pk=archive_id).select_related("owner").first()
+            if not archive:
+                continue
+            cache_dir_fingerprint = get_file_fingerprint(os.path.join(user_cache_dir, archive_id))
+            if cache_dir_fingerprint == archive.cache_dir_fingerprint:
+                continue
+            Archive.objects.filter(pk=archive_id).update(cache_dir_fingerprint=cache_dir_fingerprint)
+            yield archive
+
+
+def check_cache_health(archive_id: str, verify_checksums: bool = True) -> bool:
     """
     :param archive_id:
-    :return: True if and only if the all parts are present and are in good health
+    :param verify_checksums: if False, then only check that each part file exists and has the right size, and leave
+    the checksums to assemble_archive, which verifies them while it streams the parts into the archive file
+    :return: True if and only if the all parts are present and are in good health. A part file whose fingerprint is
+    the one recorded when it was last verified is not hashed again, and a part is only saved if its state changed
     """
     archive = Archive.objects.get(pk=archive_id)
     print(f"Checking cache health for archive {archive}'s parts")
     archive_parts_meta = ArchivePartMeta.objects.filter(archive=archive)
-    archive_cache_dir = os.path.join(
-        CACHE_DIR, str(archive.owner.username), str(archive.archive_id)
-    )
+    archive_cache_dir = get_archive_cache_dir(archive)
     ready_for_assembly = True
     for archive_part_meta in archive_parts_meta:
-        print(f"Inspecting cache file for {archive_part_meta}")
         cache_part_file_path = os.path.join(
             archive_cache_dir, str(archive_part_meta.part_index)
         )
+        was_cached, previous_cache_fingerprint = archive_part_meta.cached, archive_part_meta.cache_fingerprint
         if not (os.path.exists(cache_part_file_path) and os.path.isfile(cache_part_file_path)):
             #   If the desired path doesn't point to an existing file, then the archive is not ready for assembly
             print(f"File cache for {archive_part_meta} does not exist")
             ready_for_assembly = False
+            archive_part_meta.cached = False
+            archive_part_meta.cache_fingerprint = None
         else:
-            cache_part_file_checksum = get_file_checksum(
-                file_path=cache_part_file_path
-            )
-            if cache_part_file_checksum != archive_part_meta.part_checksum:
+            cache_fingerprint = get_file_fingerprint(cache_part_file_path)
+            if cache_fingerprint == archive_part_meta.cache_fingerprint:
+                is_healthy = True
+            elif os.path.getsize(cache_part_file_path) != archive_part_meta.get_size():
+                is_healthy = False
+            elif verify_checksums:
+                is_healthy = get_file_checksum(file_path=cache_part_file_path) == archive_part_meta.part_checksum
+                if is_healthy:
+                    archive_part_meta.cache_fingerprint = cache_fingerprint
+            else:
+                is_healthy = True
+            if not is_healthy:
                 #   If the file part's checksum does not check out, then remove the file part
                 print(f"Archive file part at {cache_part_file_path} fails checksum matching")
                 os.remove(cache_part_file_path)
                 archive_part_meta.cached = False
+                archive_part_meta.cache_fingerprint = None
+                ready_for_assembly = False
             else:
-                print(f"Archive file part at {cache_part_file_path} is in good health")
                 archive_part_meta.cached = True
-            archive_part_meta.save()
+        if archive_part_meta.cache_fingerprint != previous_cache_fingerprint:
+            archive_part_meta.save(update_fields=["cache_fingerprint"])
+        if archive_part_meta.cached != was_cached:
+            archive_part_meta.set_cached(archive_part_meta.cached)
 
     return ready_for_assembly
 
 
-def assemble_archive(archive_id: str):
+def assemble_archive(archive_id: str, verify: bool = True, hash_func=hashlib.md5):
     """
-    :param username:
     :param archive_id:
-    :return: read in the parts in cache directory and write all bytes in a single swoop to the archive directory
+    :param verify: if True, then verify each part against its part_checksum and the archive file against
+    archive_file_checksum in the same pass that copies the parts, so that every byte is read once and written once.
+    If False, then trust the parts and copy them in the kernel without looking at them
+    :param hash_func:
+    :return: True if and only if the archive was assembled; append the parts in cache directory one after another to
+    the archive file in the archive directory. A part that fails checksum matching is removed from the cache so that
+    it will be downloaded again. The archive file is removed unless the assembly succeeds, even if it raises
     """
     archive = Archive.objects.get(archive_id=archive_id)
     username = archive.owner.username
-    cache_dir = os.path.join(MEDIA_ROOT, "cache", username, archive_id)
     archive_dir = os.path.join(MEDIA_ROOT, "archives", username, archive_id)
     #   Delete archive_dir and remake it
-    shutil.rmtree(path=archive_dir)
+    shutil.rmtree(path=archive_dir, ignore_errors=True)
     os.makedirs(archive_dir)
-    #   Sort the file parts numerically by the index
-    file_part_names = os.listdir(cache_dir)
-    file_part_names.sort(key=lambda x: int(x))
     #   Find the original file name
-    archive: Archive = Archive.objects.get(pk=archive_id)
     archive_file_name = os.path.basename(archive.archive_file.name)
     archive_file_path = os.path.join(archive_dir, archive_file_name)
-    #   Start writing in batches:
-    with open(archive_file_path, "ab") as f:
-        for file_part_name in file_part_names:
-            file_part_path = os.path.join(cache_dir, file_part_name)
-            with open(file_part_path, "rb") as p:
+    archive_parts = ArchivePartMeta.objects.filter(archive=archive).order_by("part_index")
+    cache_dir = get_archive_cache_dir(archive)
+    file_hash = hash_func()
+    corrupted_part = None
+    try:
+        with open(archive_file_path, "wb", buffering=0) as f:
+            for archive_part in archive_parts:
+                file_part_path = os.path.join(cache_dir, str(archive_part.part_index))
                 print(f"Appending {file_part_path} to {archive_file_path}")
-                f.write(p.read())
-    #   Confirm the checksum
-    print(f"Verifying assembled file at {archive_file_path}")
-    written_checksum = get_file_checksum(file_path=archive_file_path)
-    if written_checksum == archive.archive_file_checksum:
+                if not verify:
+                    append_file(f, file_part_path)
+                    continue
+                part_hash = hash_func()
+                append_file_with_digests(f, file_part_path, [part_hash, file_hash])
+                if part_hash.hexdigest() != archive_part.part_checksum:
+                    corrupted_part = archive_part
+                    break
+    except Exception:
+        #   Don't leave a partial archive file behind, e.g. once the disk is full
+        if os.path.exists(archive_file_path):
+            os.remove(archive_file_path)
+        raise
+
+    if corrupted_part:
+        print(f"Archive file part at {file_part_path} fails checksum matching")
+        os.remove(file_part_path)
+        corrupted_part.cache_fingerprint = None
+        corrupted_part.save(update_fields=["cache_fingerprint"])
+        corrupted_part.set_cached(False)
+        os.remove(archive_file_path)
+        return False
+    elif (not verify) or file_hash.hexdigest() == archive.archive_file_checksum:
         print(f"Successfully assembled archive at {archive_file_path}")
         archive.cached = True
         archive.save()
+        archive.touch()
+        if verify:
+            archive.set_local_checksum(file_hash.hexdigest())
+        ArchiveChange.record(archive, "cache")
         #   Before deleting the directory holding archive part files, set the model instance's cached to False
-        for archive_part in ArchivePartMeta.objects.filter(archive=archive):
-            archive_part.cached = False
-            archive_part.save()
+        archive_parts_meta = ArchivePartMeta.objects.filter(archive=archive)
+        ArchivePartMeta.set_state(archive_parts_meta, "cached", False)
+        archive_parts_meta.update(cache_fingerprint=None)
         shutil.rmtree(cache_dir)
-    else:
-        print(f"Oh-oh something went wrong")
+        return True
+    print(f"Oh-oh something went wrong")
+    os.remove(archive_file_path)
+    return False
+
+
+def check_and_assemble(archive: Archive, logger=print) -> bool:
+    """
+    :param archive: an archive whose cache directory changed, as handed out by iter_changed_cache_archives
+    :param logger:
+    :return: True if and only if the archive was assembled; check the archive's cached parts, and assemble them if
+    they are all present. If the assembly fails or raises (e.g. the disk is full), then the fingerprint of the cache
+    directory is forgotten, so that the next run tries again instead of waiting for the directory to change
+    """
+    try:
+        #   The checksums are verified during assembly, so that the parts are only read once
+        if not check_cache_health(archive.archive_id, verify_checksums=False):
+            logger(f"Archive {archive} is not ready for assembly")
+            return False
+        logger(f"Archive {archive} is ready for assembly")
+        if assemble_archive(archive.archive_id):
+            return True
+    except Exception as e:
+        logger(f"Failed to assemble archive {archive}: {e}")
+    Archive.objects.filter(pk=archive.pk).update(cache_dir_fingerprint=None)
+    return False
 
 
 def run(logger=print):
     """
-    Check integrity of local cache and assemble them into complete archive if all of them are in good health
+    Check integrity of local cache and assemble them into complete archive if all of them are in good health. Only
+    the archives whose cache directory changed since the last run are checked
     """
     if not (os.path.exists(CACHE_DIR) and os.path.isdir(CACHE_DIR)):
         logger(f"media/cache directory does not exist; skipping inspection")
     else:
-        logger(f"Checking all archive parts' health")
-        for archive in Archive.objects.all():
+        logger(f"Checking the health of changed archive parts")
+        for archive in iter_changed_cache_archives():
             logger(f"Checking archive {archive}'s local partition cache")
-            ready_for_assembly = check_cache_health(archive.archive_id)
-            if ready_for_assembly:
-                logger(f"Archive {archive} is ready for assembly")
-                assemble_archive(archive.archive_id)
-            else:
-                logger(f"Archive {archive} is not ready for assembly")
+            check_and_assemble(archive, logger)
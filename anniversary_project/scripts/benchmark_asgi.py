@@ -0,0 +1,87 @@
+import os
+import time
+import asyncio
+import threading
+
+from channels.http import AsgiHandler
+from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY, HASH_SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.files.base import ContentFile
+
+from archive.models import Archive
+from archive.consumers import AsyncStreamingHandler
+
+
+ARCHIVE_SIZE = 4 * (2 ** 20)
+CLIENTS = [10, 100, 1000]
+#   Each client takes this many seconds to receive every message of the response body
+CLIENT_DELAY = 0.005
+HANDLERS = [('AsgiHandler', AsgiHandler), ('AsyncStreamingHandler', AsyncStreamingHandler)]
+
+
+async def download(handler_class, scope: dict) -> int:
+    """
+    :return: the number of bytes received by a slow client downloading the archive through handler_class
+    """
+    received = list()
+    done = asyncio.Event()
+    requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.body':
+            received.append(len(message.get('body', b'')))
+            await asyncio.sleep(CLIENT_DELAY)
+            if not message.get('more_body'):
+                done.set()
+
+    await handler_class(scope)(receive, send)
+    done.set()
+    return sum(received)
+
+
+async def download_all(handler_class, scope: dict, num_clients: int) -> int:
+    sizes = await asyncio.gather(*[download(handler_class, scope) for _ in range(num_clients)])
+    return sum(sizes)
+
+
+def run(logger=print):
+    """
+    Let 10, 100, and 1000 slow clients download an archive of ARCHIVE_SIZE bytes at the same time through each
+    handler, in a single process, and report how long it took and the most threads that were running
+    """
+    owner, _ = User.objects.get_or_create(username='benchmark_asgi')
+    archive = Archive(owner=owner, archive_name='benchmark')
+    archive.archive_file.save('benchmark.bin', ContentFile(os.urandom(ARCHIVE_SIZE)))
+    session = SessionStore()
+    session.update({SESSION_KEY: str(owner.pk), BACKEND_SESSION_KEY: 'django.contrib.auth.backends.ModelBackend',
+                    HASH_SESSION_KEY: owner.get_session_auth_hash()})
+    session.create()
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http', 'root_path': '',
+             'path': f"/archives/archive/{archive.archive_id}/download/", 'query_string': b'',
+             'headers': [(b'host', b'localhost'), (b'cookie', f"sessionid={session.session_key}".encode())],
+             'client': ('127.0.0.1', 0), 'server': ('localhost', 80)}
+    try:
+        for handler_name, handler_class in HANDLERS:
+            for num_clients in CLIENTS:
+                peak_threads = threading.active_count()
+                loop = asyncio.new_event_loop()
+                start = time.monotonic()
+                task = loop.create_task(download_all(handler_class, scope, num_clients))
+                while not task.done():
+                    loop.run_until_complete(asyncio.wait([task], timeout=0.1))
+                    peak_threads = max(peak_threads, threading.active_count())
+                elapsed = time.monotonic() - start
+                loop.close()
+                assert task.result() == num_clients * ARCHIVE_SIZE
+                logger(f"{handler_name:>22}, {num_clients:4} clients: {elapsed:7.2f} s, "
+                       f"{num_clients * ARCHIVE_SIZE / elapsed / (2 ** 20):8.1f} MB/s, {peak_threads} threads")
+    finally:
+        session.delete()
+        archive.delete()
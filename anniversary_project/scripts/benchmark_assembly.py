@@ -0,0 +1,64 @@
+import os
+import time
+import shutil
+import tempfile
+import tracemalloc
+
+from archive.utils import append_file
+
+
+NUM_PARTS = 2000
+PART_SIZE = 512 * (2 ** 10)
+#   Each strategy is either a single method of archive.utils.append_file or the previous whole-part read
+STRATEGIES = [('read whole part', None),
+              ('copy_file_range', ['copy_file_range']),
+              ('sendfile', ['sendfile']),
+              ('buffered', ['buffered']),
+              ('default', None)]
+
+
+def assemble(part_paths, archive_file_path, strategy_name, methods):
+    with open(archive_file_path, 'wb', buffering=0) as f:
+        for part_path in part_paths:
+            if strategy_name == 'read whole part':
+                with open(part_path, 'rb') as p:
+                    f.write(p.read())
+            elif methods is None:
+                append_file(f, part_path)
+            else:
+                append_file(f, part_path, methods=methods)
+
+
+def run(logger=print):
+    """
+    Assemble an archive of NUM_PARTS parts of PART_SIZE bytes with each strategy, and report the throughput and the
+    peak memory allocated by Python
+    """
+    work_dir = tempfile.mkdtemp()
+    try:
+        logger(f"Writing {NUM_PARTS} parts of {PART_SIZE} bytes to {work_dir}")
+        part_paths = []
+        for part_index in range(NUM_PARTS):
+            part_path = os.path.join(work_dir, str(part_index))
+            with open(part_path, 'wb') as p:
+                p.write(os.urandom(PART_SIZE))
+            part_paths.append(part_path)
+        archive_size = NUM_PARTS * PART_SIZE
+
+        for strategy_name, methods in STRATEGIES:
+            archive_file_path = os.path.join(work_dir, 'archive')
+            tracemalloc.start()
+            start = time.perf_counter()
+            assemble(part_paths, archive_file_path, strategy_name, methods)
+            #   Include the time it takes for the bytes to reach the disk, which the kernel copies defer as well
+            with open(archive_file_path, 'rb') as f:
+                os.fsync(f.fileno())
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert os.path.getsize(archive_file_path) == archive_size
+            os.remove(archive_file_path)
+            logger(f"{strategy_name:>16}: {archive_size / elapsed / (2 ** 20):8.1f} MB/s, "
+                   f"peak Python memory {peak / (2 ** 10):8.1f} KB")
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,69 @@
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+
+from archive.models import Archive, ArchivePartMeta, ArchivePartTable
+
+
+NUM_PARTS = 100000
+PART_SIZE = 5 * (2 ** 20)
+#   Every this many parts is not uploaded, and the first NUM_UPDATED_PARTS of them get uploaded
+NOT_UPLOADED_EVERY = 100
+NUM_UPDATED_PARTS = 1000
+
+
+def measure(logger, layout: str, operation: str, func):
+    """
+    :return: whatever func returns; report how long func took and the peak memory it allocated in Python
+    """
+    tracemalloc.start()
+    start = time.monotonic()
+    result = func()
+    elapsed = time.monotonic() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    logger(f"{layout:>12}, {operation:<32}: {elapsed * 1000:8.1f} ms, {peak / 2 ** 20:7.1f} MB peak")
+    return result
+
+
+def run(logger=print):
+    """
+    Create a throwaway archive of NUM_PARTS parts, and compare the latency and memory of the operations that the
+    transfer and sync code does with one ArchivePartMeta row per part and with a packed ArchivePartTable
+    """
+    owner, _ = User.objects.get_or_create(username='benchmark_part_table')
+    archive = Archive.objects.create(owner=owner, archive_name='benchmark', archive_file='benchmark')
+    try:
+        ArchivePartMeta.objects.bulk_create([
+            ArchivePartMeta(archive=archive, part_index=part_index, start_byte_index=part_index * PART_SIZE,
+                            end_byte_index=(part_index + 1) * PART_SIZE, part_checksum=f"{part_index:032x}",
+                            uploaded=part_index % NOT_UPLOADED_EVERY != 0, cached=False)
+            for part_index in range(NUM_PARTS)
+        ])
+        archive.repair_counters()
+        updated_part_indices = list(range(0, NUM_PARTS, NOT_UPLOADED_EVERY))[:NUM_UPDATED_PARTS]
+
+        measure(logger, 'rows', 'load every part', lambda: list(archive.archivepartmeta_set.all()))
+        measure(logger, 'rows', 'find the parts not uploaded',
+                lambda: [part.part_index for part in archive.archivepartmeta_set.all() if not part.uploaded])
+        measure(logger, 'rows', f"upload {NUM_UPDATED_PARTS} parts",
+                lambda: ArchivePartMeta.set_state(
+                    archive.archivepartmeta_set.filter(part_index__in=updated_part_indices), 'uploaded', True))
+        ArchivePartMeta.set_state(archive.archivepartmeta_set.filter(part_index__in=updated_part_indices),
+                                  'uploaded', False)
+
+        part_table = measure(logger, 'packed', 'pack', lambda: ArchivePartTable.pack(archive))
+        part_table = measure(logger, 'packed', 'load every part',
+                             lambda: ArchivePartTable.objects.select_related('archive__owner').get(archive=archive))
+        measure(logger, 'packed', 'find the parts not uploaded',
+                lambda: list(part_table.iter_part_indices('uploaded', False)))
+        measure(logger, 'packed', f"upload {NUM_UPDATED_PARTS} parts",
+                lambda: part_table.set_state('uploaded', updated_part_indices, True))
+        measure(logger, 'packed', 'read every part through PartRef',
+                lambda: sum(part.get_size() for part in part_table.iter_parts()))
+        packed_size = len(part_table.checksums) + len(part_table.uploaded) + len(part_table.cached) + \
+            len(part_table.placements)
+        logger(f"The packed table stores {packed_size} bytes of part data in one row instead of {NUM_PARTS} rows")
+    finally:
+        Archive.objects.filter(pk=archive.pk).delete()
@@ -0,0 +1,74 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import multiprocessing as mp
+
+from anniversary_project.settings import SQLITE_PRAGMAS
+from archive.signals import apply_sqlite_pragmas
+
+
+WRITERS = [1, 2, 4, 8]
+WRITES_PER_WRITER = 200
+#   Each configuration is a set of PRAGMAs run on every connection; "rollback journal" is SQLite's default, with the
+#   five second timeout that Django connects with
+CONFIGURATIONS = [('rollback journal', {'journal_mode': 'DELETE', 'busy_timeout': 5000}),
+                  ('tuned', SQLITE_PRAGMAS)]
+
+
+def write(db_path, pragmas, num_writes, results):
+    """
+    Write num_writes rows, each in its own transaction like a job status update, and report the number of writes
+    that failed with "database is locked"
+    """
+    failures = 0
+    try:
+        connection = sqlite3.connect(db_path, timeout=0, isolation_level=None)
+        apply_sqlite_pragmas(connection.cursor(), pragmas)
+        for _ in range(num_writes):
+            try:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.execute("INSERT INTO job (pid, payload) VALUES (?, ?)", (os.getpid(), os.urandom(64)))
+                connection.execute("SELECT COUNT(*) FROM job WHERE pid = ?", (os.getpid(), )).fetchone()
+                connection.execute("COMMIT")
+            except sqlite3.OperationalError:
+                failures += 1
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+        connection.close()
+    except sqlite3.OperationalError:
+        failures = num_writes
+    finally:
+        results.put(failures)
+
+
+def run(logger=print):
+    """
+    For each configuration, let 1, 2, 4 and 8 processes write the same database at the same time, and report the
+    write throughput and the number of writes that failed with "database is locked"
+    """
+    work_dir = tempfile.mkdtemp()
+    try:
+        for config_name, pragmas in CONFIGURATIONS:
+            for num_writers in WRITERS:
+                db_path = os.path.join(work_dir, f"{config_name}-{num_writers}.sqlite3")
+                with sqlite3.connect(db_path) as connection:
+                    apply_sqlite_pragmas(connection.cursor(), pragmas)
+                    connection.execute("CREATE TABLE job (id INTEGER PRIMARY KEY, pid INTEGER, payload BLOB)")
+                    connection.execute("CREATE INDEX job_pid ON job (pid)")
+                results = mp.Queue()
+                writers = [mp.Process(target=write, args=(db_path, pragmas, WRITES_PER_WRITER, results))
+                           for _ in range(num_writers)]
+                start = time.monotonic()
+                for writer in writers:
+                    writer.start()
+                failures = sum(results.get() for _ in writers)
+                for writer in writers:
+                    writer.join()
+                elapsed = time.monotonic() - start
+                writes = num_writers * WRITES_PER_WRITER - failures
+                logger(f"{config_name:>16}, {num_writers} writers: {writes / elapsed:8.0f} writes/s, "
+                       f"{failures} writes failed with 'database is locked'")
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,117 @@
+import os
+import shutil
+
+from django.db.models import F
+from django.utils import timezone
+
+from anniversary_project.settings import MEDIA_ROOT, ARCHIVE_CACHE_BUDGET, ARCHIVE_CACHE_HIGH_WATER, \
+    ARCHIVE_CACHE_LOW_WATER, CACHE_EVENT_RETENTION
+from archive.models import Archive, CacheEvent
+from archive.utils import can_uncache, uncache
+
+
+#   The hit and miss rates are reported over each of these windows, in seconds
+STATS_WINDOWS = [('last day', 24 * 60 * 60), ('retention', CACHE_EVENT_RETENTION)]
+
+
+def get_archive_usage() -> int:
+    """
+    :return: the number of bytes taken up by the files under MEDIA_ROOT/archives, whether the database knows about
+    them or not
+    """
+    usage = 0
+    for dir_path, _, file_names in os.walk(os.path.join(MEDIA_ROOT, 'archives')):
+        for file_name in file_names:
+            try:
+                usage += os.path.getsize(os.path.join(dir_path, file_name))
+            except FileNotFoundError:
+                continue
+    return usage
+
+
+def get_excess_bytes(budget=ARCHIVE_CACHE_BUDGET, high_water: float = ARCHIVE_CACHE_HIGH_WATER,
+                     low_water: float = ARCHIVE_CACHE_LOW_WATER) -> int:
+    """
+    :param budget: the number of bytes the archive files may take up, or None to only watch the disk
+    :param high_water: the fraction of the budget, and of the disk, past which archive files are evicted
+    :param low_water: the fraction of the budget, and of the disk, down to which archive files are evicted
+    :return: 0 if neither the archive files nor the disk are past the high-water mark, and otherwise the number of
+    bytes to free to bring back down to the low-water mark whichever of them is past it
+    """
+    excess = 0
+    if budget is not None:
+        usage = get_archive_usage()
+        if usage > high_water * budget:
+            excess = usage - low_water * budget
+    disk = shutil.disk_usage(MEDIA_ROOT)
+    if disk.used > high_water * disk.total:
+        excess = max(excess, disk.used - low_water * disk.total)
+    return int(excess)
+
+
+def evict_least_recently_used(excess: int, logger=print) -> int:
+    """
+    :param excess: the number of bytes to free
+    :param logger:
+    :return: the number of bytes freed; uncache the archives that were accessed least recently, never accessed ones
+    first, until excess bytes are freed. An archive is only evicted if it can be uncached, i.e. if it can still be
+    downloaded from its buckets, and each eviction is recorded as a CacheEvent
+    """
+    freed = 0
+    archives = Archive.objects.filter(cached=True, processing=False).select_related('owner')\
+        .order_by(F('date_last_accessed').asc(nulls_first=True), 'date_created')
+    for archive in archives.iterator():
+        if freed >= excess:
+            break
+        if not can_uncache(archive):
+            continue
+        archive_file_path = os.path.join(MEDIA_ROOT, archive.archive_file.name)
+        if not os.path.isfile(archive_file_path):
+            #   Left to sync_archive_to_db, which sets "cached" to False
+            continue
+        size = os.path.getsize(archive_file_path)
+        uncache(archive)
+        CacheEvent.record(archive, "evict", size)
+        freed += size
+        logger(f"Evicted {archive}, {size} bytes, last accessed {archive.date_last_accessed or 'never'}")
+    if freed < excess:
+        logger(f"Only {freed} of {excess} bytes could be freed; the other cached archives are not fully uploaded")
+    return freed
+
+
+def log_cache_stats(logger=print):
+    """
+    :param logger:
+    :return: None; report the hits, misses and evictions over each of STATS_WINDOWS, to size the local tier by
+    """
+    for window_name, window in STATS_WINDOWS:
+        stats = CacheEvent.get_stats(since=timezone.now() - timezone.timedelta(seconds=window))
+        (hits, hit_bytes), (misses, miss_bytes), (evictions, evicted_bytes) = \
+            stats["hit"], stats["miss"], stats["evict"]
+        hit_rate = hits / (hits + misses) if hits + misses else 0
+        byte_hit_rate = hit_bytes / (hit_bytes + miss_bytes) if hit_bytes + miss_bytes else 0
+        logger(f"{window_name:>10}: {hits} hits, {misses} misses ({hit_rate:.1%} hit rate, {byte_hit_rate:.1%} of "
+               f"the bytes), {evictions} evictions freeing {evicted_bytes} bytes")
+
+
+def evict_cached_archives(logger=print) -> int:
+    """
+    :param logger:
+    :return: the number of bytes freed; evict cached archives if MEDIA_ROOT is past its high-water mark, and forget
+    the cache events older than CACHE_EVENT_RETENTION
+    """
+    excess = get_excess_bytes()
+    freed = evict_least_recently_used(excess, logger) if excess else 0
+    CacheEvent.prune(CACHE_EVENT_RETENTION)
+    return freed
+
+
+def run(logger=print):
+    """
+    Keep the local archive files within ARCHIVE_CACHE_BUDGET and the disk, evicting the least recently accessed
+    archives that are fully uploaded, and report the cache's hit rate. The s3portal worker does the same as one of its
+    house chores
+    """
+    freed = evict_cached_archives(logger)
+    logger(f"Freed {freed} bytes")
+    log_cache_stats(logger)
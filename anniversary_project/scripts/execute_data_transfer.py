@@ -2,7 +2,10 @@ import time
 
 from django.db.models.query import QuerySet
 from s3connections.models import S3Connection
-from .s3portal.portal_utils import get_active_conn, get_scheduled_jobs, initialize_job_queue
+from s3connections.utils import get_placement_conns
+from .s3portal.portal_utils import get_active_conn, get_scheduled_jobs, initialize_job_queue, execute_job_queue, \
+    claim_jobs, release_jobs
+from .s3portal.worker import get_worker_id
 
 
 HEARTBEAT = 10
@@ -14,10 +17,16 @@ def run(logger=print):
 
     #   If there is no active connection or no job to execute, then print appropriate message and sleep for
     #   a cycle
-    if (not active_conn) or (len(scheduled_jobs) == 0):
+    if (not (active_conn or get_placement_conns())) or (len(scheduled_jobs) == 0):
         logger("No active connection found" if (not active_conn) else "No scheduled jobs found")
     else:
-        job_queue = initialize_job_queue(active_conn, scheduled_jobs)
+        #   Claim the jobs like any s3portal worker would, so that a running worker won't transfer them a second time
+        worker_id = get_worker_id('execute_data_transfer')
+        release_jobs(worker_id)
+        claimed_jobs = claim_jobs(scheduled_jobs, worker_id, batch_size=len(scheduled_jobs))
+        job_queue = initialize_job_queue(active_conn, claimed_jobs)
         logger(f"{len(job_queue)} jobs found")
-        for job in job_queue:
-            job.execute()
+        try:
+            execute_job_queue(job_queue)
+        finally:
+            release_jobs(worker_id)
@@ -0,0 +1,34 @@
+from archive.models import Archive
+from archive.utils import ingest_archive
+
+
+def ingest_processing_archives(logger=print) -> int:
+    """
+    :param logger:
+    :return: the number of archives ingested; finalize every archive that is still processing, oldest first, which
+    queues the uploads of its parts. An archive that fails to be ingested, e.g. whose file can't be read, is
+    skipped and tried again on the next run
+    """
+    ingested = 0
+    for archive in Archive.objects.filter(processing=True).select_related('owner').order_by('date_created'):
+        logger(f"Ingesting {archive}")
+        try:
+            is_ingested = ingest_archive(archive)
+        except Exception as e:
+            logger(f"Failed to ingest {archive}: {e}")
+            continue
+        if is_ingested:
+            ingested += 1
+            logger(f"Ingested {archive} into {archive.parts_total} parts")
+        else:
+            logger(f"Skipped {archive}, whose file is gone or which was ingested by someone else")
+    return ingested
+
+
+def run(logger=print):
+    """
+    Hash the archives that were uploaded but not processed yet, create their parts, and queue their uploads. The
+    s3portal worker does the same as one of its house chores
+    """
+    ingested = ingest_processing_archives(logger)
+    logger(f"Ingested {ingested} archives")
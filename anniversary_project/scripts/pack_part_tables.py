@@ -0,0 +1,23 @@
+from django.db.models import F
+
+from anniversary_project.settings import PART_TABLE_MIN_PARTS
+from archive.models import Archive, ArchivePartTable
+
+
+def run(logger=print):
+    """
+    Pack the ArchivePartMeta rows of every fully uploaded archive with at least PART_TABLE_MIN_PARTS parts, none of
+    them cached, into an ArchivePartTable. Archives whose parts are being transferred, or are not all the same size,
+    are left as they are
+    """
+    archives = Archive.objects.filter(parts_total__gte=PART_TABLE_MIN_PARTS, parts_uploaded=F('parts_total'),
+                                      parts_cached=0, archiveparttable=None)
+    num_packed = 0
+    for archive in archives:
+        try:
+            ArchivePartTable.pack(archive)
+            logger(f"Packed the {archive.parts_total} parts of {archive}")
+            num_packed += 1
+        except ValueError as e:
+            logger(f"Cannot pack {archive}: {e}")
+    logger(f"Packed {num_packed} archives")
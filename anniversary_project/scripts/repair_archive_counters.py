@@ -0,0 +1,23 @@
+from archive.models import Archive, ArchivePartMeta, ArchivePartTable, COUNTER_AGGREGATES
+
+
+def run(logger=print):
+    """
+    Recount every archive's counters from its parts with a single grouped query, and fix the archives whose counters
+    drifted. Packed archives are recounted from their part tables
+    """
+    counted = {counters.pop('archive_id'): counters for counters in
+               ArchivePartMeta.objects.order_by().values('archive_id').annotate(**COUNTER_AGGREGATES)}
+    for part_table in ArchivePartTable.objects.iterator():
+        counted[part_table.archive_id] = part_table.count_parts()
+    repaired_archives = list()
+    for archive in Archive.objects.only('archive_id', *COUNTER_AGGREGATES).iterator():
+        archive_counted = counted.get(archive.archive_id, dict())
+        counters = {counter: archive_counted.get(counter) or 0 for counter in COUNTER_AGGREGATES}
+        if any(getattr(archive, counter) != value for counter, value in counters.items()):
+            logger(f"Repairing the counters of archive {archive.archive_id}")
+            for counter, value in counters.items():
+                setattr(archive, counter, value)
+            repaired_archives.append(archive)
+    Archive.objects.bulk_update(repaired_archives, list(COUNTER_AGGREGATES), batch_size=500)
+    logger(f"Repaired the counters of {len(repaired_archives)} archives")
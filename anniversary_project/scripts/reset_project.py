@@ -38,6 +38,57 @@ def initialize_admin_tools():
     )
     sync_remote_to_db.save()
 
+    scrub = AdminTool(
+        tool_id='scrub',
+        tool_title='Scrub remote parts and local archives',
+        tool_description='Verify the remote parts and local archives that were verified least recently, within a '
+                         'budget; deploy it to run every SCRUB_INTERVAL seconds',
+        is_permanent=True
+    )
+    scrub.save()
+
+    restore_from_bucket = AdminTool(
+        tool_id='restore_from_bucket',
+        tool_title='Restore database from S3 buckets',
+        tool_description='Read the archive manifests in every valid S3 bucket, and restore the archives and archive '
+                         'parts that are missing from the database',
+        is_permanent=True
+    )
+    restore_from_bucket.save()
+
+    repair_archive_counters = AdminTool(
+        tool_id='repair_archive_counters',
+        tool_title='Repair archive counters',
+        tool_description='Recount the uploaded and cached parts of every archive, and fix the counters that drifted',
+        is_permanent=True
+    )
+    repair_archive_counters.save()
+
+    pack_part_tables = AdminTool(
+        tool_id='pack_part_tables',
+        tool_title='Pack part tables',
+        tool_description='Pack the parts of large, fully uploaded archives into a compact part table per archive',
+        is_permanent=True
+    )
+    pack_part_tables.save()
+
+    ingest_archives = AdminTool(
+        tool_id='ingest_archives',
+        tool_title='Ingest archives',
+        tool_description='Hash the newly uploaded archives, create their parts, and queue their uploads',
+        is_permanent=True
+    )
+    ingest_archives.save()
+
+    evict_archives = AdminTool(
+        tool_id='evict_archives',
+        tool_title='Evict archives',
+        tool_description='Evict the least recently accessed cached archives once the disk budget is exceeded, and '
+                         'report the cache hit rate',
+        is_permanent=True
+    )
+    evict_archives.save()
+
 
 def run(logger=print):
     reset_s3_connection()
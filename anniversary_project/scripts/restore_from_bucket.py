@@ -0,0 +1,115 @@
+import os
+import json
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.errorfactory import ClientError
+from botocore.exceptions import BotoCoreError
+from django.db import transaction
+from django.contrib.auth.models import User
+from django.utils.dateparse import parse_datetime
+
+from anniversary_project.settings import MEDIA_ROOT
+from archive.models import Archive, ArchiveChange, ArchivePartMeta, MANIFEST_NAME, MANIFEST_VERSION
+from s3connections.models import S3Connection
+from .s3portal.portal_utils import list_remote_objects
+
+
+MAX_WORKERS = 16
+
+
+def read_manifests(conn: S3Connection, keys: ty.Iterable[str], max_workers: int = MAX_WORKERS,
+                   logger=print) -> ty.Dict[str, dict]:
+    """
+    :param conn:
+    :param keys: the keys of the manifests in the connection's bucket
+    :param max_workers: the number of manifests that are downloaded at the same time
+    :param logger:
+    :return: each manifest that could be read, by key
+    """
+    s3 = conn.get_client('s3')
+
+    def read_manifest(key: str) -> ty.Optional[dict]:
+        try:
+            return json.loads(s3.get_object(Bucket=conn.connection_id, Key=key)['Body'].read())
+        except (ClientError, BotoCoreError, ValueError) as e:
+            logger(f"Failed to read manifest {key} in {conn}: {e}")
+            return None
+
+    keys = list(keys)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        manifests = executor.map(read_manifest, keys)
+    return {key: manifest for key, manifest in zip(keys, manifests) if manifest is not None}
+
+
+def restore_archive(manifest: dict, remote_objects: ty.Dict[str, ty.Dict[str, ty.Tuple[str, int]]]) -> int:
+    """
+    :param manifest: an archive's manifest, as written by Archive.upload_manifest
+    :param remote_objects: the listing of every bucket, by connection_id, as returned by list_remote_objects
+    :return: the number of parts restored; create the archive (and its owner) if it is not in the database, and
+    create whichever of its parts are missing. A part is "uploaded" if the listing of its bucket holds it in good
+    health, and "cached" is left to the syncs. The archive's counters are recounted from its parts
+    """
+    owner, owner_created = User.objects.get_or_create(username=manifest['owner'])
+    if owner_created:
+        owner.set_unusable_password()
+        owner.save()
+    archive, archive_created = Archive.objects.get_or_create(archive_id=manifest['archive_id'], defaults={
+        'archive_name': manifest['archive_name'],
+        'archive_file': manifest['archive_file'],
+        'archive_file_checksum': manifest['archive_file_checksum'],
+        'owner': owner,
+        'date_created': parse_datetime(manifest['date_created']),
+        'cached': os.path.isfile(os.path.join(MEDIA_ROOT, manifest['archive_file'])),
+    })
+    restored_part_indices = set(archive.archivepartmeta_set.values_list('part_index', flat=True))
+    archive_parts_meta = list()
+    for part_index, start_byte_index, end_byte_index, part_checksum, connection_id in manifest['parts']:
+        if part_index in restored_part_indices:
+            continue
+        remote_key = f"{manifest['owner']}/{manifest['archive_id']}/{part_index}"
+        remote_object = remote_objects.get(connection_id, dict()).get(remote_key)
+        archive_parts_meta.append(ArchivePartMeta(
+            archive=archive,
+            part_index=part_index,
+            start_byte_index=start_byte_index,
+            end_byte_index=end_byte_index,
+            part_checksum=part_checksum,
+            uploaded=remote_object == (part_checksum, end_byte_index - start_byte_index),
+            cached=False,
+            connection_id=connection_id if connection_id in remote_objects else None,
+        ))
+    ArchivePartMeta.objects.bulk_create(archive_parts_meta)
+    archive.repair_counters()
+    if archive_created:
+        ArchiveChange.record(archive, "create")
+    return len(archive_parts_meta)
+
+
+def run(logger=print):
+    """
+    Rebuild the archives and archive parts in the database from the manifests in every valid connection's bucket.
+    Each bucket is listed once, and each archive costs a single read of its manifest; the manifests are read in
+    parallel. Archives and parts that are already in the database are left as they are
+    """
+    conns = {conn.connection_id: conn for conn in S3Connection.objects.filter(is_valid=True)}
+    if not conns:
+        logger(f"No valid connection found")
+        return
+    remote_objects, manifests = dict(), dict()
+    for conn_id, conn in conns.items():
+        remote_objects[conn_id] = list_remote_objects(conn)
+        manifest_keys = [key for key in remote_objects[conn_id] if key.endswith(f"/{MANIFEST_NAME}")]
+        logger(f"Found {len(remote_objects[conn_id])} remote files and {len(manifest_keys)} manifests in {conn}")
+        #   The same manifest is written to every bucket holding the archive's parts; read it only once
+        manifest_keys = [key for key in manifest_keys if key not in manifests]
+        manifests.update(read_manifests(conn, manifest_keys, logger=logger))
+
+    restored_parts = 0
+    with transaction.atomic():
+        for key, manifest in manifests.items():
+            if manifest.get('version', 0) > MANIFEST_VERSION:
+                logger(f"Skipping manifest {key} written by a newer version")
+                continue
+            restored_parts += restore_archive(manifest, remote_objects)
+    logger(f"Restored {restored_parts} archive parts from {len(manifests)} manifests")
@@ -1,9 +1,15 @@
+import io
 import os
 import abc
+import json
+import time
 import shutil
+import hashlib
 
 from boto3.session import Session
+from boto3.s3.transfer import TransferConfig
 from botocore.errorfactory import ClientError
+from botocore.exceptions import BotoCoreError
 import django
 from django.db.models.query import QuerySet
 from django.utils import timezone
@@ -13,7 +19,8 @@ from django.contrib.auth.models import User
 from anniversary_project.settings import MEDIA_ROOT
 from s3connections.models import S3Connection
 from s3connections.utils import is_valid_connection_credentials
-from archive.models import PersistentTransferJob
+from archive.models import ArchiveChange, PersistentTransferJob, get_file_fingerprint
+from archive.progress import progress_publisher
 
 """
 # The `DataTransferJob` class
@@ -36,11 +43,11 @@ class DataTransferJob(abc.ABC):
     @classmethod
     def get_s3_client(cls, conn: S3Connection):
         """
-        :param conn: an S3Connection object
+        :param conn: an S3Connection object; it need not be the active one, since parts can be striped across
+        several connections
         :return: a boto3 s3 client
         """
         assert conn.is_valid
-        assert conn.is_active
 
         session = Session(aws_access_key_id=conn.access_key,
                           aws_secret_access_key=conn.secret_key,
@@ -161,21 +168,47 @@ class DataUploadJob(DataTransferJob):
         #   let's go!
         self.job_meta.date_started = timezone.now()
         self.job_meta.save()
+        uploaded_bytes = 0
+
+        def publish_upload_progress(num_bytes: int):
+            nonlocal uploaded_bytes
+            uploaded_bytes += num_bytes
+            progress_publisher.publish(archive_id, part_index,
+                                       transfer={'type': 'upload', 'done': uploaded_bytes, 'total': len(content)})
+
+        publish_upload_progress(0)
         try:
-            self.s3.put_object(Body=content,
-                               Bucket=self.conn.connection_id,
-                               Key=s3_key)
+            transfer_start = time.monotonic()
+            #   A single PUT, never a multipart upload, so that the object's ETag stays the part's MD5 checksum
+            self.s3.upload_fileobj(io.BytesIO(content), self.conn.connection_id, s3_key,
+                                   Config=TransferConfig(multipart_threshold=len(content) + 1),
+                                   Callback=publish_upload_progress)
+            self.conn.record_throughput(len(content), time.monotonic() - transfer_start)
             self.job_meta.status = 'completed'
-            self.job_meta.content_meta.uploaded = True
+            self.job_meta.content_meta.connection = self.conn
             self.job_meta.date_completed = timezone.now()
             self.job_meta.save()
-            self.job_meta.content_meta.save()
+            self.job_meta.content_meta.save(update_fields=['connection'])
+            self.job_meta.content_meta.set_uploaded(True)
+            ArchiveChange.record(self.job_meta.content_meta.archive, "upload", self.job_meta.content_meta)
+            progress_publisher.publish(archive_id, part_index, uploaded=True, transfer=None)
             print(f"{self.__str__()} was successful!")
+            #   Once all of the archive's parts are uploaded, describe them in the archive's manifest
+            archive = self.job_meta.content_meta.archive
+            archive.refresh_from_db(fields=['parts_total', 'parts_uploaded'])
+            if archive.is_fully_uploaded():
+                archive.upload_manifest()
         except Exception as e:
+            progress_publisher.publish(archive_id, part_index, transfer=None)
             print(e)
 
 
 class DataDownloadJob(DataTransferJob):
+    #   Parts are streamed into a ".partial" sidecar next to the destination; every CHECKPOINT_INTERVAL bytes the
+    #   sidecar is flushed to disk and the offset is recorded in a ".checkpoint" sidecar, so that a killed download can
+    #   be resumed from the last checkpoint with a Range GET instead of being started over
+    CHUNK_SIZE = 2 ** 20
+    CHECKPOINT_INTERVAL = 8 * (2 ** 20)
 
     def _get_bucket_name(self) -> str:
         return self.conn.connection_id
@@ -198,6 +231,108 @@ class DataDownloadJob(DataTransferJob):
         if not os.path.exists(dest_dir):
             os.makedirs(dest_dir)
 
+    @classmethod
+    def _get_partial_path(cls, dest) -> str:
+        return f"{dest}.partial"
+
+    @classmethod
+    def _get_checkpoint_path(cls, dest) -> str:
+        return f"{dest}.checkpoint"
+
+    def _read_checkpoint(self, dest) -> int:
+        """
+        :param dest:
+        :return: the offset up to which the partial file was durably written by a previous attempt at downloading the
+        same remote object, or 0 if there is no usable checkpoint
+        """
+        try:
+            with open(self._get_checkpoint_path(dest), 'r') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if checkpoint.get('checksum') != self.job_meta.content_meta.part_checksum:
+            return 0
+        partial_path = self._get_partial_path(dest)
+        if not os.path.isfile(partial_path) or os.path.getsize(partial_path) < checkpoint.get('offset', 0):
+            return 0
+        return checkpoint['offset']
+
+    def _write_checkpoint(self, dest, offset: int):
+        """
+        :param dest:
+        :param offset: the number of bytes of the partial file that are on disk
+        :return: None; atomically replace the checkpoint sidecar
+        """
+        checkpoint_path = self._get_checkpoint_path(dest)
+        with open(f"{checkpoint_path}.tmp", 'w') as f:
+            json.dump({'offset': offset, 'checksum': self.job_meta.content_meta.part_checksum}, f)
+        os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+    def _publish_progress(self, **update):
+        """
+        :param update: see ProgressPublisher.publish
+        """
+        progress_publisher.publish(self.job_meta.content_meta.archive.archive_id, self.job_meta.content_meta.part_index,
+                                   **update)
+
+    def _remove_sidecars(self, dest):
+        for sidecar_path in [self._get_partial_path(dest), self._get_checkpoint_path(dest)]:
+            if os.path.exists(sidecar_path):
+                os.remove(sidecar_path)
+
+    def _resumable_download(self, dest, hash_func=hashlib.md5) -> int:
+        """
+        :param dest: the final path of the part
+        :param hash_func:
+        :return: the number of bytes fetched from the bucket in this attempt. The part is moved to dest only if its
+        checksum matches part_checksum; otherwise the sidecars are removed and ValueError is raised
+        """
+        partial_path = self._get_partial_path(dest)
+        offset = self._read_checkpoint(dest)
+        part_checksum = self.job_meta.content_meta.part_checksum
+        part_hash = hash_func()
+
+        with open(partial_path, 'r+b' if offset else 'w+b') as f:
+            #   Bytes past the checkpoint may not have made it to disk before the previous attempt died
+            f.truncate(offset)
+            remains = f.read(self.CHUNK_SIZE)
+            while remains:
+                part_hash.update(remains)
+                remains = f.read(self.CHUNK_SIZE)
+
+            fetched = 0
+            if offset < self.job_meta.content_meta.get_size():
+                get_kwargs = {'Bucket': self._get_bucket_name(), 'Key': self._get_file_key()}
+                if offset:
+                    print(f"Resuming {self.get_source()} from byte {offset}")
+                    #   Only resume against the very object the partial file was downloaded from
+                    get_kwargs.update(Range=f"bytes={offset}-", IfMatch=f'"{part_checksum}"')
+                body = self.s3.get_object(**get_kwargs)['Body']
+                last_checkpoint = offset
+                chunk = body.read(self.CHUNK_SIZE)
+                while chunk:
+                    f.write(chunk)
+                    part_hash.update(chunk)
+                    offset += len(chunk)
+                    fetched += len(chunk)
+                    self._publish_progress(transfer={'type': 'download', 'done': offset,
+                                                     'total': self.job_meta.content_meta.get_size()})
+                    if offset - last_checkpoint >= self.CHECKPOINT_INTERVAL:
+                        f.flush()
+                        os.fsync(f.fileno())
+                        self._write_checkpoint(dest, offset)
+                        last_checkpoint = offset
+                    chunk = body.read(self.CHUNK_SIZE)
+                f.flush()
+                os.fsync(f.fileno())
+
+        if part_hash.hexdigest() != part_checksum:
+            self._remove_sidecars(dest)
+            raise ValueError(f"Downloaded {self.get_source()} fails checksum matching")
+        os.replace(partial_path, dest)
+        self._remove_sidecars(dest)
+        return fetched
+
     def get_source(self) -> str:
         """
         :return: the source of a data download job is the full S3 path including the bucket name and the id
@@ -215,11 +350,11 @@ class DataDownloadJob(DataTransferJob):
     def is_valid_job(self) -> bool:
         """
         :return: a download job is valid if and only if all of the conditions below are satisfied:
-        -   self.connection is valid and active
+        -   self.connection is valid
         -   the S3 bucket and key combination can be used to grab a valid "head" object
         -   the file part checksum is consistent
         """
-        if not (self.conn.is_active and self.conn.is_valid):
+        if not self.conn.is_valid:
             return False
         else:
             bucket_name = self._get_bucket_name()
@@ -238,25 +373,34 @@ class DataDownloadJob(DataTransferJob):
 
     def execute(self):
         """
-        Download the file part and store it in the right place
+        Download the file part into a sidecar file, resuming a previous attempt if there is one, and move it into the
+        right place once its checksum checks out
         """
         dest = self.get_dest()
         self._make_dest_dir(dest)
 
-        bucket_name = self._get_bucket_name()
-        file_key = self._get_file_key()
-
         self.job_meta.date_started = timezone.now()
         self.job_meta.save()
         try:
-            self.s3.download_file(Bucket=bucket_name,
-                                  Key=file_key,
-                                  Filename=dest)
+            transfer_start = time.monotonic()
+            fetched = self._resumable_download(dest)
+            self.conn.record_throughput(fetched, time.monotonic() - transfer_start)
             self.job_meta.status = 'completed'
-            self.job_meta.content_meta.cached = True
+            #   The part was verified before it was moved into place; remember that so it need not be hashed again
+            self.job_meta.content_meta.cache_fingerprint = get_file_fingerprint(dest)
             self.job_meta.date_completed = timezone.now()
             self.job_meta.save()
-            self.job_meta.content_meta.save()
+            self.job_meta.content_meta.save(update_fields=['cache_fingerprint'])
+            self.job_meta.content_meta.set_cached(True)
+            ArchiveChange.record(self.job_meta.content_meta.archive, "download", self.job_meta.content_meta)
+            self._publish_progress(cached=True, transfer=None)
             print(f"{self.__str__()} was successful!")
         except ClientError as ce:
+            self._publish_progress(transfer=None)
+            #   The remote object no longer matches the partial file, or the partial file is longer than the object
+            if ce.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'InvalidRange'):
+                self._remove_sidecars(dest)
             print(ce)
+        except (BotoCoreError, ValueError) as e:
+            self._publish_progress(transfer=None)
+            print(e)
@@ -10,11 +10,14 @@ from django.db.models.query import QuerySet
 from django.utils import timezone
 from django.contrib.auth.models import User
 
-from anniversary_project.settings import MEDIA_ROOT
+from anniversary_project.settings import MEDIA_ROOT, TRANSFER_JOB_RETENTION
 from s3connections.models import S3Connection
 from archive.models import Archive, ArchivePartMeta, PersistentTransferJob
-from archive.forms import ArchiveForm
+from ..assemble_archive import check_and_assemble, iter_changed_cache_archives
+from ..ingest_archives import ingest_processing_archives
+from ..evict_archives import evict_cached_archives
 from .data_transfer_job import DataUploadJob, DataDownloadJob, DataTransferJob
+from .portal_utils import compact_completed_jobs
 
 
 class HouseChore(abc.ABC):
@@ -31,90 +34,73 @@ class HouseChore(abc.ABC):
         raise NotImplementedError('house chore name not defined')
 
 
+class IngestArchives(HouseChore):
+    """
+    Finalize the archives that were uploaded through the web UI: hash them, create their parts, and queue their
+    uploads, which the workers then pick up. Shared with scripts/ingest_archives.py
+    """
+
+    def execute(self):
+        ingest_processing_archives()
+
+    def description(self):
+        return 'Hash the newly uploaded archives, create their parts, and queue their uploads'
+
+
 class SyncLocalCacheWithLocalArchive(HouseChore):
-    @classmethod
-    def check_cache_health(cls, archive_cache_dir: str, archive_id: str) -> bool:
-        """
-        :param archive_cache_dir: an archive's cache directory
-        :param archive_id:
-        :return: True if and only if the all parts are present and are in good health
-        """
-        archive = Archive.objects.get(pk=archive_id)
-        archive_parts_meta = ArchivePartMeta.objects.filter(archive=archive)
-        ready_for_assembly = True
-        for archive_part_meta in archive_parts_meta:
-            cache_part_file_path = os.path.join(archive_cache_dir, str(archive_part_meta.part_index))
-            if not (os.path.exists(cache_part_file_path) and os.path.isfile(cache_part_file_path)):
-                #   If the desired path doesn't point to an existing file, then the archive is not ready for assembly
-                ready_for_assembly = False
-            else:
-                cache_part_file_checksum = ArchiveForm.get_file_checksum(file_path=cache_part_file_path)
-                if cache_part_file_checksum != archive_part_meta.part_checksum:
-                    #   If the file part's checksum does not check out, then remove the file part
-                    print(f"Corrupted file part at {cache_part_file_path}")
-                    os.remove(cache_part_file_path)
-                    archive_part_meta.cached = False
-                else:
-                    archive_part_meta.cached = True
-                archive_part_meta.save()
-
-        return ready_for_assembly
-
-    @classmethod
-    def assemble_archive(cls, username, archive_id):
-        """
-        :param username:
-        :param archive_id:
-        :return: read in the parts in cache directory and write all bytes in a single swoop to the archive directory
-        """
-        cache_dir = os.path.join(MEDIA_ROOT, 'cache', username, archive_id)
-        archive_dir = os.path.join(MEDIA_ROOT, 'archives', username, archive_id)
-        #   Delete archive_dir and remake it
-        shutil.rmtree(path=archive_dir)
-        os.makedirs(archive_dir)
-        #   Sort the file parts numerically by the index
-        file_part_names = os.listdir(cache_dir)
-        file_part_names.sort(key=lambda x: int(x))
-        #   Find the original file name
-        archive: Archive = Archive.objects.get(pk=archive_id)
-        archive_file_name = os.path.basename(archive.archive_file.name)
-        archive_file_path = os.path.join(archive_dir, archive_file_name)
-        #   Start writing in batches:
-        with open(archive_file_path, 'ab') as f:
-            for file_part_name in file_part_names:
-                file_part_path = os.path.join(cache_dir, file_part_name)
-                with open(file_part_path, 'rb') as p:
-                    f.write(p.read())
-        #   Confirm the checksum
-        written_checksum = ArchiveForm.get_file_checksum(file_path=archive_file_path)
-        if written_checksum == archive.archive_file_checksum:
-            print(f"Successfully assembled archive at {archive_file_path}")
-            archive.cached = True
-            archive.save()
-            shutil.rmtree(cache_dir)
-        else:
-            print(f"Oh oh something went wrong")
+    """
+    Check the health of the parts in the local cache, and assemble the archives whose parts are all present. The
+    checking and the assembling are shared with scripts/assemble_archive.py
+    """
 
     def execute(self):
         """
-        Check integrity of local cache and assemble them into complete archive if all of them are in good health
+        Check integrity of local cache and assemble them into complete archive if all of them are in good health.
+        Only the archives whose cache directory changed since they were last checked are visited
         """
-        cache_dir = os.path.join(MEDIA_ROOT, 'cache')
-        if not (os.path.exists(cache_dir) and os.path.isdir(cache_dir)):
-            pass
-        else:
-            for username in os.listdir(cache_dir):
-                user_cache_dir = os.path.join(cache_dir, username)
-                for archive_id in os.listdir(user_cache_dir):
-                    archive_cache_dir = os.path.join(user_cache_dir, archive_id)
-                    ready_for_assembly = self.check_cache_health(archive_cache_dir, archive_id)
-                    if ready_for_assembly:
-                        self.assemble_archive(username, archive_id)
+        for archive in iter_changed_cache_archives():
+            check_and_assemble(archive)
 
     def description(self):
         return 'Synchronize among local cache directory, local archive directory, and the relevant DB instances'
 
 
+class EvictCachedArchives(HouseChore):
+    """
+    Keep the local archive files within their disk budget by evicting the least recently accessed archives that are
+    fully uploaded. Shared with scripts/evict_archives.py
+    """
+
+    def execute(self):
+        freed = evict_cached_archives()
+        if freed:
+            print(f"Evicted {freed} bytes of cached archives")
+
+    def description(self):
+        return 'Evict the least recently accessed cached archives once the disk budget is exceeded'
+
+
+class CompactCompletedJobs(HouseChore):
+    """
+    Move the completed transfer jobs that are older than TRANSFER_JOB_RETENTION into the job history, so that the
+    queue that the workers poll stays small
+    """
+
+    def execute(self):
+        compacted = compact_completed_jobs(retention=TRANSFER_JOB_RETENTION)
+        if compacted:
+            print(f"Compacted {compacted} completed transfer jobs")
+
+    def description(self):
+        return 'Move old completed transfer jobs out of the queue and into the job history'
+
+
 def clean_the_house():
+    print(f"{IngestArchives().description()}")
+    IngestArchives().execute()
     print(f"{SyncLocalCacheWithLocalArchive().description()}")
     SyncLocalCacheWithLocalArchive().execute()
+    print(f"{EvictCachedArchives().description()}")
+    EvictCachedArchives().execute()
+    print(f"{CompactCompletedJobs().description()}")
+    CompactCompletedJobs().execute()
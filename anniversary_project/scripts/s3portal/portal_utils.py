@@ -1,12 +1,19 @@
 import typing as ty
 import os
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
+from django import db
+from django.db import transaction
 from django.db.models.query import QuerySet
+from django.utils import timezone
 from botocore.errorfactory import ClientError
 
 from anniversary_project.settings import MEDIA_ROOT
 from s3connections.models import S3Connection
-from archive.models import Archive, ArchivePartMeta, PersistentTransferJob
+from s3connections.utils import get_placement_conns
+from archive.models import Archive, ArchivePartMeta, ArchivePartTable, PersistentTransferJob, \
+    PersistentTransferJobHistory
 from .data_transfer_job import DataUploadJob, DataDownloadJob, DataTransferJob
 
 
@@ -30,39 +37,146 @@ def get_scheduled_jobs() -> ty.Optional[QuerySet]:
     return PersistentTransferJob.objects.filter(status='scheduled')
 
 
-def initialize_job_queue(active_conn: S3Connection,
+def claim_jobs(scheduled_jobs: QuerySet, worker_id: str, batch_size: int) -> QuerySet:
+    """
+    :param scheduled_jobs: QuerySet of PersistentTransferJob objects whose status is 'scheduled'
+    :param worker_id: the id of the worker claiming the jobs
+    :param batch_size: the maximal number of jobs to claim
+    :return: the jobs that this worker managed to claim, oldest first. A job is claimed with a conditional UPDATE, so
+    that two workers polling the same queue can never both claim it
+    """
+    claimed_job_ids = list()
+    for job_id in scheduled_jobs.order_by('date_created').values_list('pk', flat=True)[:batch_size * 4]:
+        claimed = PersistentTransferJob.objects.filter(pk=job_id, status='scheduled').update(status='running',
+                                                                                              worker_id=worker_id)
+        if claimed:
+            claimed_job_ids.append(job_id)
+            if len(claimed_job_ids) == batch_size:
+                break
+    return PersistentTransferJob.objects.filter(pk__in=claimed_job_ids).order_by('date_created')
+
+
+def release_jobs(worker_id: str) -> int:
+    """
+    :param worker_id:
+    :return: the number of jobs that were claimed by this worker but not completed, which are now put back in the
+    queue
+    """
+    return PersistentTransferJob.objects.filter(status='running', worker_id=worker_id).update(status='scheduled',
+                                                                                              worker_id=None)
+
+
+def get_part_conn(archive_part_meta: ArchivePartMeta,
+                  active_conn: ty.Optional[S3Connection]) -> ty.Optional[S3Connection]:
+    """
+    :param archive_part_meta:
+    :param active_conn:
+    :return: the connection the part is placed on; parts that have not been placed yet go to the active connection
+    """
+    return archive_part_meta.connection or active_conn
+
+
+def initialize_job_queue(active_conn: ty.Optional[S3Connection],
                          scheduled_jobs: ty.Iterable[PersistentTransferJob]) -> ty.Iterable[DataTransferJob]:
     """
-    :param active_conn: an S3Connectin object whose .is_active is True
+    :param active_conn: an S3Connectin object whose .is_active is True, or None
     :param scheduled_jobs: QuerySet of PersistentTransferJob objects
     :return: Scan through the QuerySet and for each one of the scheduled jobs, instantiate the appropriate
-    DataTransferJob and put it in a list
+    DataTransferJob against the connection its part is placed on, and put it in a list. The jobs of the same
+    connection share a single S3Connection instance
     """
     job_queue = list()
-    for scheduled_job in scheduled_jobs:
-        if scheduled_job.transfer_type == 'upload':
-            job_queue.append(DataUploadJob(conn=active_conn, job_meta=scheduled_job))
+    conns = dict()
+    for scheduled_job in scheduled_jobs.select_related('content_meta__connection', 'content_meta__archive__owner'):
+        conn = get_part_conn(scheduled_job.content_meta, active_conn)
+        if conn:
+            conn = conns.setdefault(conn.connection_id, conn)
+        if (not conn) or (not conn.is_valid):
+            print(f"job {scheduled_job.pk} has no valid connection to transfer with")
+        elif scheduled_job.transfer_type == 'upload':
+            job_queue.append(DataUploadJob(conn=conn, job_meta=scheduled_job))
         elif scheduled_job.transfer_type == 'download':
-            job_queue.append(DataDownloadJob(conn=active_conn, job_meta=scheduled_job))
+            job_queue.append(DataDownloadJob(conn=conn, job_meta=scheduled_job))
         else:
             print(f"job {scheduled_job.pk} is neither upload nor download")
 
     return job_queue
 
 
+def execute_job_queue(job_queue: ty.Iterable[DataTransferJob], should_stop: ty.Callable[[], bool] = lambda: False):
+    """
+    :param job_queue: a list of DataTransferJob
+    :param should_stop: called before each job; once it returns True, the jobs that have not started are skipped
+    :return: None; execute the jobs, running the jobs of different connections in parallel with each other and the
+    jobs of the same connection one after another
+    """
+    def execute_conn_jobs(conn_jobs):
+        try:
+            for job in conn_jobs:
+                if should_stop():
+                    break
+                job.execute()
+        finally:
+            #   The pool's threads are not Django's request threads, so nothing else closes their connections
+            db.connection.close()
+
+    def conn_id(job):
+        return job.conn.connection_id
+
+    conn_job_groups = [list(conn_jobs) for _, conn_jobs in itertools.groupby(sorted(job_queue, key=conn_id),
+                                                                              key=conn_id)]
+    if not conn_job_groups:
+        return
+    with ThreadPoolExecutor(max_workers=len(conn_job_groups)) as executor:
+        for future in [executor.submit(execute_conn_jobs, conn_jobs) for conn_jobs in conn_job_groups]:
+            future.result()
+
+
+def get_remote_conns(active_conn: ty.Optional[S3Connection]) -> ty.Dict[str, S3Connection]:
+    """
+    :param active_conn:
+    :return: every valid connection that archive parts are, or will be, placed on, by connection_id
+    """
+    placed_conn_ids = set(ArchivePartMeta.objects.exclude(connection=None).values_list('connection_id', flat=True))
+    for part_table in ArchivePartTable.objects.only('connection_ids'):
+        placed_conn_ids.update(part_table.get_connection_ids())
+    conns = {conn.connection_id: conn
+             for conn in S3Connection.objects.filter(pk__in=placed_conn_ids, is_valid=True)}
+    for conn in get_placement_conns() + ([active_conn] if active_conn else []):
+        conns[conn.connection_id] = conn
+    return conns
+
+
+def list_remote_objects(conn: S3Connection, prefix: str = '') -> ty.Dict[str, ty.Tuple[str, int]]:
+    """
+    :param conn:
+    :param prefix: only list the keys that start with prefix
+    :return: a map from each key in the connection's bucket to its ETag (checksum) and size, built from paginated
+    ListObjectsV2 calls that return up to 1000 keys each
+    """
+    s3 = conn.get_client('s3')
+    remote_objects = dict()
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=conn.connection_id, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            #   ETag is wrapped in double quotes
+            remote_objects[obj['Key']] = (obj['ETag'][1:-1], obj['Size'])
+    return remote_objects
+
+
 def has_remote(archive_part_meta: ArchivePartMeta, active_conn: S3Connection) -> bool:
     """
     :param archive_part_meta:
-    :param active_conn:
+    :param active_conn: the connection to fall back to if the part has not been placed on one
     :return: return True if and only if the corresponding remote part exists
     """
     username = archive_part_meta.archive.owner.username
     archive_id = archive_part_meta.archive.archive_id
     part_index = archive_part_meta.part_index
     file_key = f"{username}/{archive_id}/{part_index}"
-    s3 = active_conn.get_client('s3')
+    conn = get_part_conn(archive_part_meta, active_conn)
+    s3 = conn.get_client('s3')
     try:
-        response = s3.head_object(Bucket=active_conn.connection_id,
+        response = s3.head_object(Bucket=conn.connection_id,
                                   Key=file_key)
         return True
     except ClientError as ce:
@@ -73,23 +187,27 @@ def remove_remote(archive_part_meta: ArchivePartMeta, active_conn: S3Connection)
     """
     :param archive_part_meta:
     :param active_conn:
-    :return: return the file key if the deletion if successful
+    :return: True if and only if the deletion is successful
     """
-    username = archive_part_meta.archive.owner.username
-    archive_id = archive_part_meta.archive.archive_id
-    part_index = archive_part_meta.part_index
-    file_key = f"{username}/{archive_id}/{part_index}"
-    s3 = active_conn.get_client('s3')
-    try:
-        response = s3.head_object(Bucket=active_conn.connection_id,
-                                  Key=file_key)
-        #   ETag is wrapped in double quotes
-        remote_checksum = response['ETag'][1:-1]
-        response = s3.delete_object(Bucket=active_conn.connection_id,
-                                    Key=file_key)
-        #   DELETE!
-    except ClientError as ce:
-        return False
+    return not remove_remotes([archive_part_meta], active_conn)
+
+
+def remove_remotes(archive_parts_meta: ty.Iterable[ArchivePartMeta],
+                   active_conn: ty.Optional[S3Connection]) -> ty.Dict[str, str]:
+    """
+    :param archive_parts_meta:
+    :param active_conn: the connection to fall back to for the parts that have not been placed on one
+    :return: the remote keys that could not be deleted, each mapped to the reason why. The keys are grouped by the
+    connection their parts are placed on and deleted with batched DeleteObjects requests
+    """
+    conn_keys = dict()
+    for archive_part_meta in archive_parts_meta:
+        conn = get_part_conn(archive_part_meta, active_conn)
+        conn_keys.setdefault(conn.connection_id, (conn, list()))[1].append(archive_part_meta.get_remote_key())
+    failures = dict()
+    for conn, keys in conn_keys.values():
+        failures.update(conn.delete_keys(keys))
+    return failures
 
 
 def get_remote_checksum(archive_part_meta: ArchivePartMeta, active_conn: S3Connection) -> ty.Optional[str]:
@@ -102,9 +220,10 @@ def get_remote_checksum(archive_part_meta: ArchivePartMeta, active_conn: S3Conne
     archive_id = archive_part_meta.archive.archive_id
     part_index = archive_part_meta.part_index
     file_key = f"{username}/{archive_id}/{part_index}"
-    s3 = active_conn.get_client('s3')
+    conn = get_part_conn(archive_part_meta, active_conn)
+    s3 = conn.get_client('s3')
     try:
-        response = s3.head_object(Bucket=active_conn.connection_id,
+        response = s3.head_object(Bucket=conn.connection_id,
                                   Key=file_key)
         #   ETag is wrapped in double quotes
         remote_checksum = response['ETag'][1:-1]
@@ -146,7 +265,7 @@ def queue_upload(archive_part_meta: ArchivePartMeta):
     """
     #   First check if upload job of this archive_part_meta already exists
     existing_job = PersistentTransferJob.objects.filter(content_meta=archive_part_meta,
-                                                        status='scheduled')
+                                                        status__in=['scheduled', 'running'])
     if len(existing_job) == 0:
         #   If the QuerySet above is empty, then schedule a new job
         upload_job = PersistentTransferJob(content_meta=archive_part_meta,
@@ -156,6 +275,18 @@ def queue_upload(archive_part_meta: ArchivePartMeta):
         print(f"Queued job: {upload_job}")
 
 
+def queue_uploads(archive_parts_meta: ty.Iterable[ArchivePartMeta]) -> ty.List[PersistentTransferJob]:
+    """
+    :param archive_parts_meta:
+    :return: the upload jobs created, in bulk, for the parts that don't have a scheduled or running job already
+    """
+    busy_part_ids = set(PersistentTransferJob.objects.filter(status__in=['scheduled', 'running'])
+                        .values_list('content_meta_id', flat=True))
+    upload_jobs = [PersistentTransferJob(content_meta=archive_part_meta, transfer_type='upload', status='scheduled')
+                   for archive_part_meta in archive_parts_meta if archive_part_meta.pk not in busy_part_ids]
+    return PersistentTransferJob.objects.bulk_create(upload_jobs)
+
+
 def reset_s3_connection():
     """
     If there is an active connection, then reset its bucket;
@@ -176,3 +307,32 @@ def reset_s3_connection():
         active_conn.save()
     active_conn.reset_bucket()
 
+
+def compact_completed_jobs(retention: int, batch_size: int = 1000) -> int:
+    """
+    :param retention: the number of seconds for which completed jobs are kept in the queue
+    :param batch_size: the number of jobs moved per transaction
+    :return: the number of completed jobs moved from PersistentTransferJob into PersistentTransferJobHistory
+    """
+    cutoff = timezone.now() - timezone.timedelta(seconds=retention)
+    compacted = 0
+    while True:
+        with transaction.atomic():
+            completed_jobs = list(PersistentTransferJob.objects
+                                  .filter(status='completed', date_completed__lt=cutoff)
+                                  .select_related('content_meta__archive__owner')[:batch_size])
+            if not completed_jobs:
+                return compacted
+            PersistentTransferJobHistory.objects.bulk_create([
+                PersistentTransferJobHistory(archive_id=job.content_meta.archive.archive_id,
+                                             username=job.content_meta.archive.owner.username,
+                                             part_index=job.content_meta.part_index,
+                                             transfer_type=job.transfer_type,
+                                             worker_id=job.worker_id,
+                                             date_created=job.date_created,
+                                             date_started=job.date_started,
+                                             date_completed=job.date_completed)
+                for job in completed_jobs
+            ])
+            PersistentTransferJob.objects.filter(pk__in=[job.pk for job in completed_jobs]).delete()
+        compacted += len(completed_jobs)
@@ -0,0 +1,196 @@
+"""
+# The s3portal supervisor
+Run N s3portal workers as child processes that share the PersistentTransferJob queue:
+
+    python -m scripts.s3portal.supervisor --workers 4
+
+-   Workers claim jobs atomically, so no job is transferred twice
+-   A worker that dies is restarted, and the jobs it had claimed go back to the queue
+-   On SIGTERM or SIGINT, every worker is asked to finish the transfers in flight; workers that are still busy after
+    the drain deadline are killed, and their unfinished jobs go back to the queue
+-   The state of every worker is printed every status interval, and on SIGUSR1
+"""
+import os
+import time
+import queue
+import signal
+import argparse
+import threading
+import multiprocessing as mp
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'anniversary_project.settings')
+django.setup()
+
+from django import db
+from django.utils import timezone
+
+from .portal_utils import release_jobs
+from .worker import get_worker_id, run_worker
+
+
+def worker_main(worker_id: str, heart_beat: int, house_keeper: bool, status_queue: mp.Queue):
+    """
+    The entry point of each worker process
+    """
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    def report(state: str, detail: str):
+        status_queue.put((worker_id, os.getpid(), state, detail, timezone.now()))
+
+    run_worker(worker_id, heart_beat=heart_beat, stop_event=stop_event, report=report, house_keeper=house_keeper)
+    db.connections.close_all()
+
+
+class WorkerSlot:
+    """
+    One of the N places in the pool; the worker process in it is replaced whenever it dies
+    """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.worker_id = get_worker_id(f"worker-{index}")
+        self.process: mp.Process = None
+        self.started_at = None
+        self.restarts = 0
+        self.state = 'starting'
+        self.detail = ''
+        self.date_reported = None
+
+    def __str__(self):
+        pid = self.process.pid if self.process else None
+        return f"{self.worker_id} (PID {pid}, restarts {self.restarts}): {self.state} {self.detail}".strip()
+
+
+class Supervisor:
+
+    def __init__(self, num_workers: int, heart_beat: int = 10, drain_deadline: int = 60, status_interval: int = 60,
+                 restart_backoff: int = 5):
+        """
+        :param num_workers: the number of worker processes
+        :param heart_beat: the number of seconds each worker stays idle for, for each empty cycle
+        :param drain_deadline: the number of seconds workers have to finish their transfers after SIGTERM
+        :param status_interval: the number of seconds between status reports
+        :param restart_backoff: the minimal number of seconds between two starts of the same slot
+        """
+        self.slots = [WorkerSlot(index) for index in range(num_workers)]
+        self.heart_beat = heart_beat
+        self.drain_deadline = drain_deadline
+        self.status_interval = status_interval
+        self.restart_backoff = restart_backoff
+        self.status_queue = mp.Queue()
+        self.stop_event = threading.Event()
+        self.status_requested = threading.Event()
+
+    def start_worker(self, slot: WorkerSlot):
+        #   Forked children must not share the parent's database connections
+        db.connections.close_all()
+        slot.process = mp.Process(target=worker_main,
+                                  kwargs={'worker_id': slot.worker_id,
+                                          'heart_beat': self.heart_beat,
+                                          #   Only one worker assembles archives, so that two never race on it
+                                          'house_keeper': slot.index == 0,
+                                          'status_queue': self.status_queue},
+                                  name=slot.worker_id)
+        slot.process.start()
+        slot.started_at = time.monotonic()
+        slot.state = 'starting'
+        slot.detail = ''
+        print(f"Started {slot}")
+
+    def restart_dead_workers(self):
+        for slot in self.slots:
+            if slot.process.is_alive():
+                continue
+            if time.monotonic() - slot.started_at < self.restart_backoff:
+                #   Don't spin on a worker that dies right after it starts
+                continue
+            print(f"{slot} exited with code {slot.process.exitcode}")
+            slot.process.close()
+            released = release_jobs(slot.worker_id)
+            if released:
+                print(f"Put {released} unfinished jobs of {slot.worker_id} back in the queue")
+            slot.restarts += 1
+            self.start_worker(slot)
+
+    def collect_reports(self, timeout: float):
+        """
+        :param timeout: the number of seconds to wait for the first report
+        :return: None; update the slots with the reports that the workers have sent
+        """
+        slots = {slot.worker_id: slot for slot in self.slots}
+        try:
+            report = self.status_queue.get(timeout=timeout)
+            while True:
+                worker_id, pid, state, detail, date_reported = report
+                slot = slots[worker_id]
+                if slot.process and slot.process.pid == pid:
+                    slot.state, slot.detail, slot.date_reported = state, detail, date_reported
+                report = self.status_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def print_status(self):
+        print(f"s3portal supervisor status at {timezone.now()}:")
+        for slot in self.slots:
+            print(f"    {slot}, last reported at {slot.date_reported}")
+
+    def drain(self):
+        """
+        Ask every worker to stop, wait for them until the drain deadline, then kill the ones that are still running
+        """
+        print(f"Draining workers within {self.drain_deadline} seconds")
+        for slot in self.slots:
+            if slot.process.is_alive():
+                slot.process.terminate()
+        deadline = time.monotonic() + self.drain_deadline
+        for slot in self.slots:
+            slot.process.join(timeout=max(0.0, deadline - time.monotonic()))
+            if slot.process.is_alive():
+                print(f"{slot} did not drain in time and will be killed")
+                slot.process.kill()
+                slot.process.join()
+            released = release_jobs(slot.worker_id)
+            if released:
+                print(f"Put {released} unfinished jobs of {slot.worker_id} back in the queue")
+        self.collect_reports(timeout=0)
+        self.print_status()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop_event.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop_event.set())
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.status_requested.set())
+
+        for slot in self.slots:
+            self.start_worker(slot)
+        last_status = time.monotonic()
+        while not self.stop_event.is_set():
+            self.collect_reports(timeout=1)
+            self.restart_dead_workers()
+            if self.status_requested.is_set() or time.monotonic() - last_status >= self.status_interval:
+                self.status_requested.clear()
+                self.print_status()
+                last_status = time.monotonic()
+        self.drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a supervised pool of s3portal workers')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='the number of worker processes')
+    parser.add_argument('--heart-beat', type=int, default=10, help='seconds to stay idle for, for each empty cycle')
+    parser.add_argument('--drain-deadline', type=int, default=60,
+                        help='seconds that workers have to finish their transfers after SIGTERM')
+    parser.add_argument('--status-interval', type=int, default=60, help='seconds between status reports')
+    args = parser.parse_args()
+    Supervisor(num_workers=args.workers,
+               heart_beat=args.heart_beat,
+               drain_deadline=args.drain_deadline,
+               status_interval=args.status_interval).run()
+
+
+if __name__ == '__main__':
+    main()
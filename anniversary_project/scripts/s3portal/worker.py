@@ -0,0 +1,70 @@
+import socket
+import threading
+import typing as ty
+
+from django.db.models.query import QuerySet
+
+from s3connections.models import S3Connection
+from s3connections.utils import get_placement_conns
+from .portal_utils import get_active_conn, get_scheduled_jobs, claim_jobs, release_jobs, initialize_job_queue, \
+    execute_job_queue
+from .house_chores import clean_the_house
+
+
+def get_worker_id(name: str = 'main') -> str:
+    """
+    :param name: the name of the worker on this host
+    :return: the id that the worker claims jobs under. It does not include the PID, so that a restarted worker can
+    take back the jobs its predecessor left behind
+    """
+    return f"{socket.gethostname()}:{name}"
+
+
+def run_worker(worker_id: str,
+               heart_beat: int = 10,
+               batch_size: int = 8,
+               stop_event: ty.Optional[threading.Event] = None,
+               report: ty.Callable[[str, str], None] = lambda state, detail: None,
+               house_keeper: bool = True):
+    """
+    :param worker_id: the id that jobs are claimed under
+    :param heart_beat: the number of seconds to stay idle for, for each empty cycle
+    :param batch_size: the maximal number of jobs to claim in each cycle
+    :param stop_event: once set, the worker finishes the transfers in flight, puts the jobs it has not started back
+    in the queue, and returns
+    :param report: called with the worker's state and a short detail whenever the state changes
+    :param house_keeper: if True, then clean the house after each cycle. When several workers share the queue, only
+    one of them should do it
+    """
+    stop_event = stop_event or threading.Event()
+    #   Take back whatever a previous worker with the same id left behind
+    release_jobs(worker_id)
+    while not stop_event.is_set():
+        active_conn: S3Connection = get_active_conn()
+        scheduled_jobs: QuerySet = get_scheduled_jobs()
+
+        #   If there is no usable connection or there is no job to execute, then print respective message
+        #   and sleep for a cycle
+        if (not (active_conn or get_placement_conns())) or (not scheduled_jobs.exists()):
+            print("No active connection found" if (not active_conn) else "No scheduled jobs found")
+            print(f"Sleep for {heart_beat} seconds")
+            report('sleeping', '')
+            stop_event.wait(heart_beat)
+        else:
+            #   There is an active connection and there are one or more scheduled jobs
+            claimed_jobs = claim_jobs(scheduled_jobs, worker_id, batch_size)
+            job_queue = initialize_job_queue(active_conn, claimed_jobs)
+            print(f"{len(job_queue)} jobs found")
+            report('transferring', f"{len(job_queue)} jobs")
+            try:
+                execute_job_queue(job_queue, should_stop=stop_event.is_set)
+            finally:
+                release_jobs(worker_id)
+            if not job_queue:
+                #   Other workers got to the jobs first
+                stop_event.wait(heart_beat)
+        #   After each cycle, clean the house
+        if house_keeper and not stop_event.is_set():
+            report('cleaning', '')
+            clean_the_house()
+    report('stopped', '')
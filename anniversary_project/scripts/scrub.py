@@ -0,0 +1,266 @@
+import os
+import math
+import time
+import hashlib
+import typing as ty
+
+from botocore.errorfactory import ClientError
+from botocore.exceptions import BotoCoreError
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from anniversary_project.settings import MEDIA_ROOT, SCRUB_INTERVAL, SCRUB_PERIOD, SCRUB_REQUEST_BUDGET, \
+    SCRUB_REQUESTS_PER_SECOND, SCRUB_BYTE_BUDGET, SCRUB_BYTES_PER_SECOND
+from archive.models import Archive, ArchiveChange, ArchivePartMeta, ArchivePartTable, PartRef, PersistentTransferJob, \
+    get_file_fingerprint
+from s3connections.models import S3Connection
+from .s3portal.portal_utils import get_active_conn, get_part_conn, queue_uploads
+
+
+CHUNK_SIZE = 2 ** 20
+#   The error codes with which S3 reports that an object does not exist; any other error says nothing about the object
+MISSING_OBJECT_ERROR_CODES = {'404', 'NoSuchKey', 'NotFound'}
+
+
+class RateLimiter:
+    """
+    Pace a sequence of operations so that no more than rate units (requests, bytes) are spent per second on average
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.spent = 0
+
+    def spend(self, amount: float):
+        """
+        :param amount: the number of units about to be spent
+        :return: None; sleep for as long as spending amount more units would exceed the rate
+        """
+        self.spent += amount
+        delay = self.spent / self.rate - (time.monotonic() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_slice_size(total: int, budget: int) -> int:
+    """
+    :param total: the number of units (parts, bytes) to verify once every SCRUB_PERIOD seconds
+    :param budget: the maximal number of units to verify in a single run
+    :return: the number of units to verify in this run so that, running every SCRUB_INTERVAL seconds, all of them are
+    verified once every SCRUB_PERIOD seconds, without exceeding the budget
+    """
+    return min(budget, math.ceil(total * SCRUB_INTERVAL / SCRUB_PERIOD))
+
+
+def verify_remote_part(archive_part, conn: S3Connection, clients: dict, limiter: RateLimiter,
+                       logger=print) -> ty.Optional[bool]:
+    """
+    :param archive_part: an ArchivePartMeta, or a PartRef of a packed archive
+    :param conn: the connection the part is placed on
+    :param clients: the S3 clients made so far, by connection_id; the connection's client is added if it is missing
+    :param limiter: the limiter that paces the HEAD requests
+    :param logger:
+    :return: whether the part's remote object exists and matches the part's checksum and size, or None if the
+    request failed for another reason than the object missing, which says nothing about the object
+    """
+    if conn.connection_id not in clients:
+        clients[conn.connection_id] = conn.get_client('s3')
+    limiter.spend(1)
+    try:
+        response = clients[conn.connection_id].head_object(Bucket=conn.connection_id,
+                                                           Key=archive_part.get_remote_key())
+        #   ETag is wrapped in double quotes
+        remote_object = (response['ETag'][1:-1], response['ContentLength'])
+    except ClientError as e:
+        if e.response.get('Error', dict()).get('Code') not in MISSING_OBJECT_ERROR_CODES:
+            logger(f"Failed to verify {archive_part}'s remote: {e}")
+            return None
+        remote_object = None
+    except BotoCoreError as e:
+        logger(f"Failed to verify {archive_part}'s remote: {e}")
+        return None
+    return remote_object == (archive_part.part_checksum, archive_part.get_size())
+
+
+def scrub_part_rows(slice_size: int, active_conn: ty.Optional[S3Connection], clients: dict, limiter: RateLimiter,
+                    logger=print) -> int:
+    """
+    :param slice_size: the number of parts to verify
+    :param active_conn:
+    :param clients: see verify_remote_part
+    :param limiter:
+    :param logger:
+    :return: the number of parts verified; verify the ArchivePartMeta rows that were verified least recently. A part
+    whose remote object is missing or fails checksum matching is no longer "uploaded", and is uploaded again if the
+    archive file exists locally. Parts that are being uploaded right now are left for the next run
+    """
+    uploading_part_ids = set(PersistentTransferJob.objects.filter(status='running', transfer_type='upload')
+                             .values_list('content_meta_id', flat=True))
+    archive_parts_meta = ArchivePartMeta.objects.select_related('archive__owner', 'connection')\
+        .order_by(F('date_last_verified').asc(nulls_first=True), 'pk')[:slice_size]
+
+    verified_parts, parts_to_upload = list(), list()
+    for archive_part_meta in archive_parts_meta:
+        conn = get_part_conn(archive_part_meta, active_conn)
+        if (not conn) or archive_part_meta.pk in uploading_part_ids:
+            continue
+        is_healthy = verify_remote_part(archive_part_meta, conn, clients, limiter, logger)
+        if is_healthy is None:
+            continue
+        if archive_part_meta.uploaded and not is_healthy:
+            logger(f"{archive_part_meta}'s remote is missing or fails checksum matching")
+            archive_file_path = os.path.join(MEDIA_ROOT, archive_part_meta.archive.archive_file.name)
+            if os.path.isfile(archive_file_path):
+                parts_to_upload.append(archive_part_meta)
+        #   Written right away rather than at the end of the run, which can last minutes, so that an upload that
+        #   finishes in the meantime isn't overwritten
+        if archive_part_meta.uploaded != is_healthy:
+            archive_part_meta.set_uploaded(is_healthy)
+        archive_part_meta.date_last_verified = timezone.now()
+        verified_parts.append(archive_part_meta)
+
+    ArchivePartMeta.objects.bulk_update(verified_parts, ['date_last_verified'], batch_size=500)
+    upload_jobs = queue_uploads(parts_to_upload)
+    logger(f"Verified {len(verified_parts)} remote parts and queued {len(upload_jobs)} upload jobs")
+    return len(verified_parts)
+
+
+def scrub_part_tables(slice_size: int, active_conn: ty.Optional[S3Connection], clients: dict, limiter: RateLimiter,
+                      logger=print) -> int:
+    """
+    :param slice_size: the number of parts to verify
+    :param active_conn:
+    :param clients: see verify_remote_part
+    :param limiter:
+    :param logger:
+    :return: the number of parts verified; verify the parts of the packed archives, through PartRef, starting with the
+    tables that were verified least recently and, within each table, where the previous run left off. Each table's
+    "uploaded" bitmap is written at most twice. Packed archives have no transfer jobs, so a packed archive with parts
+    that are not healthy anymore is unpacked, like in sync_remote_to_db, and their uploads queued if the archive file
+    exists locally
+    """
+    conns = {conn.connection_id: conn for conn in S3Connection.objects.all()}
+    part_tables = ArchivePartTable.objects.select_related('archive__owner')\
+        .order_by(F('date_last_verified').asc(nulls_first=True), 'pk')
+    verified = 0
+    for part_table in part_tables.iterator():
+        if verified >= slice_size:
+            break
+        num_parts = part_table.get_num_parts()
+        part_indices = [(part_table.next_part_to_verify + offset) % num_parts
+                        for offset in range(min(num_parts, slice_size - verified))]
+        healthy_part_indices, unhealthy_part_indices = list(), list()
+        for part_index in part_indices:
+            part = PartRef(part_table, part_index)
+            conn = conns.get(part.connection_id) if part.connection_id else active_conn
+            if not conn:
+                continue
+            is_healthy = verify_remote_part(part, conn, clients, limiter, logger)
+            if is_healthy is None:
+                continue
+            if part.uploaded and not is_healthy:
+                logger(f"{part}'s remote is missing or fails checksum matching")
+            (healthy_part_indices if is_healthy else unhealthy_part_indices).append(part_index)
+        verified += len(healthy_part_indices) + len(unhealthy_part_indices)
+        part_table.set_state('uploaded', healthy_part_indices, True)
+        part_table.set_state('uploaded', unhealthy_part_indices, False)
+        ArchivePartTable.objects.filter(pk=part_table.pk).update(
+            next_part_to_verify=(part_indices[-1] + 1) % num_parts, date_last_verified=timezone.now())
+        archive = part_table.archive
+        if unhealthy_part_indices and os.path.isfile(os.path.join(MEDIA_ROOT, archive.archive_file.name)):
+            part_table.unpack()
+            upload_jobs = queue_uploads(archive.archivepartmeta_set.filter(part_index__in=unhealthy_part_indices))
+            logger(f"Unpacked {archive} and queued {len(upload_jobs)} upload jobs")
+    logger(f"Verified {verified} remote parts of packed archives")
+    return verified
+
+
+def scrub_remote_parts(logger=print) -> int:
+    """
+    :param logger:
+    :return: the number of parts verified; check the remote object of the parts that were verified least recently
+    with a HEAD request each, paced to SCRUB_REQUESTS_PER_SECOND and no more than SCRUB_REQUEST_BUDGET of them. The
+    slice is shared between the ArchivePartMeta rows and the packed archives' parts in proportion to their numbers
+    """
+    active_conn = get_active_conn()
+    num_part_rows = ArchivePartMeta.objects.count()
+    num_packed_parts = ArchivePartTable.objects.aggregate(parts=Sum('archive__parts_total'))['parts'] or 0
+    slice_size = get_slice_size(num_part_rows + num_packed_parts, SCRUB_REQUEST_BUDGET)
+    rows_slice_size = math.ceil(slice_size * num_part_rows / (num_part_rows + num_packed_parts)) if slice_size else 0
+
+    limiter = RateLimiter(SCRUB_REQUESTS_PER_SECOND)
+    clients = dict()
+    return scrub_part_rows(rows_slice_size, active_conn, clients, limiter, logger) + \
+        scrub_part_tables(slice_size - rows_slice_size, active_conn, clients, limiter, logger)
+
+
+def hash_file(file_path: str, limiter: RateLimiter, hash_func=hashlib.md5) -> str:
+    """
+    :param file_path:
+    :param limiter: the limiter that paces the reads
+    :param hash_func:
+    :return: the hex digest of the file, read in chunks of CHUNK_SIZE bytes
+    """
+    file_hash = hash_func()
+    with open(file_path, 'rb') as f:
+        chunk = bytearray(CHUNK_SIZE)
+        view = memoryview(chunk)
+        while True:
+            limiter.spend(CHUNK_SIZE)
+            size = f.readinto(chunk)
+            if not size:
+                break
+            file_hash.update(view[:size])
+    return file_hash.hexdigest()
+
+
+def scrub_local_archives(logger=print) -> int:
+    """
+    :param logger:
+    :return: the number of bytes verified; hash the cached archive files that were verified least recently, paced to
+    SCRUB_BYTES_PER_SECOND and stopping once the run's share of the cached bytes, or SCRUB_BYTE_BUDGET, has been
+    read. The checksums are remembered along with the files' fingerprints (see Archive.get_local_checksum)
+    """
+    cached_bytes = Archive.objects.filter(cached=True).aggregate(size=Sum('archive_size'))['size'] or 0
+    slice_size = get_slice_size(cached_bytes, SCRUB_BYTE_BUDGET)
+    #   Processing archives have no checksum to verify against yet
+    archives = Archive.objects.filter(cached=True, processing=False)\
+        .order_by(F('date_local_verified').asc(nulls_first=True), 'pk')
+
+    limiter = RateLimiter(SCRUB_BYTES_PER_SECOND)
+    verified_bytes = 0
+    for archive in archives.iterator():
+        if verified_bytes >= slice_size:
+            break
+        archive_file_path = os.path.join(MEDIA_ROOT, archive.archive_file.name)
+        if not os.path.isfile(archive_file_path):
+            logger(f"Local archive file for {archive} does not exist")
+            archive.cached = False
+            archive.save(update_fields=['cached'])
+            archive.set_local_checksum(None)
+            ArchiveChange.record(archive, "uncache")
+            continue
+        fingerprint = get_file_fingerprint(archive_file_path, include_ctime=True)
+        checksum = hash_file(archive_file_path, limiter)
+        verified_bytes += os.path.getsize(archive_file_path)
+        if get_file_fingerprint(archive_file_path, include_ctime=True) != fingerprint:
+            logger(f"Local archive file for {archive} changed while it was verified")
+            continue
+        archive.set_local_checksum(checksum, fingerprint)
+        if checksum != archive.archive_file_checksum:
+            logger(f"Local archive file for {archive} fails checksum matching")
+    logger(f"Verified {verified_bytes} bytes of local archive files")
+    return verified_bytes
+
+
+def run(logger=print):
+    """
+    Verify a rolling slice of the remote parts and of the local archive files, prioritizing the ones verified least
+    recently. Deployed to run every SCRUB_INTERVAL seconds, it verifies everything once every SCRUB_PERIOD seconds at a
+    predictable cost
+    """
+    logger("Scrubbing remote archive parts")
+    scrub_remote_parts(logger)
+    logger("Scrubbing local archive files")
+    scrub_local_archives(logger)
@@ -1,12 +1,21 @@
 import typing as ty
 
-from archive.models import Archive
+from anniversary_project.settings import SYNC_FULL_AUDIT_INTERVAL, LOCAL_ARCHIVE_REVERIFY_INTERVAL
+from archive.models import Archive, SyncWatermark
 
 
-def run(logger=print):
+SYNC_NAME = "sync_archive_to_db"
+#   The changes after which the local archive file may have appeared or disappeared
+LOCAL_CHANGE_TYPES = ["create", "cache", "uncache"]
+
+
+def run(logger=print, full_audit: ty.Optional[bool] = None):
     """
-    Iterate through all instances of archive models, and for each of which, check if the corresponding complete file 
-    exists in the media/archives directory and if the complete file's checksum matches the recorded checksum.
+    Iterate through the archives that changed since the last run, according to the ArchiveChange journal, or through
+    all of them for a full audit (every SYNC_FULL_AUDIT_INTERVAL seconds, or if full_audit is True), and for each of
+    which, check if the corresponding complete file exists in the media/archives directory and if the complete
+    file's checksum matches the recorded checksum. The file is only hashed again if it changed since it was last
+    hashed, or if that was more than LOCAL_ARCHIVE_REVERIFY_INTERVAL seconds ago, so that bit rot is still caught.
     -   exists and in good health:
         set "cached" to True
     -   exists but in bad health:
@@ -14,10 +23,20 @@ def run(logger=print):
     -   does not exist:
         Set 'cached' to False
     """
+    watermark, _ = SyncWatermark.objects.get_or_create(sync_name=SYNC_NAME)
+    last_change_id = SyncWatermark.get_last_change_id()
+    if full_audit is None:
+        full_audit = watermark.is_full_audit_due(SYNC_FULL_AUDIT_INTERVAL)
+
     logger(f"Inspecting local archive files")
-    for archive in Archive.objects.all():
+    archives = Archive.objects.all()
+    if not full_audit:
+        changed_archives = watermark.get_changed_archives(last_change_id, LOCAL_CHANGE_TYPES)
+        logger(f"{len(changed_archives)} archives changed since the last sync")
+        archives = archives.filter(pk__in=[archive_id for _, archive_id in changed_archives])
+    for archive in archives:
         logger(f"Inspecting local archive file for {str(archive)}")
-        local_checksum = archive.get_local_checksum()
+        local_checksum = archive.get_local_checksum(reverify_interval=LOCAL_ARCHIVE_REVERIFY_INTERVAL)
         if not local_checksum:
             logger(f"Local archive file for {str(archive)} does not exist")
             archive.cached = False
@@ -26,3 +45,4 @@ def run(logger=print):
                 logger(f"Local archive file for {str(archive)} exists in good health")
                 archive.cached = True
         archive.save()
+    watermark.advance(last_change_id, full_audit)
@@ -1,51 +1,188 @@
-from archive.models import ArchivePartMeta
-from .s3portal.portal_utils import get_active_conn, has_remote, remove_remote, has_healthy_remote, has_local_file, \
-    queue_upload
+import os
+import typing as ty
+
+from botocore.errorfactory import ClientError
+from botocore.exceptions import BotoCoreError
+
+from anniversary_project.settings import MEDIA_ROOT, SYNC_FULL_AUDIT_INTERVAL
+from archive.models import ArchivePartMeta, ArchivePartTable, PersistentTransferJob, SyncWatermark
+from s3connections.models import S3Connection
+from .s3portal.portal_utils import get_active_conn, get_part_conn, get_remote_conns, list_remote_objects, \
+    queue_uploads
 
 
 HEARTBEAT = 10
+SYNC_NAME = "sync_remote_to_db"
 
 
-def run(logger=print):
+def reconcile_parts(archive_parts_meta: ty.Iterable[ArchivePartMeta],
+                    remote_objects: ty.Dict[str, ty.Dict[str, ty.Tuple[str, int]]],
+                    active_conn: ty.Optional[S3Connection],
+                    logger=print) -> ty.Dict[str, ty.Set[str]]:
     """
-    If there is no active connection, then sleep for 10 seconds.
-    If there is an active connection, then iterate through all archive part instances:
+    :param archive_parts_meta: the parts to reconcile, with their archive, owner, and connection selected
+    :param remote_objects: the listing of every bucket the parts are placed on, by connection_id, as returned by
+    list_remote_objects
+    :param active_conn:
+    :param logger:
+    :return: the keys that are supposed to exist remotely, by connection_id. Along the way, diff the parts against
+    the listings in memory:
     -   if the corresponding remote file exists in good health, then set "uploaded" to True
     -   if not, check the following:
-        -   if remote file exists, then delete it
-        -   set "uploaded" to False
+        -   set "uploaded" to False; the remote file, if any, is not among the returned keys, so it will be deleted
         -   if local_file exists, the queue an upload job
+    The changed "uploaded" flags are written and the upload jobs are queued in bulk. Parts that are being uploaded
+    right now are left alone, since the listing may predate their upload. The archive's manifest is expected in every
+    bucket that holds one of its parts, and is written again where it is missing once all of the parts are uploaded
     """
-    active_conn = get_active_conn()
-    if not active_conn:
-        logger(f"No active connection found")
-    logger("Checking remote health for all archive parts")
-    for archive_part_meta in ArchivePartMeta.objects.all():
-        archive_part_meta: ArchivePartMeta = archive_part_meta
-        logger(f"Checking remote health for archive part {archive_part_meta}")
-        if has_healthy_remote(archive_part_meta, active_conn):
-            logger(f"{archive_part_meta} has healthy remote")
-            archive_part_meta.uploaded = True
+    uploading_part_ids = set(PersistentTransferJob.objects.filter(status='running', transfer_type='upload')
+                             .values_list('content_meta_id', flat=True))
+    has_local_file = dict()
+    expected_keys = {conn_id: set() for conn_id in remote_objects}
+    changed_parts, parts_to_upload = list(), list()
+    archives, incomplete_archive_ids, missing_manifest_archive_ids = dict(), set(), set()
+    for archive_part_meta in archive_parts_meta:
+        conn = get_part_conn(archive_part_meta, active_conn)
+        if (not conn) or (conn.connection_id not in remote_objects):
+            continue
+        archive = archive_part_meta.archive
+        archives[archive.archive_id] = archive
+        manifest_key = archive.get_manifest_key()
+        expected_keys[conn.connection_id].add(manifest_key)
+        if manifest_key not in remote_objects[conn.connection_id]:
+            missing_manifest_archive_ids.add(archive.archive_id)
+        remote_key = archive_part_meta.get_remote_key()
+        if archive_part_meta.pk in uploading_part_ids:
+            expected_keys[conn.connection_id].add(remote_key)
+            incomplete_archive_ids.add(archive.archive_id)
+            continue
+        remote_object = remote_objects[conn.connection_id].get(remote_key)
+        is_healthy = remote_object == (archive_part_meta.part_checksum, archive_part_meta.get_size())
+        if is_healthy:
+            expected_keys[conn.connection_id].add(remote_key)
         else:
-            if has_remote(archive_part_meta, active_conn):
+            if remote_object:
                 logger(f"{archive_part_meta}'s remote fails checksum matching and will be deleted")
-                remove_remote(archive_part_meta, active_conn)
-            archive_part_meta.uploaded = False
-            if has_local_file(archive_part_meta):
-                logger(f"Queuing {archive_part_meta}")
-                queue_upload(archive_part_meta)
-        archive_part_meta.save()
-
-    #   After making sure that each archive_part's uploaded flag is correct, remove all remote files that have no
-    #   corresponding "uploaded" archive_part
-    logger("Cleaning up orphaned remote files")
-    uploaded_archive_parts = ArchivePartMeta.objects.filter(uploaded=True)
-    uploaded_archive_part_keys = [part.get_remote_key() for part in uploaded_archive_parts]
-    s3 = active_conn.get_resource('s3')
-    active_bucket = s3.Bucket(active_conn.connection_id)
-    for obj in active_bucket.objects.all():
-        if obj.key not in uploaded_archive_part_keys:
-            #   This object is not supposed to have a remote
-            logger(f"Deleting {obj} for not having corresponding record in database")
-            obj.delete()
+            incomplete_archive_ids.add(archive.archive_id)
+            if archive.archive_id not in has_local_file:
+                has_local_file[archive.archive_id] = os.path.isfile(os.path.join(MEDIA_ROOT, archive.archive_file.name))
+            if has_local_file[archive.archive_id]:
+                parts_to_upload.append(archive_part_meta)
+        if archive_part_meta.uploaded != is_healthy:
+            archive_part_meta.uploaded = is_healthy
+            changed_parts.append(archive_part_meta)
+
+    logger(f"{len(changed_parts)} archive parts changed their uploaded status")
+    ArchivePartMeta.save_state(changed_parts, 'uploaded')
+    upload_jobs = queue_uploads(parts_to_upload)
+    logger(f"Queued {len(upload_jobs)} upload jobs")
+    for archive_id in missing_manifest_archive_ids - incomplete_archive_ids:
+        logger(f"Writing the missing manifest of {archives[archive_id]}")
+        try:
+            archives[archive_id].upload_manifest()
+        except (ClientError, BotoCoreError) as e:
+            logger(f"Failed to write the manifest of {archives[archive_id]}: {e}")
+    return expected_keys
+
+
+def reconcile_part_tables(part_tables: ty.Iterable[ArchivePartTable],
+                          remote_objects: ty.Dict[str, ty.Dict[str, ty.Tuple[str, int]]],
+                          active_conn: ty.Optional[S3Connection],
+                          logger=print) -> ty.Dict[str, ty.Set[str]]:
+    """
+    :param part_tables: the packed archives to reconcile, with their archive and owner selected
+    :param remote_objects: see reconcile_parts
+    :param active_conn:
+    :param logger:
+    :return: the keys that are supposed to exist remotely, by connection_id, like reconcile_parts. Each table's
+    "uploaded" bitmap is written at most twice. A packed archive with parts that are not healthy anymore is unpacked,
+    so that upload jobs can be queued for those parts if the archive file exists locally
+    """
+    expected_keys = {conn_id: set() for conn_id in remote_objects}
+    for part_table in part_tables:
+        healthy_part_indices, unhealthy_part_indices = list(), list()
+        for part in part_table.iter_parts():
+            conn_id = part.connection_id or (active_conn.connection_id if active_conn else None)
+            if conn_id not in remote_objects:
+                continue
+            expected_keys[conn_id].add(part_table.archive.get_manifest_key())
+            remote_key = part.get_remote_key()
+            if remote_objects[conn_id].get(remote_key) == (part.part_checksum, part.get_size()):
+                expected_keys[conn_id].add(remote_key)
+                healthy_part_indices.append(part.part_index)
+            else:
+                unhealthy_part_indices.append(part.part_index)
+        changed = part_table.set_state('uploaded', healthy_part_indices, True) + \
+            part_table.set_state('uploaded', unhealthy_part_indices, False)
+        logger(f"{changed} parts of packed {part_table.archive} changed their uploaded status")
+        archive = part_table.archive
+        if unhealthy_part_indices and os.path.isfile(os.path.join(MEDIA_ROOT, archive.archive_file.name)):
+            part_table.unpack()
+            upload_jobs = queue_uploads(archive.archivepartmeta_set.filter(part_index__in=unhealthy_part_indices))
+            logger(f"Unpacked {archive} and queued {len(upload_jobs)} upload jobs")
+    return expected_keys
 
+
+def run(logger=print, full_audit: ty.Optional[bool] = None):
+    """
+    :param logger:
+    :param full_audit: whether to check every archive regardless of the journal; if None, do so only when the last
+    full audit is more than SYNC_FULL_AUDIT_INTERVAL seconds old
+    :return: None; reconcile archive parts against the buckets they are placed on (see reconcile_parts), and finally
+    remove the remote files that have no corresponding "uploaded" archive part.
+    Only the archives that changed since the last run, according to the ArchiveChange journal, are checked, by
+    listing their own "username/archive_id/" prefix; a deleted archive has no parts left, so every remote file under
+    its prefix is removed. A full audit lists every bucket in one paginated pass each instead, to catch whatever the
+    journal missed
+    """
+    active_conn = get_active_conn()
+    remote_conns = get_remote_conns(active_conn)
+    if not remote_conns:
+        logger(f"No active connection found")
+        return
+    watermark, _ = SyncWatermark.objects.get_or_create(sync_name=SYNC_NAME)
+    #   Changes recorded from now on are left for the next run, since the listings below may predate them
+    last_change_id = SyncWatermark.get_last_change_id()
+    if full_audit is None:
+        full_audit = watermark.is_full_audit_due(SYNC_FULL_AUDIT_INTERVAL)
+
+    logger("Listing remote files")
+    remote_objects = dict()
+    if full_audit:
+        for conn_id, conn in remote_conns.items():
+            remote_objects[conn_id] = list_remote_objects(conn)
+        archive_parts_meta = ArchivePartMeta.objects.all()
+        part_tables = ArchivePartTable.objects.all()
+    else:
+        changed_archives = watermark.get_changed_archives(last_change_id)
+        logger(f"{len(changed_archives)} archives changed since the last sync")
+        for conn_id, conn in remote_conns.items():
+            remote_objects[conn_id] = dict()
+            for username, archive_id in changed_archives:
+                remote_objects[conn_id].update(list_remote_objects(conn, prefix=f"{username}/{archive_id}/"))
+        archive_parts_meta = ArchivePartMeta.objects.filter(
+            archive_id__in=[archive_id for _, archive_id in changed_archives])
+        part_tables = ArchivePartTable.objects.filter(
+            archive_id__in=[archive_id for _, archive_id in changed_archives])
+    for conn_id, conn in remote_conns.items():
+        logger(f"Found {len(remote_objects[conn_id])} remote files in {conn}")
+
+    logger("Checking remote health for archive parts")
+    archive_parts_meta = archive_parts_meta.select_related('archive__owner', 'connection').iterator()
+    expected_keys = reconcile_parts(archive_parts_meta, remote_objects, active_conn, logger)
+    packed_expected_keys = reconcile_part_tables(part_tables.select_related('archive__owner').iterator(),
+                                                 remote_objects, active_conn, logger)
+    for conn_id, keys in packed_expected_keys.items():
+        expected_keys[conn_id].update(keys)
+
+    #   After making sure that each archive_part's uploaded flag is correct, remove all listed remote files that have
+    #   no corresponding "uploaded" archive_part in the bucket it is placed on, including the ones that failed checksum
+    #   matching
+    logger("Cleaning up orphaned remote files")
+    for conn_id, conn in remote_conns.items():
+        orphaned_keys = remote_objects[conn_id].keys() - expected_keys[conn_id]
+        logger(f"Deleting {len(orphaned_keys)} remote files in {conn} for not having corresponding record in database")
+        failures = conn.delete_keys(orphaned_keys)
+        for key, reason in failures.items():
+            logger(f"Failed to delete {key}: {reason}")
+    watermark.advance(last_change_id, full_audit)